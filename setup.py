@@ -27,7 +27,7 @@ setup(
     url='http://github.com/Jaymon/{}'.format(name),
     packages=[name],
     license='GPLv2+',
-    install_requires=['captain', 'wishlist', 'prom', 'sendgrid', 'beautifulsoup4'],
+    install_requires=['captain', 'wishlist', 'prom', 'sendgrid', 'beautifulsoup4', 'requests'],
     classifiers=[ # https://pypi.python.org/pypi?:action=list_classifiers
         'Development Status :: 4 - Beta',
         'Environment :: Plugins',
@@ -6,6 +6,7 @@ import random
 import logging
 import sys
 import datetime
+import codecs
 
 
 # configure logging, for debugging
@@ -24,96 +25,251 @@ logger.setLevel(logging.DEBUG)
 
 from captain import echo, exit, ArgError
 from captain.decorators import arg, args
-from wishlist import Wishlist
-from wishlist.exception import RobotError
 
 from watchlist import __version__
-from watchlist.models import Email, Item, WatchlistItem
+from watchlist.models import Email, DigestEmail, Item, ItemBatch, WatchlistItem, WatchlistSummary, \
+    Fingerprints, WatchlistOutbox, Checkpoint, send_emails
+from watchlist.pages import Pages
+from watchlist.rate import RateController
+from watchlist.stats import stats
+from watchlist import environ, models, sqlite
+from watchlist.compat import is_py3
 
 
-def add_item(email, item, dry_run):
-    save_item = False
-    if item.is_newest():
+@stats.timed("phase", "check")
+def add_item(email, item, dry_run, batch=None):
+    """check item against its history and add it to the email if it has changed
+
+    :param batch: models.ItemBatch, if passed in the item will be saved with the
+        rest of the batch instead of right away
+
+    :returns: string, the name of the email's list the item was added to, None
+        if it wasn't added to the email
+    """
+    verdict = item.verdict
+    category = verdict.category
+    if verdict.newest:
         echo.indent("This is a new item")
-        save_item = True
 
-    else:
-        if item.is_richer():
-            email.richer_items.append(item)
-            echo.indent("price has gone up from {} to {}".format(
-                item.last.price,
-                item.newest.price,
-            ))
-            save_item = True
-
-        elif item.is_cheaper():
-            email.cheaper_items.append(item)
-            echo.indent("price has gone down from {} to {}".format(
-                item.last.price,
-                item.newest.price,
-            ))
-            save_item = True
-
-        elif item.is_cheapest():
-            email.cheapest_items.append(item)
-            echo.indent("price is as cheap as it has ever been {}".format(
-                item.newest.price,
-            ))
-
-        elif not item.is_stocked():
-            email.nostock_items.append(item)
-            echo.indent("is out of stock")
-
-    if save_item and not dry_run:
-        item.save()
-
-
-@arg('name', nargs=1, help="the name of the wishlist, amazon.com/gp/registry/wishlist/NAME")
-@arg('--dry-run', dest="dry_run", action="store_true", help="Perform a dry run")
-def main(name, dry_run):
-    """go through and check wishlist against previous entries"""
+    elif category == "richer_items":
+        echo.indent("price has gone up from {} to {}".format(
+            verdict.last_price,
+            verdict.price,
+        ))
+
+    elif category == "cheaper_items":
+        echo.indent("price has gone down from {} to {}".format(
+            verdict.last_price,
+            verdict.price,
+        ))
+
+    elif category == "cheapest_items":
+        echo.indent("price is as cheap as it has ever been {}".format(
+            verdict.price,
+        ))
+
+    elif category == "nostock_items":
+        echo.indent("is out of stock")
+
+    if category:
+        getattr(email, category).append(item)
+
+    if verdict.changed() and not dry_run:
+        if batch is None:
+            item.save()
+        else:
+            batch.append(item)
+
+    return category
+
+
+def save_batch(batch, email, fingerprints=None, checkpoint=None):
+    """save the batch's items, every item that couldn't be saved is added to the
+    email's errors
+
+    :param fingerprints: models.Fingerprints, the pending fingerprints of the
+        items that couldn't be saved are dropped so they aren't skipped next time
+    :param checkpoint: models.Checkpoint, the pending pages of the items that
+        couldn't be saved won't skip them when the run is resumed
+    :returns: list, the items that couldn't be saved
+    """
+    batch.flush()
+    failed = batch.failed
+    batch.failed = []
+    for item, error in failed:
+        email.errors.append(error)
+        echo.err("Failed to save {}", item.uuid)
+        echo.exception(error[0])
+
+    items = [item for item, _ in failed]
+    if fingerprints is not None:
+        fingerprints.unsaved(items)
+    if checkpoint is not None:
+        checkpoint.unsaved(items)
+    return items
+
+
+def get_items(pages, seen=None, batch=None, fingerprints=None, email=None, checkpoint=None):
+    """flatten the pages into (item_count, item, error) tuples, the price history
+    of each page's items is loaded in a few queries before the page is yielded
+
+    :param pages: pages.Pages
+    :param seen: dict, the items that have already been checked, these won't be
+        loaded again
+    :param batch: models.ItemBatch, this will be flushed after each page, the
+        items that couldn't be saved are errors of the email (see save_batch())
+        and the rest of the pages are still checked
+    :param fingerprints: models.Fingerprints, the fingerprints of each page are
+        saved after the page's items are saved, except for the items that
+        couldn't be saved
+    :param email: models.Email, this will be compacted after each page's items
+        are saved
+    :param checkpoint: models.Checkpoint, each page is saved after its items are
+        saved and the email is compacted
+    """
+    seen = seen or {}
+    for page in pages:
+        if batch is not None:
+            save_batch(batch, email, fingerprints, checkpoint)
+        if fingerprints is not None:
+            fingerprints.save()
+        if email is not None:
+            email.compact()
+        if checkpoint is not None:
+            checkpoint.save()
+
+        items = [item for _, item, _ in page if item and item.uuid not in seen]
+        if items:
+            try:
+                Item.preload(items)
+
+            except Exception as e:
+                # each item will go to the db on its own and report its own error
+                logger.exception(e)
+
+        index = 0
+        try:
+            for t in page:
+                yield t
+                index += 1
 
+        except GeneratorExit:
+            # check_wishlist() bailed in the middle of the page, the items it
+            # checked are still saved so the checkpoint has to skip them
+            if checkpoint is not None and index:
+                checkpoint.page_checked(page, index)
+            raise
+
+        if fingerprints is not None:
+            fingerprints.page_checked(page)
+        if checkpoint is not None:
+            checkpoint.page_checked(page)
+
+    if batch is not None:
+        save_batch(batch, email, fingerprints, checkpoint)
+
+
+def check_wishlist(name, pages, dry_run, seen=None, batch_size=0):
+    """go through all the items of the wishlist and check them against their history
+
+    :param name: string, the wishlist name
+    :param pages: pages.Pages, the wishlist's pages
+    :param seen: dict, if passed in this will be used to track the items that
+        have been checked across multiple wishlists so an item that is on more
+        than one list is only checked and saved once
+    :param batch_size: int, the changed items are saved together in one transaction
+        at the end of each page, or every batch_size items if that comes first
+    :returns: Email, the email with all the changed items of the wishlist
+    """
     echo.out(
         "{}. Starting on wishlist {}",
         datetime.datetime.utcnow(),
         name,
     )
 
-    # Let's flush out any problems connecting to the DB before getting into the loop
-    WatchlistItem.interface.connect()
-
-    name = name[0]
     email = Email(name)
     item_count = 1
+    batch = ItemBatch(batch_size)
+    fingerprints = None if dry_run else pages.fingerprints
+    checkpoint = pages.checkpoint
+    if checkpoint is not None:
+        if checkpoint.page:
+            # the pages start after the checkpoint's last page
+            echo.out("Resuming after page {}", checkpoint.page)
+            item_count = checkpoint.item_count
+            checkpoint.restore(email)
+
+        elif not dry_run:
+            # this run starts over, so any pages saved by a run that died go
+            checkpoint.clear()
+
+        if dry_run:
+            checkpoint = None
+
+    finished = False
+    checked = 0 # the items this run checked, a resumed run starts after item_count
+    items = get_items(pages, seen, batch, fingerprints, email, checkpoint)
     try:
-        for item_count, we in enumerate(Wishlist(name), item_count):
-            try:
-                echo.out("{}. (p{}) {}", item_count, we.page, we.title)
+        for item_count, item, error in items:
+            checked += 1
+            if not error:
+                if item is None:
+                    # it hasn't changed since the last run
+                    continue
 
-                item = Item(
-                    uuid=we.uuid,
-                    body=we.jsonable(),
-                    price=we.price,
-                    element=we,
-                )
-                add_item(email, item, dry_run)
+                if checkpoint is not None and checkpoint.skip(item):
+                    echo.out("{}. (p{}) was checked before the run was resumed", item_count, item.page)
+                    continue
 
-            except Exception as e:
-                exc_type, exc_value, exc_traceback = sys.exc_info()
-                email.errors.append((e, (exc_type, exc_value, exc_traceback)))
+                try:
+                    echo.out("{}. (p{}) {}", item_count, item.page, item.newest.body.get("title", ""))
+                    added = item
+                    if seen is None:
+                        category = add_item(email, item, dry_run, batch)
+
+                    elif item.uuid in seen:
+                        echo.indent("was checked on another wishlist")
+                        added, category = seen[item.uuid]
+                        if category:
+                            getattr(email, category).append(added)
+
+                    else:
+                        # the unchanged items aren't kept since only the changed
+                        # ones get added to the other wishlists' emails
+                        category = add_item(email, item, dry_run, batch)
+                        seen[item.uuid] = (item if category else None, category)
+
+                    if category and checkpoint is not None:
+                        checkpoint.item_added(category, added)
+
+                    if fingerprints is not None:
+                        fingerprints.item_checked(item)
+                    if checkpoint is not None:
+                        checkpoint.item_checked(item)
+
+                except Exception as e:
+                    exc_type, exc_value, exc_traceback = sys.exc_info()
+                    error = (e, (exc_type, exc_value, exc_traceback))
+
+            if error:
+                email.errors.append(error)
 
                 echo.err("{}. Failed!", item_count)
-                echo.exception(e)
+                echo.exception(error[0])
 
                 # bail if we've had a lot of errors or the first N items
                 # have all resulted in an error
                 total_errors = len(email.errors)
-                if total_errors > 25 or (total_errors > 10 and total_errors == item_count):
+                if total_errors > 25 or (total_errors > 10 and total_errors == checked):
                     break
 
+        else:
+            finished = True
+
         echo.out(
-            "{}. Done with wishlist, {} total items, {} changes",
+            "{}. Done with wishlist {}, {} total items, {} changes",
             datetime.datetime.utcnow(),
+            name,
             item_count,
             len(email),
         )
@@ -123,8 +279,319 @@ def main(name, dry_run):
         email.errors.append((e, (exc_type, exc_value, exc_traceback)))
         echo.exception(e)
 
+    finally:
+        items.close()
+        pages.close()
+
+    try:
+        # if we bailed there could still be some items that need to be saved
+        save_batch(batch, email, fingerprints, checkpoint)
+        email.compact()
+
+        if fingerprints is not None:
+            if fingerprints.full and not email.errors:
+                fingerprints.swept()
+            else:
+                fingerprints.save()
+
+        if checkpoint is not None:
+            if finished:
+                # the email has the whole wishlist
+                checkpoint.clear()
+            else:
+                checkpoint.save()
+
+    except Exception as e:
+        exc_type, exc_value, exc_traceback = sys.exc_info()
+        email.errors.append((e, (exc_type, exc_value, exc_traceback)))
+        echo.exception(e)
+
+    email.kwargs["item_count"] = item_count
+    return email
+
+
+def get_names(names, names_file):
+    """combine the names passed in on the command line with the names in names_file
+
+    :param names_file: string, path to a file with one wishlist name per line,
+        blank lines and lines starting with # are ignored
+    :returns: list, the unique names in order
+    """
+    names = list(names or [])
+    if names_file:
+        with codecs.open(names_file, encoding="UTF-8") as f:
+            for line in f:
+                line = line.strip()
+                if line and not line.startswith("#"):
+                    names.append(line)
+
+    ret = []
+    for name in names:
+        if name not in ret:
+            ret.append(name)
+    return ret
+
+
+@arg('names', metavar="NAME", nargs="*", help="the name of the wishlist, amazon.com/gp/registry/wishlist/NAME")
+@arg('--names-file', dest="names_file", default="", help="path to a file with a wishlist NAME on each line")
+@arg('--dry-run', dest="dry_run", action="store_true", help="Perform a dry run")
+@arg(
+    '--prefetch',
+    type=int,
+    default=environ.PREFETCH,
+    help="How many pages can be fetched ahead of the page being checked, 0 to turn off"
+)
+@arg(
+    '--workers',
+    type=int,
+    default=environ.WORKERS,
+    help="How many wishlists can be fetched at the same time"
+)
+@arg(
+    '--batch-size',
+    dest="batch_size",
+    type=int,
+    default=environ.BATCH_SIZE,
+    help="Save the changed items every N items instead of at the end of each page"
+)
+@arg(
+    '--digest',
+    action="store_true",
+    help="Send one email with a section for each wishlist instead of an email for each wishlist"
+)
+@arg(
+    '--stats',
+    dest="show_stats",
+    action="store_true",
+    help="Print how long each part of the run took and how many queries it made"
+)
+@arg(
+    '--stats-path',
+    dest="stats_path",
+    default=environ.STATS_PATH,
+    help="Write the stats to this path, as json if it ends with .json otherwise as Prometheus text"
+)
+@arg(
+    '--incremental',
+    action="store_true",
+    help="Skip the items and pages that haven't changed since the last run"
+)
+@arg(
+    '--full-sweep-days',
+    dest="full_sweep_days",
+    type=int,
+    default=environ.FULL_SWEEP_DAYS,
+    help="With --incremental, check every item if the last full check was more than N days ago"
+)
+@arg(
+    '--engine',
+    choices=["sync", "asyncio"],
+    default=environ.ENGINE,
+    help="asyncio fetches the wishlists and sends the emails with coroutines, it needs python 3"
+)
+@arg(
+    '--render-workers',
+    dest="render_workers",
+    type=int,
+    default=environ.RENDER_WORKERS,
+    help="How many processes render the big sections of the email, 0 to render them in this process"
+)
+@arg(
+    '--spill-size',
+    dest="spill_size",
+    type=int,
+    default=environ.SPILL_SIZE,
+    help="Move the items of an email section to a temporary file once it has N items, 0 to keep them in memory"
+)
+@arg(
+    '--rebuild-summary',
+    dest="rebuild_summary",
+    action="store_true",
+    help="Build the price summary of every item from its history, NAME isn't needed"
+)
+@arg(
+    '--migrate',
+    action="store_true",
+    help="Add the indexes that were added after the database was created, NAME isn't needed"
+)
+@arg(
+    '--compact',
+    action="store_true",
+    help="Collapse the old price history into the cheapest and richest price of each day, NAME isn't needed"
+)
+@arg(
+    '--compact-days',
+    dest="compact_days",
+    type=int,
+    default=environ.COMPACT_DAYS,
+    help="With --compact, only collapse the history that is older than N days"
+)
+@arg(
+    '--outbox',
+    action="store_true",
+    default=environ.OUTBOX,
+    help="Save the emails to the outbox instead of sending them, see --flush-outbox"
+)
+@arg(
+    '--flush-outbox',
+    dest="flush_outbox",
+    action="store_true",
+    help="Send the emails in the outbox, this happens after checking NAME if it is passed in"
+)
+@arg(
+    '--resume',
+    action="store_true",
+    help="Save how far each wishlist has gotten after each page, and continue after the last page a run with --resume checked if that run didn't finish"
+)
+@arg(
+    '--rate-concurrency',
+    dest="rate_concurrency",
+    type=int,
+    default=environ.RATE_CONCURRENCY,
+    help="The most pages that are fetched at the same time, this goes down on its own if Amazon pushes back"
+)
+@arg(
+    '--rate-delay',
+    dest="rate_delay",
+    type=float,
+    default=environ.RATE_DELAY,
+    help="The least seconds between two page fetches, this goes up on its own if Amazon pushes back"
+)
+def main(names, names_file, dry_run, prefetch, workers, batch_size, digest, show_stats, stats_path,
+         incremental, full_sweep_days, engine, render_workers, spill_size,
+         rebuild_summary, migrate, compact, compact_days, outbox, flush_outbox, resume,
+         rate_concurrency, rate_delay):
+    """go through and check wishlists against previous entries"""
+    names = get_names(names, names_file)
+    if not names and not rebuild_summary and not migrate and not compact and not flush_outbox:
+        raise ArgError("no wishlist NAME was passed in")
+
+    if engine == "asyncio" and not is_py3:
+        raise ArgError("the asyncio engine needs python 3")
+
+    # Let's flush out any problems connecting to the DB before getting into the loop
+    sqlite.configure()
+    WatchlistItem.interface.connect()
+
+    if migrate:
+        echo.out("Migrating the database")
+        echo.out("Done, {} indexes", len(models.migrate()))
+
+    if rebuild_summary:
+        echo.out("Rebuilding the price summaries")
+        echo.out("Done, {} items", WatchlistSummary.rebuild())
+
+    if compact:
+        echo.out("Compacting the price history older than {} days", compact_days)
+        items, rows = WatchlistItem.compact(compact_days)
+        echo.out("Done, removed {} rows of {} items", rows, items)
+
+    if names:
+        Email.render_workers = render_workers
+        Email.spill_size = spill_size
+
+        if show_stats or stats_path:
+            stats.clear()
+            stats.enable(WatchlistItem.interface)
+
+        try:
+            check_wishlists(
+                names,
+                dry_run,
+                prefetch,
+                workers,
+                batch_size,
+                digest,
+                incremental,
+                full_sweep_days,
+                engine,
+                outbox,
+                resume,
+                rate_concurrency,
+                rate_delay,
+            )
+
+        finally:
+            if stats.enabled:
+                if show_stats:
+                    echo.out("Stats:")
+                    for line in stats.lines():
+                        echo.indent(line)
+
+                if stats_path:
+                    stats.write(stats_path)
+
+                stats.disable(WatchlistItem.interface)
+
+    if flush_outbox:
+        echo.out("Sending the emails in the outbox")
+        sent, failed = WatchlistOutbox.flush(workers=workers)
+        echo.out("Done, {} sent, {} failed", sent, failed)
+
+
+def check_wishlists(names, dry_run, prefetch, workers, batch_size, digest, incremental=False,
+                    full_sweep_days=0, engine="sync", outbox=False, resume=False,
+                    rate_concurrency=1, rate_delay=0.0):
+    """check all the wishlists and send the emails, see main()"""
+    # the db work all happens in this thread on the one connection, while the
+    # next workers wishlists are fetched in the background so their pages are
+    # ready by the time we get to them
+    from wishlist import Wishlist # the browser is slow to import so it waits until it is needed
+    rate = RateController(rate_concurrency, rate_delay)
+    pages = []
+    for name in names:
+        fingerprints = Fingerprints.load(name, full_sweep_days) if incremental else None
+        if fingerprints and fingerprints.full:
+            echo.out("Checking every item of wishlist {}, this is a full sweep", name)
+
+        checkpoint = None
+        if resume:
+            checkpoint = Checkpoint.load(name)
+
+        elif not dry_run:
+            # only a run with --resume saves its pages, this one can't be resumed
+            # so the pages a resumable run left behind are out of date
+            Checkpoint(name).clear()
+
+        pages.append(Pages(
+            Wishlist(name),
+            prefetch=prefetch,
+            fingerprints=fingerprints,
+            checkpoint=checkpoint,
+            rate=rate,
+        ))
+
+    seen = {} if len(names) > 1 else None
+    if engine == "asyncio":
+        from watchlist.aio import Engine
+        engine = Engine(check_wishlist, requests=workers)
+        emails = engine.run(names, pages, dry_run, seen, batch_size)
+
+    else:
+        engine = None
+        emails = []
+        for i, name in enumerate(names):
+            for p in pages[i:i + max(workers, 1)]:
+                p.start()
+
+            emails.append(check_wishlist(name, pages[i], dry_run, seen, batch_size))
+
+    echo.out("Rate:")
+    for line in rate.lines():
+        echo.indent(line)
+
     if not dry_run:
-        email.send(item_count=item_count)
+        if digest and len(emails) > 1:
+            emails = [DigestEmail(emails)]
+
+        if outbox:
+            echo.out("Added {} emails to the outbox", WatchlistOutbox.queue(emails))
+
+        elif engine:
+            engine.send(emails)
+
+        else:
+            send_emails(emails, workers)
 
 
 def console():
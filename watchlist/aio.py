@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""The asyncio engine, see `watchlist --engine asyncio`
+
+this is python 3 only so it is only imported when the engine is picked
+"""
+import sys
+import asyncio
+import concurrent.futures
+
+from .compat import *
+from .models import WatchlistItem
+
+
+class QueuePages(object):
+    """What check_wishlist() iterates in the asyncio engine
+
+    check_wishlist() runs on the db thread and this hands it the pages the
+    engine's fetch coroutine puts into the asyncio queue
+    """
+    def __init__(self, loop, queue, task, fingerprints=None, checkpoint=None):
+        self.loop = loop
+        self.queue = queue
+        self.task = task
+        self.fingerprints = fingerprints
+        self.checkpoint = checkpoint
+
+    def __iter__(self):
+        while True:
+            f = asyncio.run_coroutine_threadsafe(self.queue.get(), self.loop)
+            page, exc_info = f.result()
+            if exc_info:
+                reraise(*exc_info)
+
+            if page is None:
+                break
+
+            yield page
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.task.cancel)
+
+
+class Engine(object):
+    """Checks wishlists and sends their emails with asyncio
+
+    every wishlist's pages are fetched by its own coroutine and the emails are sent
+    by coroutines, fetching and sending are blocking (wishlist uses a browser and
+    sendgrid uses urllib) so they run in a thread pool and the semaphore keeps at
+    most requests of them in flight at the same time
+
+    prom is blocking too and a SQLite connection can only be used by the thread
+    that opened it, so all the db work runs on the one db thread. The wishlists are
+    checked one after the other on the db thread by the same check_wishlist() the
+    sync engine uses, so the emails come out the same
+
+    :Example:
+        engine = Engine(check_wishlist, requests=4)
+        emails = engine.run(names, pages, dry_run=False)
+        engine.send(emails)
+    """
+    def __init__(self, check_wishlist, requests=4):
+        """
+        :param check_wishlist: callable, __main__.check_wishlist
+        :param requests: int, how many fetches and sends can be in flight at once
+        """
+        self.check_wishlist = check_wishlist
+        self.requests = max(requests, 1)
+
+    def run(self, names, pages, dry_run, seen=None, batch_size=0):
+        """check all the wishlists
+
+        :param names: list, the wishlist names
+        :param pages: list, the pages.Pages of each name, they are iterated with
+            .pages() since the engine does its own prefetching
+        :returns: list, the Email of each wishlist
+        """
+        return self.loop_run(self.check_all(names, pages, dry_run, seen, batch_size))
+
+    def send(self, emails):
+        """send all the emails at the same time"""
+        return self.loop_run(self.send_all(emails))
+
+    def loop_run(self, coro):
+        loop = asyncio.new_event_loop()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.requests)
+        self.db_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+        # the db thread opens its own connection and closes it when it's done so
+        # this thread can open one again afterwards
+        interface = WatchlistItem.interface
+        interface.close()
+        try:
+            return loop.run_until_complete(coro)
+
+        finally:
+            self.db_executor.submit(interface.close).result()
+            self.db_executor.shutdown()
+            self.executor.shutdown()
+            loop.close()
+
+    async def db(self, callback, *args):
+        """run callback on the db thread"""
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.db_executor, callback, *args)
+
+    async def blocking(self, callback, *args):
+        """run callback in the thread pool once the semaphore lets it"""
+        loop = asyncio.get_event_loop()
+        async with self.semaphore:
+            return await loop.run_in_executor(self.executor, callback, *args)
+
+    async def fetch(self, pages, queue):
+        """fetch the pages and put (page, exc_info) tuples into queue, a (None, None)
+        tuple means the wishlist is done"""
+        it = pages.pages()
+        try:
+            while True:
+                page = await self.blocking(next, it, None)
+                if page is None:
+                    break
+                await queue.put((page, None))
+
+        except asyncio.CancelledError:
+            raise
+
+        except Exception:
+            await queue.put((None, sys.exc_info()))
+
+        else:
+            await queue.put((None, None))
+
+    async def check_all(self, names, pages, dry_run, seen, batch_size):
+        loop = asyncio.get_event_loop()
+        self.semaphore = asyncio.Semaphore(self.requests)
+        qpages = []
+        for p in pages:
+            # the queue is how far ahead of the db thread each wishlist can get
+            queue = asyncio.Queue(maxsize=max(p.prefetch, 1))
+            task = loop.create_task(self.fetch(p, queue))
+            qpages.append(QueuePages(loop, queue, task, p.fingerprints, p.checkpoint))
+
+        emails = []
+        try:
+            for name, qp in zip(names, qpages):
+                email = await self.db(self.check_wishlist, name, qp, dry_run, seen, batch_size)
+                emails.append(email)
+
+        finally:
+            for qp in qpages:
+                qp.task.cancel()
+            await asyncio.gather(*[qp.task for qp in qpages], return_exceptions=True)
+
+        return emails
+
+    async def send_email(self, email):
+        # check_wishlist() leaves snapshots in the email (see Email.compact()) but
+        # any Item still in it goes to the db when it is rendered, rendering the
+        # html once on the db thread caches those lookups so rendering it again
+        # while sending doesn't go to the db
+        await self.db(lambda: list(email.iter_html()))
+        return await self.blocking(email.send)
+
+    async def send_all(self, emails):
+        self.semaphore = asyncio.Semaphore(self.requests)
+        rets = await asyncio.gather(
+            *[self.send_email(em) for em in emails],
+            return_exceptions=True
+        )
+        for ret in rets:
+            if isinstance(ret, Exception):
+                raise ret
+        return rets
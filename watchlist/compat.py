@@ -10,6 +10,8 @@ is_py3 = (_ver[0] == 3)
 
 if is_py2:
     from StringIO import StringIO
+    import Queue as queue
+    import cPickle as pickle
 
     basestring = basestring
     range = xrange # range is now always an iterator
@@ -26,8 +28,11 @@ if is_py2:
 
 elif is_py3:
     from io import StringIO
+    import queue
+    import pickle
 
     basestring = (str, bytes)
+    long = int
 
     # ripped from six https://bitbucket.org/gutworth/six
     def reraise(tp, value, tb=None):
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, division, print_function, absolute_import
+import inspect
+
+
+class cachedproperty(object):
+    """A read only property that only runs its method once per instance
+
+    the value is cached in the instance's __dict__ under the same name, since
+    this isn't a data descriptor (there is no __set__) the instance's __dict__ takes
+    priority over this on every lookup after the first one, which is why just
+    setting self.__dict__[name] in a normal property doesn't work
+
+    example --
+
+        class Foo(object):
+            @cachedproperty
+            def bar(self):
+                return expensive_lookup()
+
+        f = Foo()
+        f.bar # runs expensive_lookup()
+        f.bar # cached
+        cachedproperty.reset(f)
+        f.bar # runs expensive_lookup() again
+    """
+    def __init__(self, fget):
+        self.fget = fget
+        self.__name__ = fget.__name__
+        self.__doc__ = fget.__doc__
+
+    def __get__(self, instance, cls):
+        if instance is None:
+            return self
+
+        ret = self.fget(instance)
+        instance.__dict__[self.__name__] = ret
+        return ret
+
+    @classmethod
+    def reset(cls, instance, *names):
+        """clear the cached values of instance
+
+        :param instance: object, the instance with cached values
+        :param *names: the names of the properties to clear, if empty then all the
+            cached properties of instance are cleared
+        """
+        if not names:
+            names = set()
+            # we go through vars() instead of getattr() so we don't trigger any
+            # other descriptors on the class (eg, Orm.query)
+            for klass in inspect.getmro(type(instance)):
+                for k, v in vars(klass).items():
+                    if isinstance(v, cls):
+                        names.add(k)
+
+        for name in names:
+            instance.__dict__.pop(name, None)
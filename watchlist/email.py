@@ -2,10 +2,13 @@ from __future__ import unicode_literals
 import os
 import logging
 import traceback
+import time
+import random
+import threading
+from multiprocessing.pool import ThreadPool
 
-import sendgrid
-from sendgrid.helpers.mail import Email as EmailAddr, Content, Mail, Personalization
-from brow.utils import Soup
+from .stats import stats
+from . import environ
 
 
 logger = logging.getLogger(__name__)
@@ -17,6 +20,8 @@ class Email(object):
 
     body_html = ""
 
+    _interface = None
+
     @property
     def body_text(self):
         body = getattr(self, "_body_text", None)
@@ -24,6 +29,9 @@ class Email(object):
             body = ""
             html = self.body_html
             if html:
+                # brow pulls in the browser and bs4, so it's only imported when a
+                # text body is needed
+                from brow.utils import Soup
                 body_texts = [text for text in Soup(html).stripped_strings]
                 body = " ".join(body_texts)
         return body
@@ -42,12 +50,19 @@ class Email(object):
 
     @property
     def interface(self):
-        if not hasattr(self, '_interface'):
-            self._interface = sendgrid.SendGridAPIClient(apikey=os.environ['SENDGRID_KEY'])
-        return self._interface
+        return self.get_interface()
+
+    @classmethod
+    def get_interface(cls):
+        # every email shares the one Delivery so its connections are reused
+        if Email._interface is None:
+            Email._interface = Delivery()
+        return Email._interface
+
+    def mail(self):
+        """Return the json body of the SendGrid request that sends this email"""
+        from sendgrid.helpers.mail import Email as EmailAddr, Content, Mail, Personalization
 
-    def send(self):
-        response = None
         # https://github.com/sendgrid/sendgrid-python/blob/master/examples/helpers/mail/mail_example.py
         mail = Mail()
         mail.from_email = EmailAddr(self.from_email)
@@ -60,15 +75,15 @@ class Email(object):
         mail.add_content(Content("text/plain", self.body_text))
         body_html = self.body_html
         if body_html:
-            mail.add_content(Content("text/html", self.body_html))
+            mail.add_content(Content("text/html", body_html))
 
-        # on success it returns 202
-        # https://sendgrid.com/docs/API_Reference/api_v3.html
-        response = self.interface.client.mail.send.post(request_body=mail.get())
-        if response.status_code >= 400:
-            raise SendError(response)
+        return mail.get()
 
-        return response
+    def send(self):
+        ret = self.interface.send([self])[0]
+        if isinstance(ret, Exception):
+            raise ret
+        return ret
 
     def __str__(self):
         lines = [
@@ -103,14 +118,141 @@ class ErrorEmail(Email):
 
 
 class SendError(Exception):
-    def __init__(self, response):
+    def __init__(self, response=None, error=None):
+        """
+        :param response: requests.Response, the failed SendGrid response
+        :param error: Exception, the connection error when SendGrid never responded
+        """
+        self.response = response
+        self.error = error
+        self.__cause__ = error
+        if response is None:
+            self.errno = None
+            super(SendError, self).__init__(str(error))
+            return
+
         self.errno = response.status_code
 
         msg = []
-        errors = response.body.get("errors", {})
+        try:
+            errors = response.json().get("errors", [])
+        except ValueError:
+            errors = []
         for err_d in errors:
             msg.append(err_d.get("message", ""))
+        super(SendError, self).__init__("\n\n".join(msg) or response.reason)
 
-        self.response = response
-        super(SendError, self).__init__("\n\n".join(msg))
 
+class Delivery(object):
+    """Sends emails to SendGrid at the same time
+
+    the emails' bodies are rendered in the calling thread, since rendering can
+    still go to the db, and then they are posted from a pool of threads that each
+    keep their own connection open to SendGrid. A 429 or 5xx response (or a
+    connection error) is retried with an exponential backoff with jitter so
+    retries of different emails don't all happen at the same time
+
+    :Example:
+        responses = Delivery().send(emails)
+    """
+    url = environ.SENDGRID_URL
+
+    retries = 4
+    """how many times a request is retried before giving up"""
+
+    backoff = 0.5
+    """the first retry waits up to this many seconds, every retry after that can
+    wait twice as long as the one before it"""
+
+    timeout = 30
+    """seconds, so a SendGrid that stopped responding doesn't hang the run"""
+
+    def __init__(self, workers=environ.WORKERS):
+        """
+        :param workers: int, how many emails can be posted at the same time
+        """
+        self.workers = workers
+        self.local = threading.local()
+
+    @property
+    def session(self):
+        """the requests session of the current thread"""
+        session = getattr(self.local, "session", None)
+        if session is None:
+            import requests
+            session = requests.Session()
+            session.headers["Authorization"] = "Bearer {}".format(os.environ["SENDGRID_KEY"])
+            self.local.session = session
+        return session
+
+    def post(self, body):
+        """post body to SendGrid, retrying if SendGrid is busy or having problems
+
+        :param body: dict, the json body from Email.mail()
+        :returns: requests.Response, SendGrid returns 202 on success
+        """
+        import requests
+
+        attempt = 0
+        while True:
+            response = None
+            try:
+                with stats.timer("phase", "send"):
+                    response = self.session.post(self.url, json=body, timeout=self.timeout)
+                if response.status_code < 400:
+                    return response
+
+                if response.status_code != 429 and response.status_code < 500:
+                    raise SendError(response)
+
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt >= self.retries:
+                    raise SendError(error=e)
+
+            if attempt >= self.retries:
+                raise SendError(response)
+
+            delay = random.uniform(0, self.backoff * (2 ** attempt))
+            retry_after = response.headers.get("Retry-After", "") if response is not None else ""
+            if retry_after.isdigit():
+                delay = max(delay, int(retry_after))
+
+            logger.warning("SendGrid request failed, retrying in {:.2f} seconds".format(delay))
+            time.sleep(delay)
+            attempt += 1
+
+    def send(self, emails, workers=0):
+        """send all the emails
+
+        :param emails: list, Email instances
+        :param workers: int, overrides .workers
+        :returns: list, the response of each email or the exception that was raised
+            trying to send it
+        """
+        return self.post_all([em.mail() for em in emails], workers)
+
+    def post_all(self, bodies, workers=0):
+        """post all the bodies at the same time
+
+        :param bodies: list, the json bodies from Email.mail()
+        :param workers: int, overrides .workers
+        :returns: list, the response of each body or the exception that was raised
+            posting it
+        """
+        def post(body):
+            try:
+                return self.post(body)
+            except Exception as e:
+                return e
+
+        workers = min(workers or self.workers, len(bodies))
+        if workers <= 1:
+            return [post(body) for body in bodies]
+
+        pool = ThreadPool(workers)
+        try:
+            return pool.map(post, bodies)
+
+        finally:
+            pool.close()
+            pool.join()
@@ -9,3 +9,52 @@ SUCCESS_PATH = os.environ.get("WATCHLIST_SUCCESS_PATH", "")
 ERROR_PATH = os.environ.get("WATCHLIST_ERROR_PATH", "")
 """The error email's body will be dumped to this path if it exists"""
 
+PREFETCH = int(os.environ.get("WATCHLIST_PREFETCH", 2))
+"""How many pages of the wishlist can be fetched ahead of the page being checked"""
+
+WORKERS = int(os.environ.get("WATCHLIST_WORKERS", 4))
+"""How many wishlists can be fetched at the same time when checking more than one"""
+
+BATCH_SIZE = int(os.environ.get("WATCHLIST_BATCH_SIZE", 0))
+"""Changed items are saved in one transaction every N items, 0 to save at the end
+of each page"""
+
+STATS_PATH = os.environ.get("WATCHLIST_STATS_PATH", "")
+"""If set the run's stats are written to this path, see --stats-path"""
+
+FULL_SWEEP_DAYS = int(os.environ.get("WATCHLIST_FULL_SWEEP_DAYS", 7))
+"""In incremental mode every item is checked if the last full sweep was more than
+this many days ago, 0 to never do a full sweep"""
+
+ENGINE = os.environ.get("WATCHLIST_ENGINE", "sync")
+"""sync or asyncio, see --engine"""
+
+RENDER_WORKERS = int(os.environ.get("WATCHLIST_RENDER_WORKERS", 0))
+"""How many processes render the big sections of the email, 0 to render them all
+in the main process"""
+
+SPILL_SIZE = int(os.environ.get("WATCHLIST_SPILL_SIZE", 0))
+"""Once a section of the email has this many items in memory they are moved to a
+temporary file, 0 to keep them all in memory"""
+
+COMPACT_DAYS = int(os.environ.get("WATCHLIST_COMPACT_DAYS", 90))
+"""--compact collapses the price history that is older than this many days"""
+
+SQLITE_PROFILE = os.environ.get("WATCHLIST_SQLITE_PROFILE", "")
+"""tuned to connect to SQLite with WAL and the other settings of watchlist.sqlite.SQLite,
+empty to use prom's SQLite settings"""
+
+SENDGRID_URL = os.environ.get("WATCHLIST_SENDGRID_URL", "https://api.sendgrid.com/v3/mail/send")
+"""Where the emails are posted, this only needs to change to point at a stand in
+for SendGrid"""
+
+OUTBOX = bool(int(os.environ.get("WATCHLIST_OUTBOX", 0)))
+"""Save the emails to the outbox instead of sending them, see --outbox"""
+
+RATE_CONCURRENCY = int(os.environ.get("WATCHLIST_RATE_CONCURRENCY", 1))
+"""The most wishlist pages that are fetched at the same time across all the
+wishlists, see rate.RateController"""
+
+RATE_DELAY = float(os.environ.get("WATCHLIST_RATE_DELAY", 0))
+"""The least seconds between the start of two wishlist page fetches, the delay
+goes up from here when Amazon pushes back, see rate.RateController"""
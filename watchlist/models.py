@@ -1,17 +1,25 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals, division, print_function, absolute_import
 import os
+import sys
 import datetime
 import bisect
+import itertools
 from distutils import dir_util
 import codecs
 import logging
+import hashlib
+import json
+import multiprocessing
+import threading
+import tempfile
+import heapq
 
 from prom import Orm, Field, ObjectField, Index
-import sendgrid
-from bs4 import BeautifulSoup
 
 from .email import Email as BaseEmail, ErrorEmail
+from .decorators import cachedproperty
+from .stats import stats
 from .compat import *
 from . import environ
 
@@ -33,84 +41,325 @@ class Filepath(object):
         with self.open("w+") as f:
             return f.write(contents)
 
+    def writelines(self, lines):
+        """write lines with a newline between each of them, this is the same as
+        .write("\\n".join(lines)) without ever having all of lines in memory"""
+        dir_util.mkpath(self.directory)
+        with self.open("w+") as f:
+            for i, line in enumerate(lines):
+                if i:
+                    f.write("\n")
+                f.write(line)
+
     def open(self, mode=""):
         if not mode:
             mode = "r"
         return codecs.open(self.path, encoding=self.encoding, mode=mode)
 
 
-class SortedList(list):
+class SortedList(object):
     """Keep a list sorted as you append or extend it
 
-    simpler version of this recipe:
-        https://code.activestate.com/recipes/577197-sortedcollection/
+    the values are kept in a list of smaller sorted lists, each append bisects
+    the last keys of the sublists to find the right sublist and then inserts into
+    a list of at most 2 * load values, so appending n values is O(n log n) instead
+    of the O(n^2) you get inserting into one big list. This is a much simpler
+    version of how the sortedcontainers package does it:
+        http://www.grantjenks.com/docs/sortedcontainers/implementation.html
 
-    uses this stdlib:
-        https://docs.python.org/2.7/library/bisect.html
+    the key of each value is only computed once when it is appended, values with
+    equal keys stay in the order they were appended
     """
+    load = 1000
+    """sublists are split in half when they get to twice this size"""
+
     def __init__(self, key=None, reverse=False):
         self.key = (lambda x: x) if key is None else key
         self.reverse = reverse
-        self.semaphore = False
-        self._keys = []
+        self.clear()
+
+    def append(self, x, key=None):
+        """
+        :param key: the key of x if it is already known, x's key is computed if
+            this is None
+        """
+        # the counter makes every key unique so values never get compared and
+        # equal keys keep their append order
+        k = (self.key(x) if key is None else key, next(self._counter))
+        if self._maxes:
+            i = bisect.bisect_right(self._maxes, k)
+            if i == len(self._maxes):
+                i -= 1
+                self._keys[i].append(k)
+                self._values[i].append(x)
+                self._maxes[i] = k
+
+            else:
+                j = bisect.bisect_right(self._keys[i], k)
+                self._keys[i].insert(j, k)
+                self._values[i].insert(j, x)
+
+            if len(self._keys[i]) > self.load * 2:
+                self._split(i)
 
-    def append(self, x):
-        k = self.key(x)
-        i = bisect.bisect_right(self._keys, k)
-        self.semaphore = True
-        if i is None:
-            super(SortedList, self).append(x)
-            self._keys.append(k)
         else:
-            self.insert(i, x)
-            self._keys.insert(i, k)
-        self.semaphore = False
+            self._keys.append([k])
+            self._values.append([x])
+            self._maxes.append(k)
+
+        self._len += 1
 
     def extend(self, iterable):
         for x in iterable:
             self.append(x)
 
-    def insert(self, i, x):
-        if self.semaphore:
-            super(SortedList, self).insert(i, x)
-        else:
-            raise NotImplementedError()
-
     def remove(self, x):
-        k = self.key(x)
-        self._keys.remove(k)
-        super(SortedList, self).remove(x)
+        """remove the first occurrence of x, this has to compute x's key again to
+        find it
 
-    def pop(self, *args, **kwargs):
-        super(SortedList, self).pop(*args, **kwargs)
-        self._keys.pop(*args, **kwargs)
+        :raises: ValueError, if x isn't in the list
+        """
+        k = (self.key(x),)
+        i = bisect.bisect_left(self._maxes, k)
+        while i < len(self._maxes) and self._keys[i][0][0] <= k[0]:
+            for j, v in enumerate(self._values[i]):
+                if v is x or v == x:
+                    self._delete(i, j)
+                    return
+            i += 1
+
+        raise ValueError("{} not in list".format(x))
+
+    def replace(self, callback):
+        """replace every value x with callback(x) in place, the keys aren't
+        computed again so the order doesn't change"""
+        for values in self._values:
+            for j, x in enumerate(values):
+                values[j] = callback(x)
+
+    def pop(self, i=-1):
+        """remove and return the value at index i (default last)"""
+        i, j = self._position(i)
+        x = self._values[i][j]
+        self._delete(i, j)
+        return x
 
     def clear(self):
-        super(SortedList, self).clear()
-        self._keys.clear()
+        self._keys = [] # sublists of (key, counter) tuples
+        self._values = [] # sublists of values, parallel to ._keys
+        self._maxes = [] # the last key of each sublist
+        self._len = 0
+        self._counter = itertools.count()
+
+    def _split(self, i):
+        half = len(self._keys[i]) // 2
+        self._keys.insert(i + 1, self._keys[i][half:])
+        self._values.insert(i + 1, self._values[i][half:])
+        del self._keys[i][half:]
+        del self._values[i][half:]
+        self._maxes.insert(i, self._keys[i][-1])
+
+    def _delete(self, i, j):
+        del self._keys[i][j]
+        del self._values[i][j]
+        if self._keys[i]:
+            self._maxes[i] = self._keys[i][-1]
+
+        else:
+            del self._keys[i]
+            del self._values[i]
+            del self._maxes[i]
+
+        self._len -= 1
+
+    def _position(self, index):
+        """convert a public index into the (sublist, position) of the value"""
+        if index < 0:
+            index += self._len
+
+        if index < 0 or index >= self._len:
+            raise IndexError("list index out of range")
 
-    def __getitem__(self, i):
         if self.reverse:
-            i = -(i + 1)
-        return super(SortedList, self).__getitem__(i)
+            index = self._len - index - 1
+
+        for i, values in enumerate(self._values):
+            if index < len(values):
+                return i, index
+            index -= len(values)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return list(self)[index]
+
+        i, j = self._position(index)
+        return self._values[i][j]
 
     def __iter__(self):
         if self.reverse:
-            for x in reversed(self):
-                yield x
+            for values in reversed(self._values):
+                for x in reversed(values):
+                    yield x
+
         else:
-            for x in super(SortedList, self).__iter__():
+            for values in self._values:
+                for x in values:
+                    yield x
+
+    def __len__(self):
+        return self._len
+
+    def __bool__(self):
+        return self._len > 0
+    __nonzero__ = __bool__ # 2
+
+
+class SpillList(SortedList):
+    """A SortedList that can move its values to a temporary file so a huge list
+    doesn't have to be kept in memory
+
+    .spill() writes the values in memory to the file as one sorted run and clears
+    them out of memory, iterating does an external merge of all the runs and
+    whatever is still in memory, so only one value of each run is in memory at a
+    time. The values have to be picklable and a value that was spilled is a copy
+    from then on, so this is for values that won't change anymore, Email only
+    spills ItemSnapshot instances, see Email.compact()
+
+    .pop() and .remove() only see the values that haven't been spilled, and the
+    runs can only be merged from their start so there is no reverse
+    """
+    def __init__(self, key=None, size=0):
+        """
+        :param size: int, .spill() only spills once there are this many values in
+            memory, 0 to never spill
+        """
+        self.size = size
+        self._file = None
+        self._runs = [] # (offset, count) of each run in ._file
+        self._spilled = 0
+        self._last = None # the (key, value) with the largest key that was spilled
+        super(SpillList, self).__init__(key=key)
+
+    def spill(self):
+        """write the values in memory to the file if there are at least .size of them
+
+        :returns: int, how many values were spilled
+        """
+        count = self._len
+        if not self.size or count < self.size:
+            return 0
+
+        if self._file is None:
+            self._file = tempfile.TemporaryFile()
+
+        f = self._file
+        f.seek(0, os.SEEK_END)
+        offset = f.tell()
+        for k, x in self._items():
+            pickle.dump((k, x), f, pickle.HIGHEST_PROTOCOL)
+
+        self._runs.append((offset, count))
+        self._spilled += count
+        if self._last is None or self._keys[-1][-1] > self._last[0]:
+            self._last = (self._keys[-1][-1], self._values[-1][-1])
+        self._keys = []
+        self._values = []
+        self._maxes = []
+        self._len = 0
+        return count
+
+    def _items(self):
+        """the (key, value) tuples in memory in key order"""
+        for keys, values in zip(self._keys, self._values):
+            for k, x in zip(keys, values):
+                yield k, x
+
+    def _run(self, offset, count):
+        """the (key, value) tuples of the run at offset in the file, each read seeks
+        to where the last one ended since all the runs share the one file"""
+        f = self._file
+        for _ in range(count):
+            f.seek(offset)
+            kx = pickle.load(f)
+            offset = f.tell()
+            yield kx
+
+    def clear(self):
+        super(SpillList, self).clear()
+        if getattr(self, "_file", None) is not None:
+            self._file.close()
+        self._file = None
+        self._runs = []
+        self._spilled = 0
+        self._last = None
+
+    def __getitem__(self, index):
+        if not self._spilled:
+            return super(SpillList, self).__getitem__(index)
+
+        if isinstance(index, slice):
+            return list(self)[index]
+
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError("list index out of range")
+
+        if index == len(self) - 1:
+            # the last value (eg, for Email.subject) is either the last value in
+            # memory or the largest one that was spilled, so the runs aren't merged
+            if self._len and self._keys[-1][-1] > self._last[0]:
+                return self._values[-1][-1]
+            return self._last[1]
+
+        return next(itertools.islice(iter(self), index, None))
+
+    def __iter__(self):
+        if not self._spilled:
+            for x in super(SpillList, self).__iter__():
                 yield x
+            return
+
+        # every key is unique (see SortedList.append) so the values are never
+        # compared while merging
+        runs = [self._run(offset, count) for offset, count in self._runs]
+        runs.append(self._items())
+        for _, x in heapq.merge(*runs):
+            yield x
 
-    def __setitem__(self, x):
-        raise NotImplementedError()
-    def reverse(self):
-        raise NotImplementedError()
-    def sort(self):
-        raise NotImplementedError()
+    def __len__(self):
+        return self._len + self._spilled
+
+    def __bool__(self):
+        return len(self) > 0
+    __nonzero__ = __bool__ # 2
 
 
 class Email(BaseEmail):
+    render_workers = environ.RENDER_WORKERS
+    """how many processes render the items of the email, 0 to render them in this
+    process, see .render()"""
+
+    render_min = 500
+    """a section needs at least this many items before it is rendered in the
+    process pool, starting the pool costs more than rendering small sections"""
+
+    digest = None
+    """the DigestEmail this email is a section of, its render pool is used"""
+
+    spill_size = environ.SPILL_SIZE
+    """once a section has this many items in memory .compact() moves them to a
+    temporary file, 0 to keep everything in memory, see SpillList"""
+
+    sections = [
+        ("cheaper_items", True),
+        ("richer_items", False),
+        ("cheapest_items", False),
+        ("nostock_items", False),
+    ]
+    """the name of each list of items and if its items are rendered with their
+    detail (which needs the price counts), see .compact()"""
+
     @property
     def subject(self):
         fmt_args = {
@@ -138,9 +387,8 @@ class Email(BaseEmail):
         return " ".join(fmt_str).format(**fmt_args)
 
     @property
-    def body_html(self):
-        lines = ["<p>"]
-
+    def summary(self):
+        """the one line summary of all the changes"""
         fmt_args = {
             "cheaper_count": len(self.cheaper_items),
             "cheapest_count": len(self.cheapest_items),
@@ -161,46 +409,131 @@ class Email(BaseEmail):
             fmt_str.append("{item_count} total")
             fmt_args["item_count"] = item_count
 
-        lines.append(" ".join(fmt_str).format(**fmt_args))
-        lines.append("</p>")
+        return " ".join(fmt_str).format(**fmt_args)
 
-        if self.cheaper_items:
-            lines.append("<h2>Lower Priced</h2>")
-            #self.cheaper_items.sort(key=lambda i: i.newest.price)
-            for i in self.cheaper_items:
-                lines.append(i.html_detail())
+    @property
+    @stats.timed("phase", "render")
+    def body_html(self):
+        return "\n".join(self.iter_body_html())
 
-        return "\n".join(lines)
+    @property
+    @stats.timed("phase", "render")
+    def body_text(self):
+        return "\n".join(self.iter_body_text())
 
     @property
+    @stats.timed("phase", "render")
     def html(self):
         """the full html for like a website, not an email"""
-        try:
-            title = self.subject
-        except IndexError:
-            title = ""
+        return "\n".join(self.iter_html())
 
-        lines = [self.body_html]
-        if self.richer_items:
-            lines.append("<h2>Higher Priced</h2>")
-            #self.richer_items.sort(key=lambda i: i.newest.price)
-            for i in self.richer_items:
-                lines.append(i.html_summary())
+    @property
+    @stats.timed("phase", "render")
+    def page_html(self):
+        """the body_html plus all the sections that would make the email too long"""
+        return "\n".join(self.iter_page_html())
+
+    def iter_body_html(self):
+        """the iter_* methods yield the html a chunk at a time so big reports can be
+        written out without ever having all of it in memory, joining the chunks
+        with newlines gives the full html"""
+        yield "<p>"
+        yield self.summary
+        yield "</p>"
+
+        if self.cheaper_items:
+            yield "<h2>Lower Priced</h2>"
+            for fragment in self.render(self.cheaper_items, "html_detail"):
+                yield fragment
 
-        if self.cheapest_items:
-            lines.append("<h2>Cheapest</h2>")
-            for i in self.cheapest_items:
-                lines.append(i.html_summary())
+    def iter_body_text(self):
+        """the plain text version of body_html, this is rendered from the items
+        instead of parsing body_html"""
+        yield self.summary
 
-        if self.nostock_items:
-            lines.append("<h2>Out of Stock</h2>")
-            #self.nostock_items.sort(key=lambda i: i.last.price if i.last else 0)
-            for i in self.nostock_items:
-                lines.append(i.html_summary())
+        if self.cheaper_items:
+            yield ""
+            yield "Lower Priced"
+            for fragment in self.render(self.cheaper_items, "text_detail"):
+                yield ""
+                yield fragment
+
+    def iter_page_html(self):
+        for chunk in self.iter_body_html():
+            yield chunk
+
+        sections = [
+            ("Higher Priced", self.richer_items),
+            ("Cheapest", self.cheapest_items),
+            ("Out of Stock", self.nostock_items),
+        ]
+        for title, items in sections:
+            if items:
+                yield "<h2>{}</h2>".format(title)
+                for fragment in self.render(items, "html_summary"):
+                    yield fragment
+
+    def render(self, items, method):
+        """yield the rendered fragment of each item in order
+
+        big sections are rendered across .render_workers processes, the items are
+        turned into ItemSnapshot instances first (this does all the db lookups in
+        this process) and the snapshots are rendered in chunks by the pool, the
+        chunks come back in order so the output is the same as rendering serially.
+        Only a few chunks are handed to the pool at a time so a spilled section
+        (see .compact()) isn't read back into memory all at once
+
+        :param items: SortedList, the Item instances of a section
+        :param method: string, html_detail, text_detail or html_summary
+        """
+        if self.render_workers <= 0 or len(items) < self.render_min:
+            for i in items:
+                yield getattr(i, method)()
 
-        body = "\n".join(lines)
+        else:
+            detail = method != "html_summary"
+            snapshots = (i.snapshot(detail=detail) for i in items)
+            size = max(self.render_min // self.render_workers, 1)
+            chunks = iter(lambda: (method, list(itertools.islice(snapshots, size))), (method, []))
+
+            pool = self.render_pool()
+            while True:
+                window = list(itertools.islice(chunks, self.render_workers * 2))
+                if not window:
+                    break
+
+                for fragments in pool.imap(render_snapshots, window):
+                    for fragment in fragments:
+                        yield fragment
+
+    def render_pool(self):
+        """the process pool of .render(), it is started the first time a big section
+        is rendered and every render after that uses it until .close(), the email
+        is rendered a few times when it is sent (the html and text bodies and the
+        SUCCESS_PATH page) and starting a pool each time would cost more than the
+        rendering it saves"""
+        if self.digest is not None:
+            return self.digest.render_pool()
+
+        with self.pool_lock:
+            if self.pool is None:
+                self.pool = multiprocessing.Pool(self.render_workers)
+            return self.pool
+
+    def close(self):
+        """stop the render pool, this is called once the email has been sent"""
+        with self.pool_lock:
+            if self.pool is not None:
+                self.pool.terminate()
+                self.pool = None
+
+    def iter_html(self):
+        try:
+            title = self.subject
+        except IndexError:
+            title = ""
 
-        return "\n".join([
+        for chunk in [
             "<!DOCTYPE html>",
             "<html>",
             "<head>",
@@ -210,23 +543,49 @@ class Email(BaseEmail):
             "</head>",
             "<body>",
             "<h1>{}</h1>".format(title),
-            "<div>{}</div>".format(body),
-            "</body>",
-            "</html>",
-        ])
+        ]:
+            yield chunk
+
+        # the page is wrapped in a div, so the div goes on the first and last chunk
+        chunk = None
+        for page_chunk in self.iter_page_html():
+            if chunk is None:
+                chunk = "<div>" + page_chunk
+
+            else:
+                yield chunk
+                chunk = page_chunk
+        yield (chunk or "<div>") + "</div>"
+
+        yield "</body>"
+        yield "</html>"
 
     def __init__(self, name):
         self.name = name
         self.kwargs = {}
-        self.cheaper_items = SortedList(key=lambda i: i.newest.price)
-        self.richer_items = SortedList(key=lambda i: i.newest.price)
-        self.nostock_items = SortedList(key=lambda i: i.last.price if i.last else 0)
+        self.pool = None # see .render_pool()
+        self.pool_lock = threading.Lock()
+        self.cheaper_items = SpillList(key=lambda i: i.newest.price, size=self.spill_size)
+        self.richer_items = SpillList(key=lambda i: i.newest.price, size=self.spill_size)
+        self.nostock_items = SpillList(
+            key=lambda i: i.last.price if i.last else 0,
+            size=self.spill_size
+        )
         self.errors = []
 
         def sorting(i):
-            ci = i.cheapest
-            return ci._created if ci else datetime.datetime.utcnow()
-        self.cheapest_items = SortedList(key=sorting)
+            return i.cheapest_seen or datetime.datetime.utcnow()
+        self.cheapest_items = SpillList(key=sorting, size=self.spill_size)
+
+    def compact(self):
+        """swap the Item instances in the email for ItemSnapshot instances so their
+        rows and history can be freed, and spill the sections that have gotten
+        big to disk, this should only be called after the items have been saved
+        since saving an item changes how it renders"""
+        for name, detail in self.sections:
+            items = getattr(self, name)
+            items.replace(lambda i: i.snapshot(detail=detail))
+            items.spill()
 
     def __len__(self):
         return len(self.cheaper_items) + len(self.richer_items) + len(self.cheapest_items)
@@ -235,7 +594,13 @@ class Email(BaseEmail):
         return len(self) > 0
     __nonzero__ = __bool__ # 2
 
-    def send(self, **kwargs):
+    def outgoing(self, **kwargs):
+        """Return the emails that sending this email actually sends, the ErrorEmail
+        of the errors if there were any and this email if it has any items
+
+        :returns: list, email.Email instances
+        """
+        ret = []
         if self.errors:
             logger.warning("There were {} errors".format(len(self.errors)))
             try:
@@ -244,7 +609,7 @@ class Email(BaseEmail):
                 if environ.ERROR_PATH:
                     fp = Filepath(environ.ERROR_PATH)
                     fp.write(em.body_text)
-                em.send()
+                ret.append(em)
 
             except Exception as e:
                 logger.exception(e)
@@ -253,9 +618,181 @@ class Email(BaseEmail):
             self.kwargs.update(kwargs)
             if environ.SUCCESS_PATH:
                 fp = Filepath(environ.SUCCESS_PATH)
-                fp.write(self.html)
+                with stats.timer("phase", "render"):
+                    fp.writelines(self.iter_html())
             logger.warning("Sending successful email to {}".format(self.to_email))
-            return super(Email, self).send()
+            ret.append(self)
+
+        return ret
+
+    def send(self, **kwargs):
+        responses = send_emails([self], **kwargs)
+        return responses[-1] if self and responses else None
+
+
+def send_emails(emails, workers=0, **kwargs):
+    """send all the emails of a run at the same time, see email.Delivery
+
+    failing to send an ErrorEmail is only logged, if any of the other emails
+    failed then the first error is raised once all of them have been tried
+
+    :param emails: list, Email instances
+    :param workers: int, how many can be sent at the same time, 0 for the default
+    :returns: list, the responses of the emails that were sent
+    """
+    ret = []
+    error = None
+    try:
+        outgoing = []
+        for email in emails:
+            outgoing.extend(email.outgoing(**kwargs))
+
+        if outgoing:
+            for em, r in zip(outgoing, BaseEmail.get_interface().send(outgoing, workers)):
+                if isinstance(r, Exception):
+                    if isinstance(em, ErrorEmail):
+                        logger.error("Sending the error email failed: {}".format(r))
+
+                    elif error is None:
+                        error = r
+
+                else:
+                    ret.append(r)
+
+    finally:
+        for email in emails:
+            email.close()
+
+    if error is not None:
+        raise error
+    return ret
+
+
+class DigestEmail(Email):
+    """Combines the emails of multiple wishlists into one email that has a section
+    for each wishlist"""
+    @property
+    def subject(self):
+        fmt_args = {
+            "cheaper_count": sum(len(em.cheaper_items) for em in self.emails),
+            "item_count": sum(em.kwargs.get("item_count", 0) for em in self.emails),
+            "name": self.name,
+        }
+        return "{cheaper_count}/{item_count} down [wishlists {name}]".format(**fmt_args)
+
+    def iter_body_html(self):
+        for em in self.emails:
+            if em:
+                yield "<h1>{}</h1>".format(em.name)
+                for chunk in em.iter_body_html():
+                    yield chunk
+
+    def iter_body_text(self):
+        for em in self.emails:
+            if em:
+                yield em.name
+                for chunk in em.iter_body_text():
+                    yield chunk
+                yield ""
+
+    def iter_page_html(self):
+        for em in self.emails:
+            if em:
+                yield "<h1>{}</h1>".format(em.name)
+                for chunk in em.iter_page_html():
+                    yield chunk
+
+    @property
+    def errors(self):
+        return [error for em in self.emails for error in em.errors]
+
+    def __init__(self, emails):
+        """
+        :param emails: list, the Email instance of each wishlist
+        """
+        self.emails = emails
+        self.name = ", ".join(em.name for em in emails)
+        self.kwargs = {}
+        self.pool = None
+        self.pool_lock = threading.Lock()
+        for em in emails:
+            em.digest = self
+
+    def __len__(self):
+        return sum(len(em) for em in self.emails)
+
+
+class WatchlistOutbox(Orm):
+    """The emails that have been rendered but not sent yet
+
+    with --outbox a run saves its emails here instead of sending them, so the run
+    is done as soon as the wishlists are checked and saved, and --flush-outbox
+    sends them. An email that fails to send stays here and is tried again the
+    next time the outbox is flushed
+
+    an email's key is the hash of its request body and an email that is already
+    waiting here isn't added again, so checking the same wishlists again before
+    the outbox is flushed doesn't send the same email twice
+    """
+    table_name = "watchlist_outbox"
+    connection_name = "watchlist"
+
+    key = Field(str, True, max_size=32, unique=True)
+    subject = Field(str, True)
+    body = ObjectField(True) # the json body from email.Email.mail()
+    attempts = Field(int, True) # how many times sending it has failed
+    error = Field(str, False) # why it failed the last time
+
+    @classmethod
+    def queue(cls, emails, **kwargs):
+        """save everything that sending emails would send, see send_emails()
+
+        :param emails: list, Email instances
+        :returns: int, how many emails were added
+        """
+        ret = 0
+        for email in emails:
+            try:
+                for em in email.outgoing(**kwargs):
+                    body = em.mail()
+                    key = Fingerprints.hash([json.dumps(body, sort_keys=True)])
+                    if not cls.query.is_key(key).has():
+                        cls.create(key=key, subject=em.subject, body=body, attempts=0)
+                        ret += 1
+
+            finally:
+                email.close()
+        return ret
+
+    @classmethod
+    def flush(cls, batch_size=50, workers=0):
+        """send the waiting emails oldest first, batch_size of them at the same time,
+        the ones that are sent are removed
+
+        :returns: tuple, (how many were sent, how many failed)
+        """
+        sent = failed = 0
+        interface = BaseEmail.get_interface()
+        last_pk = 0
+        while True:
+            rows = list(cls.query.gt_pk(last_pk).asc_pk().limit(batch_size).get())
+            if not rows:
+                break
+
+            last_pk = rows[-1].pk
+            for row, r in zip(rows, interface.post_all([row.body for row in rows], workers)):
+                if isinstance(r, Exception):
+                    logger.warning("Sending {} failed: {}".format(row.subject, r))
+                    row.attempts += 1
+                    row.error = "{}".format(r)
+                    row.save()
+                    failed += 1
+
+                else:
+                    row.delete()
+                    sent += 1
+
+        return sent, failed
 
 
 class WatchlistItem(Orm):
@@ -271,8 +808,13 @@ class WatchlistItem(Orm):
     uuid = Field(str, True, max_size=32)
     price = Field(int, True)
     body = ObjectField(True)
+    body_hash = Field(str, False, max_size=32) # see WatchlistBody
 
+    # cheapest and richest, the price counts and existence checks
     uuid_index = Index("uuid", "price")
+    # last and the price points of an item's history in pk order, this covers
+    # the points queries so they never have to read the rows
+    history_index = Index("uuid", "_id", "price", "_created")
 
     def _modify(self, fields):
         if "body" in fields:
@@ -282,6 +824,28 @@ class WatchlistItem(Orm):
                 fields["body"].setdefault("uuid", fields["uuid"])
         return fields
 
+    def _populate(self, fields):
+        super(WatchlistItem, self)._populate(fields)
+        # the body column only has the fields that change, the rest of the body
+        # is added the first time .body is read
+        self._body_delta = bool(self.body_hash)
+
+    def depopulate(self, is_update):
+        fields = super(WatchlistItem, self).depopulate(is_update)
+        if "body" in fields:
+            body_hash, delta = WatchlistBody.dedupe(self.body)
+            fields["body"] = self.schema.fields["body"].encode(delta)
+            fields["body_hash"] = body_hash
+        return fields
+
+    @body.fgetter
+    def body(self, val):
+        if val is not None and getattr(self, "_body_delta", False):
+            self._body_delta = False
+            val = WatchlistBody.merge(self.body_hash, val)
+            self.body = val
+        return val
+
     @body.fsetter
     def body(self, val):
         if val is None: return None
@@ -298,12 +862,70 @@ class WatchlistItem(Orm):
         if isinstance(val, (int, long)): return val
         return int(val * 100.0)
 
-    @property
+    @classmethod
+    def compact(cls, days, batch_size=500):
+        """collapse the history that is more than days old into the cheapest and
+        richest row of each day
+
+        the rows the item's summary points to (its last, cheapest and richest rows)
+        are always kept so Item's lookups don't change, and the price counts and
+        total changes come from the summary, which isn't touched, so items that
+        don't have a summary are skipped (see --rebuild-summary)
+
+        :param batch_size: int, how many items are compacted in each transaction
+        :returns: tuple, (items compacted, rows deleted)
+        """
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=days)
+        items = deleted = 0
+        summary_pk = 0
+        while True:
+            query = WatchlistSummary.query.select_fields(
+                "_id",
+                "uuid",
+                "last_pk",
+                "cheapest_pk",
+                "richest_pk",
+            )
+            summaries = query.gt_pk(summary_pk).asc_pk().limit(batch_size).values()
+            if not summaries:
+                break
+
+            summary_pk = summaries[-1][0]
+            keep = set()
+            for _, _, last_pk, cheapest_pk, richest_pk in summaries:
+                keep.update([last_pk, cheapest_pk, richest_pk])
+
+            query = cls.query.select_fields("_id", "uuid", "price", "_created")
+            query.in_uuid([r[1] for r in summaries]).lt__created(cutoff)
+            rows = query.asc_uuid().asc_pk().values()
+
+            pks = []
+            for uuid, points in itertools.groupby(rows, lambda r: r[1]):
+                points = list(points)
+                for _, day_points in itertools.groupby(points, lambda r: r[3].date()):
+                    day_points = list(day_points)
+                    keep.add(min(day_points, key=lambda r: r[2])[0])
+                    keep.add(max(day_points, key=lambda r: r[2])[0])
+
+                ps = [r for r in points if r[0] not in keep]
+                if ps:
+                    items += 1
+                    pks.extend(r[0] for r in ps)
+
+            if pks:
+                with cls.interface.transaction():
+                    for i in range(0, len(pks), batch_size):
+                        cls.query.in_pk(pks[i:i + batch_size]).delete()
+                deleted += len(pks)
+
+        return items, deleted
+
+    @cachedproperty
     def price_count(self):
         """how many times this price has been seen"""
         return self.query.is_uuid(self.uuid).is_price(self.price).count()
 
-    @property
+    @cachedproperty
     def count(self):
         """how many total price changes there have been"""
         return self.query.is_uuid(self.uuid).count()
@@ -311,7 +933,12 @@ class WatchlistItem(Orm):
     @property
     def pricetag(self):
         """it's price formatted in dollars and cents (so price=100 would be pricetag $1.00)"""
-        price = self.body.get("price", 0.0)
+        if getattr(self, "_body_delta", False):
+            # the price is in the delta so the rest of the body isn't needed
+            body = self.schema.fields["body"].fval(self)
+        else:
+            body = self.body
+        price = body.get("price", 0.0)
         pricetag = "${:.2f}".format(price)
         return pricetag
 
@@ -340,6 +967,267 @@ class WatchlistItem(Orm):
         return self.price >= other.price
 
 
+class WatchlistBody(Orm):
+    """The distinct bodies of the items
+
+    a wishlist item's body hardly ever changes except for its price, so instead of
+    saving the whole body on every price change the body minus the .delta_fields
+    is saved here once under its hash and each watchlist_item row only has the
+    hash and the .delta_fields, WatchlistItem.body puts them back together so this
+    is invisible to everything that reads a body
+
+    rows from before this table existed have their whole body and no hash, they
+    are read as they always have been
+    """
+    table_name = "watchlist_body"
+    connection_name = "watchlist"
+
+    hash = Field(str, True, max_size=32, unique=True)
+    body = ObjectField(True)
+
+    delta_fields = ("price",)
+    """the body fields that are saved with each watchlist_item row"""
+
+    cache_size = 10000
+    """how many bodies .cache can have before it is cleared"""
+
+    cache = {}
+    """hash -> body, only bodies that were read from the db are cached so a body
+    whose insert was rolled back is never trusted to be there"""
+
+    hashes = set()
+    """the hashes of rows that were read from the db, their bodies are known to be
+    saved, see .seen()"""
+
+    @classmethod
+    def split(cls, body):
+        """split body into the part that is shared by every row and the part that
+        is saved with each row
+
+        :returns: tuple, (hash, shared body, delta)
+        """
+        shared = dict((k, v) for k, v in body.items() if k not in cls.delta_fields)
+        delta = dict((k, body[k]) for k in cls.delta_fields if k in body)
+        body_hash = Fingerprints.hash([json.dumps(shared, sort_keys=True)])
+        return body_hash, shared, delta
+
+    @classmethod
+    def dedupe(cls, body):
+        """make sure the shared part of body is saved
+
+        :returns: tuple, (hash, delta)
+        """
+        body_hash, shared, delta = cls.split(body)
+        if body_hash not in cls.cache and body_hash not in cls.hashes:
+            if not cls.query.is_hash(body_hash).has():
+                cls.create(hash=body_hash, body=shared)
+        return body_hash, delta
+
+    @classmethod
+    def seen(cls, hashes):
+        """remember hashes that came from rows read from the db, so saving a row
+        with the same body doesn't need to check the body is there"""
+        hashes = set(h for h in hashes if h)
+        if len(cls.hashes) + len(hashes) > cls.cache_size:
+            cls.hashes.clear()
+        cls.hashes.update(hashes)
+
+    @classmethod
+    def preload(cls, hashes):
+        """load the bodies of all the hashes that aren't cached in one query"""
+        hashes = set(h for h in hashes if h and h not in cls.cache)
+        if hashes:
+            if len(cls.cache) + len(hashes) > cls.cache_size:
+                cls.cache.clear()
+
+            decode = cls.schema.fields["body"].decode
+            query = cls.query.select_fields("hash", "body").in_hash(list(hashes))
+            for body_hash, body in query.values():
+                cls.cache[body_hash] = decode(body)
+
+    @classmethod
+    def merge(cls, body_hash, delta):
+        """return the whole body of a row with body_hash and delta"""
+        cls.preload([body_hash])
+        ret = dict(cls.cache.get(body_hash, {}))
+        ret.update(delta)
+        return ret
+
+
+class WatchlistSummary(Orm):
+    """The summary of one item's (uuid) whole price history
+
+    this is kept up to date by Item.save() so the cheapest, richest, price count
+    and change count lookups don't need to go through all the item's rows in
+    watchlist_item, databases from before this table existed can fill it in with
+    `watchlist --rebuild-summary`
+
+    the rows are read and updated through Summary instances, see Summary
+    """
+    table_name = "watchlist_summary"
+    connection_name = "watchlist"
+
+    uuid = Field(str, True, max_size=32, unique=True)
+    last_pk = Field(int, True)
+    last_price = Field(int, True)
+    cheapest_pk = Field(int, False)
+    cheapest_price = Field(int, False)
+    cheapest_seen = Field(datetime.datetime, False) # the last time it was at cheapest_price
+    richest_pk = Field(int, False)
+    richest_price = Field(int, False)
+    change_count = Field(int, True)
+    prices = ObjectField(True) # price -> how many times it was seen at that price
+
+    @classmethod
+    def points(cls, uuid):
+        """the (pk, price, created) points of uuid's whole history in pk order"""
+        query = WatchlistItem.query.select_fields("_id", "price", "_created")
+        return query.is_uuid(uuid).asc_pk().values()
+
+    @classmethod
+    def record(cls, witem):
+        """add the just saved witem to its item's summary, creating the summary from
+        the item's history if it doesn't have one yet
+
+        :returns: Summary
+        """
+        s = Summary.load([witem.uuid]).get(witem.uuid)
+        if s is None:
+            s = Summary.build(witem.uuid, cls.points(witem.uuid))
+
+        else:
+            s.add(witem.pk, witem.price, witem._created)
+        s.save()
+        return s
+
+    @classmethod
+    def rebuild(cls):
+        """throw away all the summaries and build them again from watchlist_item,
+        the rows removed by WatchlistItem.compact() can't be counted again so this
+        will undercount the price counts and changes of compacted items
+
+        :returns: int, how many summaries were saved
+        """
+        ret = 0
+        query = WatchlistItem.query.select_fields("_id", "uuid", "price", "_created")
+        rows = query.asc_uuid().asc_pk().all().values()
+        with cls.interface.transaction():
+            cls.query.gt_pk(0).delete()
+            for uuid, points in itertools.groupby(rows, lambda r: r[1]):
+                Summary.build(uuid, ((pk, price, created) for pk, _, price, created in points)).save()
+                ret += 1
+        return ret
+
+
+class Summary(object):
+    """The in memory version of a WatchlistSummary row
+
+    creating Orm instances is slow and most of the summaries loaded during a run
+    are only ever read, so they are loaded into these and only turned into a
+    WatchlistSummary when they need to be saved
+    """
+    field_names = [
+        "_id",
+        "uuid",
+        "last_pk",
+        "last_price",
+        "cheapest_pk",
+        "cheapest_price",
+        "cheapest_seen",
+        "richest_pk",
+        "richest_price",
+        "change_count",
+        "prices",
+    ]
+
+    def __init__(self, uuid, **fields):
+        self._id = None
+        self.uuid = uuid
+        self.last_pk = 0
+        self.last_price = 0
+        self.cheapest_pk = None
+        self.cheapest_price = None
+        self.cheapest_seen = None
+        self.richest_pk = None
+        self.richest_price = None
+        self.change_count = 0
+        self.prices = {}
+        for k, v in fields.items():
+            setattr(self, k, v)
+
+    @classmethod
+    def load(cls, uuids):
+        """load the saved summaries of uuids
+
+        :param uuids: list, the uuids, uuids that don't have a summary won't be in
+            the returned dict
+        :returns: dict, uuid keys with Summary values
+        """
+        ret = {}
+        if uuids:
+            prices = WatchlistSummary.schema.prices
+            query = WatchlistSummary.query.select_fields(*cls.field_names)
+            for values in query.in_uuid(uuids).values():
+                fields = dict(zip(cls.field_names, values))
+                fields["prices"] = prices.decode(fields["prices"])
+                ret[fields["uuid"]] = cls(**fields)
+        return ret
+
+    @classmethod
+    def build(cls, uuid, points=None):
+        """create a summary from the history of an item
+
+        :param uuid: string, the item's uuid
+        :param points: iterable, (pk, price, created) tuples in pk order
+        :returns: Summary, it isn't saved
+        """
+        s = cls(uuid)
+        for pk, price, created in (points or []):
+            s.add(pk, price, created)
+        return s
+
+    def add(self, pk, price, created):
+        """add a price point to the summary, the points have to be added in pk order"""
+        self.last_pk = pk
+        self.last_price = price
+        self.change_count += 1
+        self.prices[price] = self.prices.get(price, 0) + 1
+
+        if price > 0:
+            # this matches the db queries, cheapest ties go to the oldest point
+            # and richest ties go to the newest point
+            if self.cheapest_price is None or price < self.cheapest_price:
+                self.cheapest_pk = pk
+                self.cheapest_price = price
+                self.cheapest_seen = created
+
+            elif price == self.cheapest_price:
+                self.cheapest_seen = created
+
+            if self.richest_price is None or price >= self.richest_price:
+                self.richest_pk = pk
+                self.richest_price = price
+
+    def price_count(self, price):
+        return self.prices.get(price, 0)
+
+    def save(self):
+        """insert or update this summary's WatchlistSummary row"""
+        fields = dict((k, getattr(self, k)) for k in self.field_names[1:])
+        fields["prices"] = WatchlistSummary.schema.prices.encode(self.prices)
+        fields["_updated"] = datetime.datetime.utcnow()
+
+        # this goes through the query instead of a WatchlistSummary instance
+        # because populating the Orm is most of the cost of a save
+        if self._id:
+            WatchlistSummary.query.is_pk(self._id).set_fields(fields).update()
+
+        else:
+            fields["_created"] = fields["_updated"]
+            self._id = WatchlistSummary.query.set_fields(fields).insert()
+        return self._id
+
+
 class Item(object):
     """Represents the item as a whole, its entire price history, this is the public
     interface that takes the information from a wishlist item and converts it into
@@ -363,42 +1251,66 @@ class Item(object):
     def color(self):
         """return a different color depending on if the item is cheapest, richest,
         or somewhere in the middle"""
-        color = "black"
-        if self.is_cheapest():
-            color = "green"
-
-        elif self.is_richest():
-            color = "red"
-        return color
+        return self.verdict.color
 
     @property
     def uuid(self):
         return self.newest.uuid
 
-    @property
+    @cachedproperty
+    @stats.timed("query")
     def cheapest(self):
         """Return the cheapest record of this item in the db"""
+        if self.history is not None:
+            return self.history.cheapest()
+
         ret = WatchlistItem.query.is_uuid(self.uuid).gt_price(0).asc_price().get_one()
-        self.__dict__["cheapest"] = ret
         return ret
 
-    @property
+    @cachedproperty
+    @stats.timed("query")
+    def cheapest_seen(self):
+        """Return when the item was last at its cheapest price, the cheapest row is
+        the first time it was at that price"""
+        if self.summary is not None and self.summary.cheapest_seen:
+            return self.summary.cheapest_seen
+
+        citem = self.cheapest
+        if not citem:
+            return None
+
+        # summaries from before cheapest_seen was added don't have it
+        ret = WatchlistItem.query.is_uuid(self.uuid).is_price(citem.price).desc_pk().get_one()
+        return ret._created
+
+    @cachedproperty
+    @stats.timed("query")
     def richest(self):
         """Return the richest record of this item in the db"""
+        if self.history is not None:
+            return self.history.richest()
+
         ret = WatchlistItem.query.is_uuid(self.uuid).gt_price(0).desc_price().get_one()
-        self.__dict__["richest"] = ret
         return ret
 
-    @property
+    @cachedproperty
+    @stats.timed("query")
     def last(self):
         """Return the most recent record of this item in the db"""
+        if self.history is not None:
+            return self.history.last(self.newest.pk)
+
         if self.newest.pk:
             ret = WatchlistItem.query.is_uuid(self.uuid).lt_pk(self.newest.pk).desc_pk().first()
         else:
             ret = WatchlistItem.query.is_uuid(self.uuid).last()
-        self.__dict__["last"] = ret
         return ret
 
+    @cachedproperty
+    def verdict(self):
+        """Return the Verdict of how this item compares to its history"""
+        return Verdict(self)
+
     def __init__(self, uuid, body, price, element=None, **kwargs):
         """
         :param uuid: string, the amazon uuid of the item
@@ -419,20 +1331,32 @@ class Item(object):
         #self.element = element
         self.page = element.page if element else 0
 
+        # set by .preload(), if this is None then all the lookups go to the db
+        self.history = None
+
+        # set by pages.Pages in incremental mode, see Fingerprints
+        self.fingerprint = ""
+
+        # detail -> ItemSnapshot, see .snapshot()
+        self.snapshots = {}
+
+    @classmethod
+    def preload(cls, items):
+        """Load the price history of all the items in a few queries
+
+        :param items: list, Item instances, usually a page's worth
+        """
+        histories = History.load(it.uuid for it in items)
+        for it in items:
+            it.history = histories[it.uuid]
+            it.reset()
 
     def is_richer(self):
         """Return true if the new item is more expensive than the old item"""
-        if not self.is_stocked(): return False
-        last = self.last
-        return last is not None and last.price < self.newest.price
+        return self.verdict.direction > 0
 
     def is_cheaper(self):
-        if not self.is_stocked(): return False
-        ret = False
-        last = self.last
-        if last:
-            ret = self.newest.price < last.price
-        return ret
+        return self.verdict.direction < 0
 
     def is_stocked(self):
         """Return True if the item is in stock"""
@@ -444,46 +1368,305 @@ class Item(object):
 
     def is_cheapest(self):
         """Return True if the item is the cheapest it's ever been"""
-        ret = False
-        if not self.is_richer() and self.is_stocked():
-            if self.cheapest:
-                ret = self.newest.price <= self.cheapest.price
-            else:
-                ret = True # no other one exists in db
-        return ret
+        return self.verdict.cheapest
 
     def is_richest(self):
         """Return True if the item is the richest it's ever been"""
-        ret = False
-        if self.is_stocked():
-            if self.richest:
-                ret = self.newest.price >= self.richest.price
-            else:
-                ret = True # no other one exists in db
-        return ret
+        return self.verdict.richest
 
+    @stats.timed("query")
     def is_newest(self):
         """Return if there are no other items like this one in the db"""
+        if self.history is not None:
+            return not self.history
+
         return not WatchlistItem.query.is_uuid(self.uuid).has()
 
+    @stats.timed("query")
     def save(self):
-        return self.newest.save()
+        with WatchlistItem.interface.transaction():
+            ret = self.newest.save()
+            if self.history is not None:
+                self.history.append(self.newest)
+                self.history.summary.save()
+
+            else:
+                WatchlistSummary.record(self.newest)
+
+        self.reset()
+        return ret
+
+    def savepoint(self):
+        """the in memory state that .save() changes, pass it to .rollback() if the
+        transaction the item was saved in fails"""
+        fields = {}
+        for k in self.newest.schema.fields:
+            v = getattr(self.newest, k)
+            if v is not None and k != self.newest.schema.pk.name:
+                fields[k] = v
+        history = None
+        if self.history is not None:
+            h = self.history
+            s = dict((k, getattr(h.summary, k)) for k in Summary.field_names)
+            s["prices"] = dict(s["prices"])
+            history = (list(h.points), dict(h.rows), s)
+        return fields, history
+
+    def rollback(self, savepoint):
+        """put the item back the way it was before it was saved, the rows of a failed
+        transaction aren't in the db so the item can't keep their pks"""
+        fields, history = savepoint
+        self.newest = WatchlistItem(**fields)
+        if history is not None:
+            points, rows, s = history
+            self.history.points = list(points)
+            self.history.rows = dict(rows)
+            for k, v in s.items():
+                setattr(self.history.summary, k, v)
+            self.history.summary.prices = dict(s["prices"])
+        self.reset()
+
+    def reset(self):
+        """clear all the cached lookups of this item, this needs to be called anytime
+        a new row for this item is added to the db"""
+        for k in ["last", "cheapest", "richest"]:
+            witem = self.__dict__.get(k, None)
+            if witem:
+                cachedproperty.reset(witem)
+        cachedproperty.reset(self.newest)
+        cachedproperty.reset(self)
+        self.snapshots = {}
+
+    @cachedproperty
+    @stats.timed("query")
+    def summary(self):
+        """Return the Summary of this item's history, None if it doesn't have one"""
+        if self.history is not None:
+            return self.history.summary
+        return Summary.load([self.uuid]).get(self.uuid)
+
+    @stats.timed("query")
+    def price_count(self, witem):
+        """how many times witem's price has been seen for this item, this comes
+        from the summary since WatchlistItem.compact() deletes rows"""
+        if self.summary is not None:
+            return self.summary.price_count(witem.price)
+        return witem.price_count
+
+    @stats.timed("query")
+    def count(self):
+        """how many total price changes there have been for this item"""
+        if self.summary is not None:
+            return self.summary.change_count
+        return self.newest.count
+
+    def snapshot(self, detail=True):
+        """Return the ItemSnapshot of everything rendering this item needs, this is
+        cached until .reset() so an item on more than one wishlist has the same
+        snapshot in each wishlist's Email
+
+        :param detail: boolean, html_summary() doesn't need the price counts, so
+            they are only looked up if this is True
+        """
+        # the detailed snapshot has everything the other one has
+        ret = self.snapshots.get(detail) or self.snapshots.get(True)
+        if ret is None:
+            ret = ItemSnapshot(self, detail=detail)
+            self.snapshots[detail] = ret
+        return ret
 
     def html_detail(self):
-        item = self
-        new_item = self.newest
-        old_item = self.last
-        citem = self.cheapest
-        ritem = self.richest
+        return self.snapshot().html_detail()
+
+    def text_detail(self):
+        """the plain text version of html_detail()"""
+        return self.snapshot().text_detail()
+
+    def html_summary(self):
+        return self.snapshot(detail=False).html_summary()
+
+
+class Verdict(object):
+    """How an Item compares to its history, this is worked out once from the item's
+    last, cheapest and richest rows and then everything that classifies or renders
+    the item reads it, see Item.verdict
+
+    the prices are in cents like WatchlistItem.price and are None if the item
+    doesn't have that row
+    """
+    __slots__ = (
+        "newest",
+        "stocked",
+        "direction",
+        "cheapest",
+        "richest",
+        "category",
+        "color",
+        "price",
+        "last_price",
+        "cheapest_price",
+        "richest_price",
+    )
+
+    def __init__(self, item):
+        self.price = item.newest.price
+        self.stocked = bool(item.is_stocked())
+        self.last_price = self.cheapest_price = self.richest_price = None
+        self.direction = 0
+        self.cheapest = self.richest = False
+
+        if item.history is None and not item.newest.pk:
+            # the last row is any row of the item, so this saves the
+            # is_newest() query
+            last = item.last
+            self.newest = last is None
+
+        else:
+            self.newest = item.is_newest()
+            last = None if self.newest else item.last
+
+        if last is not None:
+            self.last_price = last.price
+            if self.stocked and last.price != self.price:
+                self.direction = 1 if last.price < self.price else -1
+
+        if self.stocked:
+            # an item without any rows can't have a cheapest or richest row
+            citem = None if self.newest else item.cheapest
+            ritem = None if self.newest else item.richest
+            if citem:
+                self.cheapest_price = citem.price
+            if ritem:
+                self.richest_price = ritem.price
+
+            if self.direction <= 0:
+                self.cheapest = citem is None or self.price <= citem.price
+            self.richest = ritem is None or self.price >= ritem.price
+
+        self.category = None
+        if not self.newest:
+            if self.direction > 0:
+                self.category = "richer_items"
+
+            elif self.direction < 0:
+                self.category = "cheaper_items"
+
+            elif self.cheapest:
+                self.category = "cheapest_items"
+
+            elif not self.stocked:
+                self.category = "nostock_items"
+
+        self.color = "black"
+        if self.cheapest:
+            self.color = "green"
 
-        url = new_item.body["url"]
+        elif self.richest:
+            self.color = "red"
+
+    def changed(self):
+        """True if the item is new or its price changed, so it needs to be saved"""
+        return self.newest or self.direction != 0
+
+
+class ItemSnapshot(object):
+    """The values of an Item that classifying and rendering it need
+
+    Email keeps every changed item of the wishlist until it is sent, and an Item
+    holds its newest row, its last, cheapest and richest rows (each with the whole
+    body) and its history, so the Email swaps each Item for one of these once the
+    item has been saved, see Email.compact(). These are all plain values (prices
+    are in cents like WatchlistItem.price) so a snapshot can also be pickled and
+    rendered in another process, see Email.render()
+
+    the rows themselves aren't kept, use .rows() if you need them
+    """
+    __slots__ = (
+        "uuid",
+        "page",
+        "title",
+        "color",
+        "url",
+        "image",
+        "page_url",
+        "added",
+        "comment",
+        "current_price",
+        "current_pricetag",
+        "last_price",
+        "last_pricetag",
+        "cheapest_price",
+        "cheapest_pricetag",
+        "cheapest_seen",
+        "richest_price",
+        "richest_pricetag",
+        "cheapest_count",
+        "richest_count",
+        "count",
+    )
+
+    def __init__(self, item, detail=True):
+        new_item = item.newest
+        old_item = item.last
+        citem = item.cheapest
+        ritem = item.richest
+
+        body = new_item.body
+        self.uuid = item.uuid
+        self.page = item.page
+        self.title = item.title
+        self.color = item.color
+        self.url = body["url"]
+        self.image = body.get("image", "")
+        self.page_url = body.get("page_url", "")
+        self.added = body.get("added", "unknown")
+        self.comment = body.get("comment", "")
+
+        self.current_price = new_item.price
+        self.current_pricetag = new_item.pricetag
+
+        # the pricetags are None if the item doesn't have that row
+        self.last_price = old_item.price if old_item else None
+        self.last_pricetag = old_item.pricetag if old_item else None
+        self.cheapest_price = citem.price if citem else None
+        self.cheapest_pricetag = citem.pricetag if citem else None
+        self.cheapest_seen = item.cheapest_seen if citem else None
+        self.richest_price = ritem.price if ritem else None
+        self.richest_pricetag = ritem.pricetag if ritem else None
+
+        self.cheapest_count = self.richest_count = self.count = 0
+        if detail and citem and ritem:
+            self.cheapest_count = item.price_count(citem)
+            self.richest_count = item.price_count(ritem)
+            self.count = item.count()
+
+    def __getstate__(self):
+        return dict((k, getattr(self, k)) for k in self.__slots__)
+
+    def __setstate__(self, state):
+        for k, v in state.items():
+            setattr(self, k, v)
+
+    def snapshot(self, detail=True):
+        return self
+
+    def has_range(self):
+        """True if the item has a cheapest and a richest price"""
+        return self.cheapest_pricetag is not None and self.richest_pricetag is not None
+
+    def rows(self):
+        """load all the item's rows from the db, newest first"""
+        return WatchlistItem.query.is_uuid(self.uuid).desc_pk().all()
+
+    def html_detail(self):
+        url = self.url
 
         lines = [
             "<table>",
             "<tr>",
         ]
 
-        image_url = new_item.body.get("image", "")
+        image_url = self.image
         if image_url:
             lines.extend([
                 "  <td>",
@@ -498,46 +1681,42 @@ class Item(object):
             "  <td>"
         )
 
-        title = self.title
-        color = self.color
         lines.append("    <h3><a style=\"color:{}\" href=\"{}\">{}</a></h3>".format(
-            color,
+            self.color,
             url,
-            title
+            self.title
         ))
 
         lines.append("    <p>")
-        lines.append("        <b>{}</b>".format(new_item.pricetag))
-        if old_item:
+        lines.append("        <b>{}</b>".format(self.current_pricetag))
+        if self.last_pricetag is not None:
             lines.append("        was <b>{}</b></p>".format(
-                old_item.pricetag,
+                self.last_pricetag,
             ))
         lines.append("    </p>")
 
-        if citem and ritem:
+        if self.has_range():
             format_str = "    <p>range: <b>{}</b> ({}x, last on {}) to <b>{}</b> ({}x), {}x total changes</p>"
             lines.append(format_str.format(
-                citem.pricetag,
-                citem.price_count,
-                citem._created.strftime("%B %d, %Y"),
-                ritem.pricetag,
-                ritem.price_count,
-                ritem.count,
+                self.cheapest_pricetag,
+                self.cheapest_count,
+                self.cheapest_seen.strftime("%B %d, %Y"),
+                self.richest_pricetag,
+                self.richest_count,
+                self.count,
             ))
 
         lines.append("    <p>")
-        page_url = new_item.body.get("page_url", "")
-        added = new_item.body.get("added", "unknown")
-        if page_url:
-            lines.append("        <a href=\"{}\">added {}, p{}</a>".format(page_url, added, self.page))
+        if self.page_url:
+            lines.append("        <a href=\"{}\">added {}, p{}</a>".format(self.page_url, self.added, self.page))
 
         else:
-            lines.append("        added {}".format(added))
+            lines.append("        added {}".format(self.added))
 
         lines.append("    </p>")
 
         lines.extend([
-            "    <p>{}</p>".format(new_item.body.get("comment", "")),
+            "    <p>{}</p>".format(self.comment),
             "  </td>",
             "</tr>",
             "</table>",
@@ -547,53 +1726,648 @@ class Item(object):
 
         return "\n".join(lines)
 
+    def text_detail(self):
+        lines = [self.title]
+
+        if self.last_pricetag is not None:
+            lines.append("{} was {}".format(self.current_pricetag, self.last_pricetag))
+        else:
+            lines.append(self.current_pricetag)
+
+        if self.has_range():
+            format_str = "range: {} ({}x, last on {}) to {} ({}x), {}x total changes"
+            lines.append(format_str.format(
+                self.cheapest_pricetag,
+                self.cheapest_count,
+                self.cheapest_seen.strftime("%B %d, %Y"),
+                self.richest_pricetag,
+                self.richest_count,
+                self.count,
+            ))
+
+        lines.append("added {}, p{}".format(self.added, self.page))
+
+        if self.comment:
+            lines.append(self.comment)
+
+        lines.append(self.url)
+        return "\n".join(lines)
+
     def html_summary(self):
         lines = ["<p>"]
 
-        item = self
-        new_item = self.newest
-        old_item = self.last
-        citem = self.cheapest
-        ritem = self.richest
-
-        url = new_item.body["url"]
+        url = self.url
+        price = self.current_price
+        pricetag = self.current_pricetag
 
-        title = self.title
-        color = self.color
         lines.append("    <a style=\"color:{}\" href=\"{}\">{}</a>".format(
-            color,
+            self.color,
             url,
-            title
+            self.title
         ))
 
-        if citem and ritem:
-            if citem < new_item < ritem:
-                lines.append("    {} < <b>{}</b> < {}".format(citem.pricetag, new_item.pricetag, ritem.pricetag))
-            elif citem == new_item:
-                lines.append("    <b>{}</b> < {}".format(new_item.pricetag, ritem.pricetag))
+        if self.has_range():
+            cprice, cpricetag = self.cheapest_price, self.cheapest_pricetag
+            rprice, rpricetag = self.richest_price, self.richest_pricetag
+            if cprice < price < rprice:
+                lines.append("    {} < <b>{}</b> < {}".format(cpricetag, pricetag, rpricetag))
+            elif cprice == price:
+                lines.append("    <b>{}</b> < {}".format(pricetag, rpricetag))
             else:
-                lines.append("    {} < <b>{}</b>".format(citem.pricetag, new_item.pricetag))
+                lines.append("    {} < <b>{}</b>".format(cpricetag, pricetag))
 
         else:
-            if old_item:
-                if old_item < new_item:
-                    lines.append("    {} < <b>{}</b>".format(old_item.pricetag, new_item.pricetag))
-                elif old_item > new_item:
-                    lines.append("    <b>{}</b> < {}".format(new_item.pricetag, old_item.pricetag))
+            if self.last_pricetag is not None:
+                lprice, lpricetag = self.last_price, self.last_pricetag
+                if lprice < price:
+                    lines.append("    {} < <b>{}</b>".format(lpricetag, pricetag))
+                elif lprice > price:
+                    lines.append("    <b>{}</b> < {}".format(pricetag, lpricetag))
                 else:
-                    lines.append("    <b>{}</b>".format(new_item.pricetag))
+                    lines.append("    <b>{}</b>".format(pricetag))
             else:
-                lines.append("    <b>{}</b>".format(new_item.pricetag))
+                lines.append("    <b>{}</b>".format(pricetag))
 
-        page_url = new_item.body.get("page_url", "")
-        added = new_item.body.get("added", "unknown")
-        if page_url:
-            lines.append("    (<a href=\"{}\">{}</a>)".format(page_url, added))
+        if self.page_url:
+            lines.append("    (<a href=\"{}\">{}</a>)".format(self.page_url, self.added))
 
         else:
-            lines.append("    (added {})".format(added))
+            lines.append("    (added {})".format(self.added))
 
         lines.append("</p>")
         return "\n".join(lines)
 
 
+def render_snapshots(args):
+    """render a chunk of snapshots, this is what Email.render() runs in its process
+    pool so it has to be a module function
+
+    :param args: tuple, (method name, list of ItemSnapshot instances)
+    :returns: list, the rendered fragments in the same order as the snapshots
+    """
+    method, snapshots = args
+    return [getattr(s, method)() for s in snapshots]
+
+
+class WatchlistFingerprint(Orm):
+    """The fingerprints of a wishlist's items and pages from the last run, see
+    Fingerprints"""
+    table_name = "watchlist_fingerprint"
+    connection_name = "watchlist"
+
+    name = Field(str, True, max_size=100) # the wishlist name
+    key = Field(str, True, max_size=32) # the item's uuid or the page key
+    fingerprint = Field(str, True, max_size=32)
+
+    name_index = Index("name", "key", unique=True)
+
+
+class Fingerprints(object):
+    """Remembers what a wishlist's items and pages looked like the last time they
+    were checked so an incremental run can skip the ones that haven't changed
+
+    an item's fingerprint is a hash of everything that would change how it is
+    checked or rendered (price, stock, digital, and the body fields in
+    body_fields) and a page's fingerprint is a hash of its items' fingerprints
+
+    skipping items means they aren't in the email, so an unchanged item that is
+    still at its cheapest or still out of stock isn't listed again, and any drift
+    (eg, rows changed by hand) wouldn't be noticed, so every sweep_days there is
+    a full sweep that checks every item again
+    """
+    body_fields = ["title", "url", "image", "comment", "added", "page_url", "digital"]
+    """the body fields that are part of an item's fingerprint"""
+
+    sweep_key = "sweep"
+    """the key of the row whose _updated is when the last full sweep happened"""
+
+    def __init__(self, name, full=False):
+        """
+        :param name: string, the wishlist name
+        :param full: boolean, True if this is a full sweep, nothing is skipped but
+            the fingerprints are still saved
+        """
+        self.name = name
+        self.full = full
+        self.saved = {} # key -> (pk, fingerprint) of the rows in the db
+        self.pending = {} # key -> fingerprint that need to be saved
+
+    @classmethod
+    def load(cls, name, sweep_days=0):
+        """load all the fingerprints of wishlist name
+
+        :param sweep_days: int, if the last full sweep was more than this many days
+            ago then this will be a full sweep, 0 to never do a full sweep
+        """
+        fps = cls(name)
+        swept = None
+        query = WatchlistFingerprint.query.select_fields("_id", "key", "fingerprint", "_updated")
+        for pk, key, fingerprint, updated in query.is_name(name).values():
+            fps.saved[key] = (pk, fingerprint)
+            if key == cls.sweep_key:
+                swept = updated
+
+        if sweep_days:
+            if not swept or swept < datetime.datetime.utcnow() - datetime.timedelta(days=sweep_days):
+                fps.full = True
+        return fps
+
+    @classmethod
+    def hash(cls, lines):
+        return hashlib.md5("\n".join(lines).encode("utf-8")).hexdigest()
+
+    @classmethod
+    def item_fingerprint(cls, price, body):
+        """
+        :param price: number, the price from the wishlist
+        :param body: dict, the wishlist element jsonable
+        :returns: string
+        """
+        fields = dict((k, body.get(k, None)) for k in cls.body_fields)
+        fields["price"] = price
+        return cls.hash([json.dumps(fields, sort_keys=True)])
+
+    @classmethod
+    def page_fingerprint(cls, fingerprints):
+        """
+        :param fingerprints: list, the (uuid, fingerprint) tuples of the page's items
+            in order
+        :returns: string
+        """
+        return cls.hash("{}:{}".format(uuid, fp) for uuid, fp in fingerprints)
+
+    def page_key(self, number):
+        return "p{}".format(number)
+
+    def get(self, key):
+        if key in self.pending:
+            return self.pending[key]
+        return self.saved.get(key, (None, None))[1]
+
+    def matches(self, key, fingerprint):
+        """return True if key can be skipped because it hasn't changed"""
+        return bool(fingerprint) and not self.full and self.get(key) == fingerprint
+
+    def set(self, key, fingerprint):
+        if fingerprint and self.get(key) != fingerprint:
+            self.pending[key] = fingerprint
+
+    def item_checked(self, item):
+        """call this once item has been checked without any errors"""
+        self.set(item.uuid, item.fingerprint)
+
+    def page_checked(self, page):
+        """call this once every item of page has been checked, the page's fingerprint
+        is only set if all its items were checked without any errors"""
+        if page.fingerprint and all(self.get(uuid) == fp for uuid, fp in page.fingerprints):
+            self.set(self.page_key(page.number), page.fingerprint)
+
+    def unsaved(self, items):
+        """call this with the items that couldn't be saved, their pending fingerprints
+        and the pending fingerprints of their pages are dropped so they are checked
+        again next time"""
+        for item in items:
+            self.pending.pop(item.uuid, None)
+            self.pending.pop(self.page_key(item.page), None)
+
+    def save(self):
+        """save the pending fingerprints, this should only be called after the items
+        they belong to have been saved
+
+        :returns: int, how many fingerprints were saved
+        """
+        pending = self.pending
+        self.pending = {}
+        if pending:
+            now = datetime.datetime.utcnow()
+            with WatchlistFingerprint.interface.transaction():
+                for key, fingerprint in pending.items():
+                    fields = {"fingerprint": fingerprint, "_updated": now}
+                    pk = self.saved.get(key, (None, None))[0]
+                    # this goes through the query to skip populating an Orm, see
+                    # Summary.save()
+                    if pk:
+                        WatchlistFingerprint.query.is_pk(pk).set_fields(fields).update()
+
+                    else:
+                        fields.update({"name": self.name, "key": key, "_created": now})
+                        pk = WatchlistFingerprint.query.set_fields(fields).insert()
+                    self.saved[key] = (pk, fingerprint)
+
+        return len(pending)
+
+    def swept(self):
+        """call this after a full sweep without any errors, the sweep_key row is saved
+        with a new fingerprint each time so its _updated always changes"""
+        self.set(self.sweep_key, self.hash([datetime.datetime.utcnow().isoformat()]))
+        self.full = False
+        return self.save()
+
+
+class WatchlistCheckpoint(Orm):
+    """The items of a wishlist page that a run has checked, see Checkpoint"""
+    table_name = "watchlist_checkpoint"
+    connection_name = "watchlist"
+
+    name = Field(str, True, max_size=100) # the wishlist name
+    page = Field(int, True) # the page number
+    page_url = Field(str, False)
+    item_index = Field(int, True) # how many items of the page have been checked
+    item_count = Field(int, True) # the count of the last checked item
+    items = ObjectField(True) # (section, uuid, page) of the checked items in the email
+    uuids = ObjectField(False) # the uuids of the checked items, see Checkpoint.unsaved()
+
+    name_index = Index("name")
+
+
+class Checkpoint(object):
+    """Saves how far a run has gotten through a wishlist after each page so a run
+    that died (a RobotError, a timeout, running out of memory) can pick up where
+    it left off with --resume instead of fetching and checking everything again
+
+    each checked page is saved as a row with the page's url, how many of its items
+    were checked (a page can be cut short by an error) and the uuid and section of
+    the items that were added to the email. Resuming starts the wishlist at the url
+    of the last page, skips the items that were checked, and loads the items of
+    every page back into the email from the db, so the email still has the whole
+    wishlist. The rows are deleted once the whole wishlist has been checked
+
+    an item that couldn't be saved has to be checked again, so once that happens
+    the checkpoint doesn't go past it anymore and the items checked after it are
+    skipped by their uuid instead, see .unsaved()
+    """
+    saved_sections = set(["cheaper_items", "richer_items"])
+    """the email sections of the items that are saved when they are added, see
+    .restore()"""
+
+    def __init__(self, name):
+        self.name = name
+        self.page = 0 # the number of the last checked page, 0 if there isn't one
+        self.page_url = ""
+        self.item_index = 0
+        self.item_count = 0
+        self.items = [] # (section, uuid, page) of the items in the email of the saved pages
+        self.uuids = set() # the checked items after the last checked page
+        self.pending = [] # (section, uuid, page) added since the last checked page
+        self.pending_uuids = [] # the items checked since the last checked page
+        self.checked = [] # the rows of the checked pages that need to be saved
+        self.saved = (0, "", 0, 0) # the page, page_url, item_index, and item_count of the last saved row
+        self.stuck = False # True once an item couldn't be saved
+
+    @classmethod
+    def load(cls, name):
+        """load the saved pages of wishlist name"""
+        cp = cls(name)
+        for row in WatchlistCheckpoint.query.is_name(name).asc_pk().get():
+            cp.page = row.page
+            cp.page_url = row.page_url or ""
+            cp.item_index = row.item_index
+            cp.item_count = row.item_count
+            cp.items.extend(row.items)
+            cp.uuids.update(row.uuids or [])
+        cp.saved = (cp.page, cp.page_url, cp.item_index, cp.item_count)
+        return cp
+
+    def skip(self, item):
+        """True if item was checked after an item that couldn't be saved, so it
+        was checked before the run was resumed"""
+        return item.uuid in self.uuids
+
+    def restore(self, email):
+        """add the items of the saved pages to email
+
+        each item is loaded from its newest row, the items whose price changed were
+        saved (see Verdict.changed()) so that row is the item's newest row, the
+        rest weren't so they are checked against that row again like they were
+        when they were added
+
+        :returns: int, how many items were added
+        """
+        items = self.items
+        self.items = []
+
+        rows = {}
+        uuids = list(set(uuid for _, uuid, _ in items))
+        for i in range(0, len(uuids), History.chunk_size):
+            chunk = uuids[i:i + History.chunk_size]
+            pks = [s.last_pk for s in Summary.load(chunk).values()]
+            if pks:
+                for row in WatchlistItem.query.in_pk(pks).get():
+                    rows[row.uuid] = row
+
+            for uuid in chunk:
+                if uuid not in rows:
+                    rows[uuid] = WatchlistItem.query.is_uuid(uuid).desc_pk().get_one()
+
+        WatchlistBody.preload(row.body_hash for row in rows.values())
+
+        details = dict(Email.sections)
+        for section, uuid, page in items:
+            row = rows[uuid]
+            item = Item(row.uuid, dict(row.body), row.price)
+            if section in self.saved_sections:
+                item.newest = row
+            item.page = page
+
+            # the key comes from the item, the snapshot doesn't have its rows
+            sl = getattr(email, section)
+            sl.append(item.snapshot(detail=details[section]), key=sl.key(item))
+
+        return len(items)
+
+    def item_added(self, section, item):
+        """call this once item has been added to the email's section"""
+        self.pending.append((section, item.uuid, item.page))
+
+    def item_checked(self, item):
+        """call this once item has been checked without any errors"""
+        self.pending_uuids.append(item.uuid)
+
+    def page_checked(self, page, index=None):
+        """call this once every item of page has been checked
+
+        :param index: int, if only the first index items of the page were checked
+        """
+        if not self.stuck:
+            index = len(page) if index is None else index
+            item_index = index
+            if page.number == self.page:
+                # this is the rest of a page that was cut short
+                item_index += self.item_index
+
+            self.page = page.number
+            self.page_url = page.url or self.page_url
+            self.item_index = item_index
+            self.item_count = page[index - 1][0]
+
+        self.checked.append({
+            "page": self.page,
+            "page_url": self.page_url,
+            "item_index": self.item_index,
+            "item_count": self.item_count,
+            "items": self.pending,
+            "uuids": self.pending_uuids,
+        })
+        self.pending = []
+        self.pending_uuids = []
+
+    def unsaved(self, items):
+        """call this with the items that couldn't be saved
+
+        the pages they are on haven't been saved yet (see .save()), so those pages
+        are saved at the last saved page instead and the checkpoint stays there for
+        the rest of the run, a resumed run checks everything after it again except
+        the items in .uuids, which keeps the items that were saved in the email
+        """
+        uuids = set(item.uuid for item in items)
+        if not uuids:
+            return
+
+        self.stuck = True
+        self.page, self.page_url, self.item_index, self.item_count = self.saved
+        for fields in self.checked:
+            fields.update({
+                "page": self.page,
+                "page_url": self.page_url,
+                "item_index": self.item_index,
+                "item_count": self.item_count,
+            })
+            fields["items"] = [t for t in fields["items"] if t[1] not in uuids]
+            fields["uuids"] = [uuid for uuid in fields["uuids"] if uuid not in uuids]
+
+        self.pending = [t for t in self.pending if t[1] not in uuids]
+        self.pending_uuids = [uuid for uuid in self.pending_uuids if uuid not in uuids]
+
+    def save(self):
+        """save the pages that have been checked, this should only be called after
+        their items have been saved, see Email.compact()
+
+        :returns: int, how many pages were saved
+        """
+        checked = self.checked
+        self.checked = []
+        if checked:
+            with WatchlistCheckpoint.interface.transaction():
+                for fields in checked:
+                    WatchlistCheckpoint.create(name=self.name, **fields)
+
+            fields = checked[-1]
+            self.saved = (fields["page"], fields["page_url"], fields["item_index"], fields["item_count"])
+
+        return len(checked)
+
+    def clear(self):
+        """delete the saved pages, this is called once the whole wishlist has been
+        checked or when a run starts over without resuming"""
+        self.page = 0
+        self.page_url = ""
+        self.item_index = 0
+        self.item_count = 0
+        self.items = []
+        self.uuids = set()
+        self.pending = []
+        self.pending_uuids = []
+        self.checked = []
+        self.saved = (0, "", 0, 0)
+        self.stuck = False
+        WatchlistCheckpoint.query.is_name(self.name).delete()
+
+
+class ItemBatch(object):
+    """Buffers the items that need to be saved so they can be saved together in
+    one transaction
+
+    every transaction on SQLite is a commit and an fsync, so saving each changed
+    item on its own really adds up on the first run of a big wishlist. If the
+    transaction fails none of the batch's rows are saved, so the history is
+    never left with half a batch, and then each item is saved on its own so one
+    bad item doesn't lose the rest of the batch. The items that still fail are
+    in .failed and will be found again on the next run
+    """
+    def __init__(self, size=0):
+        """
+        :param size: int, flush every size items, if 0 then the items are only
+            saved when .flush() is called
+        """
+        self.size = size
+        self.items = []
+        self.failed = [] # (item, (e, exc_info)) of the items that couldn't be saved
+
+    def append(self, item):
+        self.items.append(item)
+        if self.size and len(self.items) >= self.size:
+            self.flush()
+
+    @stats.timed("phase", "save")
+    def flush(self):
+        """save all the buffered items
+
+        :returns: int, how many items were saved
+        """
+        items = self.items
+        self.items = []
+        if not items:
+            return 0
+
+        savepoints = [item.savepoint() for item in items]
+        try:
+            with WatchlistItem.interface.transaction():
+                for item in items:
+                    item.save()
+            return len(items)
+
+        except Exception as e:
+            logger.exception(e)
+            for item, savepoint in zip(items, savepoints):
+                item.rollback(savepoint)
+
+        ret = 0
+        for item, savepoint in zip(items, savepoints):
+            try:
+                item.save()
+                ret += 1
+
+            except Exception as e:
+                item.rollback(savepoint)
+                self.failed.append((item, (e, sys.exc_info())))
+        return ret
+
+    def __len__(self):
+        return len(self.items)
+
+
+class History(object):
+    """The price history of one item (uuid) in the db
+
+    Item queries the db for each of its lookups, which adds up to thousands of
+    queries on a big wishlist, so this fetches the history of a bunch of items
+    in a couple of queries and answers those lookups instead
+
+    the lookups are answered by the item's Summary, only the items that
+    don't have a summary yet have all their (pk, price) points fetched to build
+    one, the full WatchlistItem rows are only fetched for the last, cheapest, and
+    richest points
+    """
+    chunk_size = 500
+    """how many uuids will be passed into each IN query"""
+
+    def __init__(self, uuid, summary=None):
+        self.uuid = uuid
+        self.summary = summary or Summary(uuid)
+        self.points = [] # the most recent (pk, price) tuples in pk order
+        if self.summary.last_pk:
+            self.points.append((self.summary.last_pk, self.summary.last_price))
+        self.rows = {} # pk -> WatchlistItem
+
+    @classmethod
+    def load(cls, uuids):
+        """Load the history of all the uuids
+
+        :param uuids: iterable, the uuids of the items
+        :returns: dict, uuid keys with History instance values
+        """
+        uuids = list(set(uuids))
+        histories = {}
+        for i in range(0, len(uuids), cls.chunk_size):
+            chunk = uuids[i:i + cls.chunk_size]
+            for uuid, summary in Summary.load(chunk).items():
+                histories[uuid] = cls(uuid, summary)
+
+            missing = [uuid for uuid in chunk if uuid not in histories]
+            if missing:
+                for uuid in missing:
+                    histories[uuid] = cls(uuid)
+
+                query = WatchlistItem.query.select_fields("_id", "uuid", "price", "_created")
+                for pk, uuid, price, created in query.in_uuid(missing).asc_pk().values():
+                    histories[uuid].points.append((pk, price))
+                    histories[uuid].summary.add(pk, price, created)
+
+            pks = set()
+            for uuid in chunk:
+                h = histories[uuid]
+                for point in [h.last_point(), h.cheapest_point(), h.richest_point()]:
+                    if point:
+                        pks.add(point[0])
+
+            if pks:
+                rows = list(WatchlistItem.query.in_pk(list(pks)).get())
+                WatchlistBody.seen(row.body_hash for row in rows)
+                for row in rows:
+                    histories[row.uuid].rows[row.pk] = row
+
+        return histories
+
+    def last_point(self, pk=None):
+        """the most recent point, or the most recent point before pk"""
+        for point in reversed(self.points):
+            if not pk or point[0] < pk:
+                return point
+
+    def cheapest_point(self):
+        s = self.summary
+        return (s.cheapest_pk, s.cheapest_price) if s.cheapest_pk else None
+
+    def richest_point(self):
+        s = self.summary
+        return (s.richest_pk, s.richest_price) if s.richest_pk else None
+
+    def get(self, point):
+        """return the WatchlistItem for point, querying the db if it isn't loaded"""
+        if not point: return None
+        pk = point[0]
+        if pk not in self.rows:
+            self.rows[pk] = WatchlistItem.query.get_pk(pk)
+        return self.rows[pk]
+
+    def last(self, pk=None):
+        return self.get(self.last_point(pk))
+
+    def cheapest(self):
+        return self.get(self.cheapest_point())
+
+    def richest(self):
+        return self.get(self.richest_point())
+
+    def price_count(self, price):
+        return self.summary.price_count(price)
+
+    def append(self, row):
+        """add a newly saved row to the history"""
+        self.points.append((row.pk, row.price))
+        self.rows[row.pk] = row
+        self.summary.add(row.pk, row.price, row._created)
+
+    def __len__(self):
+        return self.summary.change_count
+
+    def __bool__(self):
+        return len(self) > 0
+    __nonzero__ = __bool__ # 2
+
+
+def migrate():
+    """bring the tables of an existing database up to date, prom only creates a
+    table's indexes when it creates the table so this adds the indexes that were
+    added to the tables after they were created, creating an index that already
+    exists doesn't do anything
+
+    :returns: list, the (table, index name) of every index that was checked
+    """
+    ret = []
+    orm_classes = [
+        WatchlistItem,
+        WatchlistBody,
+        WatchlistSummary,
+        WatchlistFingerprint,
+        WatchlistOutbox,
+        WatchlistCheckpoint,
+    ]
+    for orm_class in orm_classes:
+        schema = orm_class.schema
+        interface = orm_class.interface
+        if interface.has_table(orm_class.table_name):
+            for name, index in schema.indexes.items():
+                interface.set_index(schema, name, index.fields, **index.options)
+                ret.append((orm_class.table_name, name))
+    return ret
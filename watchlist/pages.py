@@ -0,0 +1,336 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, division, print_function, absolute_import
+import sys
+import time
+import threading
+import logging
+
+from .compat import *
+from .models import Item, Fingerprints
+from .rate import is_robot
+from .stats import stats
+
+
+logger = logging.getLogger(__name__)
+
+
+class Page(list):
+    """A page's worth of wishlist items
+
+    each entry is an (item_count, item, error) tuple, if the item couldn't be
+    created then item is None and error is an (e, exc_info) tuple, if the item
+    was skipped because it hasn't changed since the last run then item and error
+    are both None
+    """
+    def __init__(self, number=0):
+        super(Page, self).__init__()
+        self.number = number
+        self.url = "" # the url the page was fetched from, see models.Checkpoint
+        self.fingerprint = "" # set in incremental mode, see models.Fingerprints
+        self.fingerprints = [] # (uuid, fingerprint) tuples of the page's items
+
+
+def resume(wishlist, number, url="", index=0):
+    """iterate the elements of wishlist that come after the first index elements
+    of page number
+
+    the next page's url is only found on the current page, so if the wishlist can
+    start at url it starts on page number again, otherwise it starts from its
+    first page, either way the elements that were already checked are skipped
+
+    :param wishlist: iterable, usually a wishlist.Wishlist instance
+    :param number: int, the last page that was checked
+    :param url: string, the url of page number
+    :param index: int, how many elements of page number were checked
+    :returns: generator, the elements, their .page is counted from number
+    """
+    offset = 0
+    get_wishlist_url = getattr(wishlist, "get_wishlist_url", None)
+    patched = bool(url and get_wishlist_url)
+    if patched:
+        def get_url(path=""):
+            # the wishlist gets its first page's url by calling this without a
+            # path, its own url is still gotten so a wrapped get_wishlist_url
+            # sees every page, see Pages
+            ret = get_wishlist_url(path)
+            return ret if path else url
+
+        wishlist.get_wishlist_url = get_url
+        offset = None
+
+    try:
+        for we in wishlist:
+            if offset is None:
+                offset = number - we.page
+
+            we.page += offset
+            if we.page < number:
+                continue
+
+            if we.page == number and index > 0:
+                index -= 1
+                continue
+
+            yield we
+
+    finally:
+        if patched:
+            wishlist.get_wishlist_url = get_wishlist_url
+
+
+class Pages(object):
+    """Iterate a wishlist a page at a time
+
+    the next page's url is only found on the current page, so pages can't be
+    fetched in parallel, but a background thread can fetch up to prefetch pages
+    ahead while the caller is checking and saving the current page. The queue
+    between them is bounded so the thread blocks once it is prefetch pages ahead,
+    which keeps memory bounded on huge wishlists
+
+    :Example:
+        pages = Pages(Wishlist(name), prefetch=2)
+        try:
+            for page in pages:
+                for item_count, item, error in page:
+                    pass
+        finally:
+            pages.close()
+    """
+    def __init__(self, wishlist, prefetch=2, item_count=1, fingerprints=None, checkpoint=None,
+                 rate=None):
+        """
+        :param wishlist: iterable, usually a wishlist.Wishlist instance
+        :param prefetch: int, how many pages can be fetched ahead, 0 to fetch each
+            page in the calling thread when it is needed
+        :param item_count: int, the count of the first item
+        :param fingerprints: models.Fingerprints, if passed in then the pages and
+            items that haven't changed since the last run are skipped
+        :param checkpoint: models.Checkpoint, if it has a saved page then the
+            pages start after its last checked item, see resume()
+        :param rate: rate.RateController, if passed in then every page fetch waits
+            for it, this needs a wishlist with a get_wishlist_url() method like
+            wishlist.Wishlist since that is called right before each fetch
+        """
+        self.resume_at = (0, "", 0) # the (page, url, index) to start after, see resume()
+        if checkpoint is not None and checkpoint.page:
+            self.resume_at = (checkpoint.page, checkpoint.page_url, checkpoint.item_index)
+            item_count = checkpoint.item_count + 1
+
+        self.wishlist = wishlist
+        self.prefetch = prefetch
+        self.item_count = item_count
+        self.fingerprints = fingerprints
+        self.checkpoint = checkpoint
+        self.stopping = threading.Event()
+        self.queue = None
+        self.thread = None
+
+        self.rate = None
+        self.fetching = None # when the fetch of the page being fetched started
+        get_wishlist_url = getattr(wishlist, "get_wishlist_url", None)
+        if rate is not None and get_wishlist_url:
+            def get_url(path=""):
+                self.fetched()
+                self.fetching = rate.acquire()
+                return get_wishlist_url(path)
+
+            wishlist.get_wishlist_url = get_url
+            self.rate = rate
+
+    def __iter__(self):
+        if self.prefetch > 0:
+            self.start()
+            return self.drain(self.queue)
+
+        else:
+            return self.pages()
+
+    def start(self):
+        """start fetching pages in the background thread, this happens when iterating
+        but can be called before that to get a head start"""
+        if self.prefetch > 0 and not self.thread:
+            self.queue = queue.Queue(maxsize=self.prefetch)
+            self.thread = threading.Thread(target=self.fill, args=(self.queue,))
+            self.thread.daemon = True
+            self.thread.start()
+
+    def pages(self):
+        """the actual fetching of the wishlist, this yields Page instances"""
+        # the elements of a page are gathered before any items are created so the
+        # whole page can be skipped if it hasn't changed
+        number = None
+        elements = []
+        start = time.time()
+        try:
+            for item_count, we in enumerate(self.elements(), self.item_count):
+                if self.stopping.is_set():
+                    break
+
+                if elements and number != we.page:
+                    # the wishlist fetched the next page to get we
+                    stats.observe("phase", "scrape", time.time() - start)
+                    yield self.page(number, elements)
+                    elements = []
+                    start = time.time()
+
+                number = we.page
+                elements.append((item_count, we))
+
+        except Exception:
+            # make sure the items we did get are checked before raising
+            exc_info = sys.exc_info()
+            stats.observe("phase", "scrape", time.time() - start)
+            if elements:
+                yield self.page(number, elements)
+            reraise(*exc_info)
+
+        if elements:
+            stats.observe("phase", "scrape", time.time() - start)
+            yield self.page(number, elements)
+
+    def elements(self):
+        """the wishlist's elements after .resume_at
+
+        if there is a .rate then a robot check starts the wishlist again at the last
+        page it got to, up to .rate.retries times, the robot check has already
+        slowed the rate down so starting again waits for it
+        """
+        number, url, index = self.resume_at
+        retries = 0
+        while True:
+            wishlist = resume(self.wishlist, number, url, index) if number else self.wishlist
+            try:
+                for we in wishlist:
+                    self.fetched()
+                    if we.page != number:
+                        number = we.page
+                        url = ""
+                        index = 0
+
+                    url = url or getattr(we, "page_url", "").split("#")[0]
+                    index += 1
+                    yield we
+
+                self.fetched()
+                return
+
+            except Exception as e:
+                self.fetched(e)
+                if self.rate is None or retries >= self.rate.retries or not is_robot(e):
+                    raise
+
+                retries += 1
+                logger.warning("Robot check after page {}, starting again".format(number))
+
+    def fetched(self, error=None):
+        """let .rate know the fetch of the page is done, this is called when the
+        first element of the page comes in or when the next fetch starts if the
+        page didn't have any elements"""
+        if self.fetching is not None:
+            self.rate.release(self.fetching, error, getattr(self.wishlist, "name", ""))
+            self.fetching = None
+
+    def page(self, number, elements):
+        """create the Page and its items
+
+        :param number: int, the page number
+        :param elements: list, (item_count, wishlist element) tuples
+        :returns: Page
+        """
+        page = Page(number)
+        fps = self.fingerprints
+        bodies = []
+        for item_count, we in elements:
+            try:
+                body = we.jsonable()
+                fp = Fingerprints.item_fingerprint(we.price, body) if fps else ""
+                bodies.append((body, fp, None))
+                if not page.url:
+                    # each element's page_url has an anchor to the element
+                    page.url = body.get("page_url", "").split("#")[0]
+                page.fingerprints.append((we.uuid, fp))
+
+            except Exception as e:
+                bodies.append((None, "", (e, sys.exc_info())))
+
+        if fps:
+            if all(fp for _, fp in page.fingerprints) and len(page.fingerprints) == len(elements):
+                page.fingerprint = Fingerprints.page_fingerprint(page.fingerprints)
+
+            if fps.matches(fps.page_key(number), page.fingerprint):
+                page.extend((item_count, None, None) for item_count, _ in elements)
+                return page
+
+        for (item_count, we), (body, fp, error) in zip(elements, bodies):
+            if not error:
+                if fps and fps.matches(we.uuid, fp):
+                    page.append((item_count, None, None))
+                    continue
+
+                try:
+                    item = Item(
+                        uuid=we.uuid,
+                        body=body,
+                        price=we.price,
+                        element=we,
+                    )
+                    item.fingerprint = fp
+
+                except Exception as e:
+                    error = (e, sys.exc_info())
+
+            if error:
+                page.append((item_count, None, error))
+
+            else:
+                page.append((item_count, item, None))
+
+        return page
+
+    def fill(self, q):
+        """runs in the background thread and puts (page, exc_info) tuples into q,
+        a (None, None) tuple means the wishlist is done"""
+        try:
+            for page in self.pages():
+                if not self.put(q, (page, None)):
+                    return
+
+        except Exception:
+            self.put(q, (None, sys.exc_info()))
+
+        else:
+            self.put(q, (None, None))
+
+    def put(self, q, v):
+        """block until v is in q or .close() is called
+
+        :returns: boolean, False if we are stopping
+        """
+        while not self.stopping.is_set():
+            try:
+                q.put(v, timeout=0.1)
+                return True
+
+            except queue.Full:
+                pass
+
+        return False
+
+    def drain(self, q):
+        """get the pages that .fill() has put into q, re-raising any error from
+        the background thread in this thread"""
+        while True:
+            page, exc_info = q.get()
+            if exc_info:
+                reraise(*exc_info)
+
+            if page is None:
+                break
+
+            yield page
+
+    def close(self):
+        """stop fetching pages, the background thread will stop as soon as it is
+        done with whatever it is currently doing"""
+        self.stopping.set()
+        self.queue = None
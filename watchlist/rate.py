@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""Paces the wishlist page fetches, see `watchlist --rate-delay`"""
+from __future__ import unicode_literals, division, print_function, absolute_import
+import sys
+import time
+import datetime
+import threading
+import logging
+
+from .stats import stats
+from . import environ
+
+
+logger = logging.getLogger(__name__)
+
+
+def is_robot(e):
+    """True if e is the wishlist package's RobotError, which it raises when Amazon
+    answers with a robot check instead of the page
+
+    this doesn't import the wishlist package since that pulls in the browser,
+    if it hasn't been imported then e can't be one of its errors
+    """
+    module = sys.modules.get("wishlist.exception")
+    return module is not None and isinstance(e, module.RobotError)
+
+
+class Backoff(object):
+    """A time the controller slowed down, see RateController.lines()"""
+    def __init__(self, reason, name, concurrency, delay, controller):
+        self.created = datetime.datetime.utcnow()
+        self.reason = reason
+        self.name = name
+        self.from_concurrency = int(concurrency)
+        self.to_concurrency = int(controller.concurrency)
+        self.from_delay = delay
+        self.to_delay = controller.delay
+
+    def __str__(self):
+        return "{:%H:%M:%S} {}{}, {} -> {} at a time, {:.2f}s -> {:.2f}s apart".format(
+            self.created,
+            self.reason,
+            " on wishlist {}".format(self.name) if self.name else "",
+            self.from_concurrency,
+            self.to_concurrency,
+            self.from_delay,
+            self.to_delay,
+        )
+
+
+class RateController(object):
+    """Adapts how fast the wishlist pages are fetched to how Amazon is responding
+
+    this is AIMD, like TCP's congestion control: every page that comes back
+    fine speeds up a little (concurrency goes up by one every concurrency pages
+    and the delay goes down by delay_step), and a robot check or an error slows
+    way down (concurrency is cut in half and the delay doubles), so the rate
+    settles just under what Amazon puts up with. A page that takes a lot longer
+    than the pages have been taking is usually the first sign of trouble, so it
+    cuts concurrency but leaves the delay alone
+
+    concurrency is how many pages can be fetched at the same time across all
+    the wishlists (each wishlist still fetches its pages one after the other) and
+    delay is the least time between the start of two fetches
+
+    :Example:
+        rate = RateController(concurrency=4)
+        start = rate.acquire()
+        try:
+            page = fetch()
+        except Exception as e:
+            rate.release(start, e)
+            raise
+        else:
+            rate.release(start)
+    """
+    backoff = 1.0
+    """seconds, the delay after a robot check or an error if there wasn't one"""
+
+    max_delay = 60.0
+
+    delay_step = 0.1
+    """seconds, how much every page that comes back fine takes off the delay"""
+
+    slow_factor = 4.0
+    """a page that takes this many times longer than the average is slow"""
+
+    slow_seconds = 1.0
+    """a page that takes less than this is never slow"""
+
+    retries = 3
+    """how many times a wishlist is started again after a robot check, see Pages"""
+
+    def __init__(self, concurrency=environ.RATE_CONCURRENCY, delay=environ.RATE_DELAY):
+        """
+        :param concurrency: int, the most pages that can be fetched at the same time
+        :param delay: float, seconds, the delay never goes below this
+        """
+        self.max_concurrency = max(concurrency, 1)
+        self.concurrency = float(self.max_concurrency)
+        self.min_delay = delay
+        self.delay = delay
+        self.latency = 0.0 # the moving average of how long a page takes
+        self.active = 0 # how many pages are being fetched right now
+        self.last = 0.0 # when the last fetch started
+        self.started = 0.0 # when the first fetch started
+        self.fetches = 0
+        self.backoffs = []
+        self.condition = threading.Condition()
+
+    @property
+    def rate(self):
+        """the pages per second the controller lets through right now"""
+        rates = []
+        if self.delay:
+            rates.append(1.0 / self.delay)
+        if self.latency:
+            rates.append(int(self.concurrency) / self.latency)
+        return min(rates) if rates else 0.0
+
+    def acquire(self):
+        """wait until another page can be fetched
+
+        :returns: float, when the fetch started, pass it to .release()
+        """
+        start = time.time()
+        with self.condition:
+            while True:
+                now = time.time()
+                wait = self.last + self.delay - now
+                if self.active < int(self.concurrency) and wait <= 0:
+                    break
+                self.condition.wait(wait if wait > 0 else None)
+
+            self.active += 1
+            self.last = now
+            self.started = self.started or now
+
+        stats.observe("rate", "wait", now - start)
+        return now
+
+    def release(self, start, error=None, name=""):
+        """call this once the fetch that .acquire() let through is done
+
+        :param start: float, what .acquire() returned
+        :param error: Exception, if the fetch failed
+        :param name: string, the wishlist name, for the backoffs
+        """
+        latency = time.time() - start
+        with self.condition:
+            self.active -= 1
+            self.fetches += 1
+            if error is not None:
+                self.slow_down("robot check" if is_robot(error) else "error", name, True)
+
+            else:
+                if latency > max(self.latency * self.slow_factor, self.slow_seconds):
+                    self.slow_down("slow page", name, False)
+
+                else:
+                    self.concurrency = min(
+                        self.max_concurrency,
+                        self.concurrency + 1.0 / self.concurrency
+                    )
+                    self.delay = max(self.min_delay, self.delay - self.delay_step)
+
+                self.latency = latency if not self.latency else self.latency * 0.8 + latency * 0.2
+
+            self.condition.notify_all()
+
+        stats.observe("rate", "fetch", latency)
+
+    def slow_down(self, reason, name, delay):
+        """the multiplicative decrease, this has to be called with .condition held
+
+        :param delay: boolean, True to double the delay too
+        """
+        concurrency = self.concurrency
+        from_delay = self.delay
+        self.concurrency = max(1.0, self.concurrency / 2.0)
+        if delay:
+            self.delay = min(self.max_delay, max(self.delay * 2.0, self.backoff))
+
+        backoff = Backoff(reason, name, concurrency, from_delay, self)
+        self.backoffs.append(backoff)
+        logger.warning("Slowing down, {}".format(backoff))
+
+    def lines(self):
+        """the summary that gets printed at the end of a run"""
+        seconds = self.last - self.started if self.fetches > 1 else 0.0
+        yield "{} pages, {:.2f} pages/s, now {:.2f} pages/s with {} at a time {:.2f}s apart".format(
+            self.fetches,
+            (self.fetches - 1) / seconds if seconds else 0.0,
+            self.rate,
+            int(self.concurrency),
+            self.delay,
+        )
+        for backoff in self.backoffs:
+            yield "{}".format(backoff)
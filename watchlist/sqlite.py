@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""A SQLite interface tuned for watchlist, see `WATCHLIST_SQLITE_PROFILE`
+
+    $ export PROM_DSN_1="watchlist.sqlite.SQLite:///path/to/watchlist.db#watchlist"
+
+or keep prom's interface in the dsn and switch to this one with:
+
+    $ export WATCHLIST_SQLITE_PROFILE=tuned
+"""
+from __future__ import unicode_literals, division, print_function, absolute_import
+
+import prom
+from prom.interface.sqlite import SQLite as BaseSQLite
+
+from . import environ
+
+
+class SQLite(BaseSQLite):
+    """prom's SQLite interface with the pragmas that suit a watchlist run, which is
+    one process doing lots of small reads and writes
+
+    the rollback journal syncs the db file on every commit, WAL only appends
+    the changes to the -wal file and synchronous=NORMAL only syncs it at
+    checkpoints, so a crash can lose the last commits but never corrupts the db.
+    WAL is saved in the db file so it stays on even if the db is opened without
+    this interface later
+
+    each pragma can be changed with the dsn's query string:
+
+        watchlist.sqlite.SQLite:///path/to/watchlist.db?synchronous=FULL#watchlist
+    """
+    pragmas = [
+        ("journal_mode", "WAL"),
+        ("synchronous", "NORMAL"),
+        ("cache_size", -64000), # in KiB, so 64MB
+        ("mmap_size", 256 * 1024 * 1024),
+        ("temp_store", "MEMORY"),
+    ]
+
+    cached_statements = 256
+    """sqlite3 reuses the prepared statement of every query string it has seen on
+    the connection, Item's queries are always the same strings but the IN
+    queries of History.load() and the compaction change with the length of their
+    lists, this keeps them from pushing Item's queries out of the cache"""
+
+    def _connect(self, connection_config):
+        options = connection_config.options
+        options["cached_statements"] = int(options.get("cached_statements", self.cached_statements))
+        super(SQLite, self)._connect(connection_config)
+
+        for name, val in self.pragmas:
+            val = options.get(name, val)
+            self._query("PRAGMA {} = {}".format(name, val), ignore_result=True)
+
+    def get_pragmas(self):
+        """returns a dict of the current value of each of the pragmas"""
+        ret = {}
+        for name, _ in self.pragmas:
+            r = self.query("PRAGMA {}".format(name), fetchone=True)
+            ret[name] = r[name]
+        return ret
+
+
+def configure(profile=environ.SQLITE_PROFILE):
+    """switch every connection that uses prom's SQLite interface to SQLite
+
+    :param profile: string, "tuned" to switch, anything else leaves the
+        connections alone
+    :returns: list, the names of the connections that were switched
+    """
+    ret = []
+    if profile == "tuned":
+        for name, interface in list(prom.get_interfaces().items()):
+            if type(interface) is BaseSQLite:
+                interface.close()
+                prom.set_interface(SQLite(interface.connection_config), name)
+                ret.append(name)
+    return ret
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, division, print_function, absolute_import
+import time
+import json
+import threading
+import functools
+
+from .compat import *
+
+
+class Histogram(object):
+    """Counts and latencies of one thing, the buckets are cumulative like a
+    Prometheus histogram so bucket le=0.01 counts everything that took 10ms or less"""
+    buckets = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 60.0)
+    """the upper bounds in seconds, there is also an implied +Inf bucket"""
+
+    def __init__(self):
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        for i, le in enumerate(self.buckets):
+            if seconds <= le:
+                self.counts[i] += 1
+
+    def jsonable(self):
+        return {
+            "count": self.count,
+            "total": self.total,
+            "max": self.max,
+            "buckets": dict(("{}".format(le), c) for le, c in zip(self.buckets, self.counts)),
+        }
+
+
+class Timer(object):
+    """context manager that observes how long its block took"""
+    def __init__(self, stats, kind, name):
+        self.stats = stats
+        self.kind = kind
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stats.observe(self.kind, self.name, time.time() - self.start)
+
+
+class NullTimer(object):
+    """what Stats.timer() returns when stats are off, it doesn't do anything"""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+class Stats(object):
+    """Records how many times things happened and how long they took during a run
+
+    everything is recorded under a kind and a name, the kinds watchlist uses are
+    "phase" (scrape, check, save, render, send), "query" (the Item lookups like
+    last and cheapest), "sql" (the actual db queries by statement type) and "rate"
+    (how long each page fetch took and how long it waited to start, see
+    rate.RateController)
+
+    this is off by default and when it is off .timer() returns a shared timer
+    that does nothing and .observe() returns right away, so leaving the
+    instrumentation in the code costs next to nothing
+
+    :Example:
+        stats.enable()
+        with stats.timer("phase", "render"):
+            html = email.html
+        print(stats)
+    """
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.null_timer = NullTimer()
+        self.clear()
+
+    def enable(self, interface=None):
+        """turn on recording
+
+        :param interface: prom.interface.base.Interface, if passed in every query
+            sent through it will be recorded under the "sql" kind
+        """
+        self.enabled = True
+        if interface is not None and not getattr(interface, "_stats_query", None):
+            _query = interface._query
+            def query(query_str, *args, **kwargs):
+                name = query_str.split(None, 1)[0].lower() if query_str.strip() else ""
+                with self.timer("sql", name):
+                    return _query(query_str, *args, **kwargs)
+
+            interface._query = query
+            interface._stats_query = _query
+
+    def disable(self, interface=None):
+        self.enabled = False
+        if interface is not None and getattr(interface, "_stats_query", None):
+            del interface._query
+            del interface._stats_query
+
+    def clear(self):
+        self.histograms = {} # (kind, name) -> Histogram
+
+    def timer(self, kind, name):
+        """returns a context manager that records how long its block took"""
+        if not self.enabled:
+            return self.null_timer
+        return Timer(self, kind, name)
+
+    def timed(self, kind, name=""):
+        """decorator that records how long each call of the function took
+
+        :param name: string, defaults to the function's name
+        """
+        def decorator(func):
+            n = name or func.__name__
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                with Timer(self, kind, n):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def observe(self, kind, name, seconds):
+        if not self.enabled:
+            return
+
+        # pages are scraped in background threads
+        with self.lock:
+            key = (kind, name)
+            h = self.histograms.get(key)
+            if h is None:
+                h = Histogram()
+                self.histograms[key] = h
+            h.observe(seconds)
+
+    def jsonable(self):
+        ret = {}
+        for (kind, name), h in sorted(self.histograms.items()):
+            ret.setdefault(kind, {})[name] = h.jsonable()
+        return ret
+
+    def prometheus(self):
+        """returns the histograms in the Prometheus text exposition format"""
+        lines = [
+            "# HELP watchlist_seconds How long each part of the watchlist run took",
+            "# TYPE watchlist_seconds histogram",
+        ]
+        for (kind, name), h in sorted(self.histograms.items()):
+            labels = 'kind="{}",name="{}"'.format(kind, name)
+            for le, c in zip(h.buckets, h.counts):
+                lines.append('watchlist_seconds_bucket{{{},le="{}"}} {}'.format(labels, le, c))
+            lines.append('watchlist_seconds_bucket{{{},le="+Inf"}} {}'.format(labels, h.count))
+            lines.append("watchlist_seconds_sum{{{}}} {}".format(labels, h.total))
+            lines.append("watchlist_seconds_count{{{}}} {}".format(labels, h.count))
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        """write the stats to path, as json if path ends with .json, otherwise as
+        Prometheus text so it can be picked up by node_exporter's textfile collector"""
+        from .models import Filepath
+        fp = Filepath(path)
+        if path.endswith(".json"):
+            fp.write(json.dumps(self.jsonable(), indent=2, sort_keys=True))
+        else:
+            fp.write(self.prometheus())
+
+    def lines(self):
+        """the summary that gets printed at the end of a run, one line per kind
+        and name"""
+        for (kind, name), h in sorted(self.histograms.items()):
+            yield "{} {}: {} calls, {:.3f}s total, {:.2f}ms avg, {:.2f}ms max".format(
+                kind,
+                name,
+                h.count,
+                h.total,
+                h.total / h.count * 1000.0 if h.count else 0.0,
+                h.max * 1000.0,
+            )
+
+    def __str__(self):
+        return "\n".join(self.lines())
+
+
+stats = Stats()
+"""the stats of the current run, everything in watchlist records to this"""
@@ -0,0 +1,411 @@
+# -*- coding: utf-8 -*-
+"""Benchmarks for the expensive parts of a watchlist run
+
+    $ python watchlist_bench.py
+    $ python watchlist_bench.py sortedlist
+    $ python watchlist_bench.py run --sizes 1000 10000 100000 --output bench.json
+    $ TMPDIR=/path/on/a/real/disk python watchlist_bench.py sqlite
+    $ python3 watchlist_bench.py startup
+
+everything runs offline against a temporary SQLite db, the results can be written
+to a json file with --output so runs can be compared between commits
+"""
+from __future__ import unicode_literals, division, print_function, absolute_import
+import sys
+import time
+import random
+import bisect
+import argparse
+import json
+import os
+import logging
+import tempfile
+import shutil
+import resource
+import subprocess
+import multiprocessing
+
+import prom
+
+from watchlist.models import SortedList
+
+
+def timeit(callback):
+    """run callback and return how many seconds it took"""
+    start = time.time()
+    callback()
+    return time.time() - start
+
+
+class WishlistElement(object):
+    """stands in for wishlist.WishlistElement, like the one in watchlist_test"""
+    def __init__(self, i, page, price):
+        self.uuid = "bench{:032}".format(i)[-32:]
+        self.page = page
+        self.price = price
+        self.title = "item {}".format(i)
+        self.body = {
+            "uuid": self.uuid,
+            "price": price,
+            "title": self.title,
+            "url": "http://example.com/{}".format(i),
+            "image": "http://example.com/{}.jpg".format(i),
+            "page_url": "http://example.com/page/{}".format(page),
+            "added": "January 1, 2018",
+            "comment": "",
+            "digital": False,
+        }
+
+    def jsonable(self):
+        return dict(self.body)
+
+
+def get_wishlist(size, run, change_rate, nostock_ratio, page_size=25):
+    """generate a synthetic wishlist
+
+    every item has the same starting price every run, then change_rate of them
+    will have a different price and nostock_ratio of them will be out of stock
+
+    :param run: int, the run number, the first run (0) is always the starting price
+    """
+    r = random.Random(run)
+    for i in range(size):
+        price = random.Random(i).randint(100, 10000) / 100.0
+        if run:
+            if r.random() < change_rate:
+                price = round(price * r.choice([0.5, 0.8, 1.2, 1.5]), 2)
+
+            if r.random() < nostock_ratio:
+                price = 0.0
+
+        yield WishlistElement(i, (i // page_size) + 1, price)
+
+
+def count_queries(callback):
+    """run callback and return how many queries it sent to the db"""
+    from watchlist.models import WatchlistItem
+    interface = WatchlistItem.interface
+    queries = [0]
+    _query = interface._query
+    def query(*args, **kwargs):
+        queries[0] += 1
+        return _query(*args, **kwargs)
+
+    interface._query = query
+    try:
+        callback()
+    finally:
+        del interface._query
+    return queries[0]
+
+
+def bench_sortedlist(args):
+    """appending random keys to a SortedList vs. bisect inserting them into one
+    big list, which is what SortedList used to do"""
+    ret = {}
+    for count in (10000, 100000):
+        vals = [random.random() for _ in range(count)]
+
+        def sortedlist():
+            sl = SortedList(key=lambda x: x)
+            sl.extend(vals)
+            list(sl)
+
+        def insort():
+            keys = []
+            values = []
+            for v in vals:
+                i = bisect.bisect_right(keys, v)
+                keys.insert(i, v)
+                values.insert(i, v)
+
+        ret[count] = {
+            "sortedlist": timeit(sortedlist),
+            "insert": timeit(insort),
+        }
+        print("sortedlist {}: {:.3f}s SortedList, {:.3f}s list insert".format(
+            count,
+            ret[count]["sortedlist"],
+            ret[count]["insert"],
+        ))
+
+    return ret
+
+
+def run_size(size, change_rate, nostock_ratio, prefetch, incremental=False, spill_size=0,
+             sqlite_profile=""):
+    """do a first run of a wishlist of size items and then a second run with
+    changes, this is run in its own process so the peak rss is just this size
+
+    :param sqlite_profile: string, see WATCHLIST_SQLITE_PROFILE
+    :returns: dict, the results of the runs
+    """
+    # the bench must never touch a real db, so this ignores any PROM_DSN
+    # environment variables
+    directory = tempfile.mkdtemp()
+    prom.configure("prom.interface.sqlite.SQLite://{}#watchlist".format(
+        os.path.join(directory, "bench.db")
+    ))
+    from watchlist import sqlite
+    sqlite.configure(sqlite_profile)
+    for name in ["captain.echo.stdout", "captain.echo.istdout", "captain.echo.stderr"]:
+        logging.getLogger(name).disabled = True
+    # prom logs the "no such table" error it gets before it creates the tables
+    logging.getLogger("prom").setLevel(logging.CRITICAL)
+
+    from watchlist.__main__ import check_wishlist
+    from watchlist.pages import Pages
+    from watchlist.models import Fingerprints, Email
+    Email.spill_size = spill_size
+
+    ret = {"size": size}
+    try:
+        for run, name in enumerate(["import", "change"]):
+            email = []
+            def callback():
+                wishlist = get_wishlist(size, run, change_rate, nostock_ratio)
+                fingerprints = Fingerprints.load("bench") if incremental else None
+                pages = Pages(wishlist, prefetch=prefetch, fingerprints=fingerprints)
+                email.append(check_wishlist("bench", pages, False))
+
+            start = time.time()
+            queries = count_queries(callback)
+            ret[name] = {
+                "seconds": time.time() - start,
+                "queries": queries,
+                "errors": len(email[0].errors),
+            }
+            for category in ["cheaper_items", "richer_items", "cheapest_items", "nostock_items"]:
+                ret[name][category] = len(getattr(email[0], category))
+
+        ret["render"] = {
+            "seconds": timeit(lambda: email[0].html),
+        }
+        email[0].close()
+        ret["peak_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    finally:
+        shutil.rmtree(directory)
+
+    return ret
+
+
+def run_process(args, size, sqlite_profile=""):
+    """run_size() in its own process"""
+    pool = multiprocessing.Pool(1)
+    try:
+        return pool.apply(
+            run_size,
+            (
+                size,
+                args.change_rate,
+                args.nostock_ratio,
+                args.prefetch,
+                args.incremental,
+                args.spill_size,
+                sqlite_profile,
+            )
+        )
+    finally:
+        pool.terminate()
+
+
+def bench_run(args):
+    """a full run of synthetic wishlists through check_wishlist()"""
+    ret = []
+    for size in args.sizes:
+        r = run_process(args, size, args.sqlite_profile)
+        print("run {size}: import {import[seconds]:.3f}s {import[queries]} queries,"
+            " change {change[seconds]:.3f}s {change[queries]} queries,"
+            " render {render[seconds]:.3f}s, peak rss {peak_rss_kb}kb".format(**r))
+        ret.append(r)
+
+    return ret
+
+
+def bench_sqlite(args):
+    """the runs of bench_run() with prom's SQLite settings and with the tuned ones,
+    the bench db is in TMPDIR so point that at a real disk to see what the fsyncs
+    cost"""
+    ret = []
+    for size in args.sizes:
+        r = {"size": size}
+        for profile in ["", "tuned"]:
+            r[profile or "default"] = run_process(args, size, profile)
+
+        print("sqlite {size}: import {default[import][seconds]:.3f}s default,"
+            " {tuned[import][seconds]:.3f}s tuned, change {default[change][seconds]:.3f}s"
+            " default, {tuned[change][seconds]:.3f}s tuned".format(**r))
+        ret.append(r)
+
+    return ret
+
+
+DEFERRED_MODULES = ["wishlist", "brow", "selenium", "bs4", "sendgrid"]
+"""watchlist only imports these when it needs them, so importing any of them at
+startup is a regression"""
+
+
+def get_startup():
+    """import watchlist.__main__ in a new interpreter like the watchlist command does
+
+    :returns: tuple, (seconds, the DEFERRED_MODULES it imported, the
+        (microseconds, module) of the slowest top level imports if python has
+        -X importtime, which is 3.7+)
+    """
+    script = "import sys, watchlist.__main__; print(' '.join(m for m in {!r} if m in sys.modules))".format(
+        [str(m) for m in DEFERRED_MODULES]
+    )
+    cmd = [sys.executable]
+    importtime = sys.version_info >= (3, 7)
+    if importtime:
+        cmd.extend(["-X", "importtime"])
+    cmd.extend(["-c", script])
+
+    start = time.time()
+    p = subprocess.Popen(
+        cmd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+    )
+    out, err = p.communicate()
+    seconds = time.time() - start
+
+    imports = []
+    if importtime:
+        # import time: self [us] | cumulative | imported package, each level of
+        # nesting indents the package by 2 more spaces, this keeps the top 3 levels
+        for line in err.decode("utf-8").splitlines():
+            if line.startswith("import time:"):
+                bits = line.split("|")
+                name = bits[2][1:].rstrip()
+                depth = (len(name) - len(name.lstrip())) // 2
+                if bits[1].strip().isdigit() and depth <= 2:
+                    imports.append((int(bits[1]), name.strip()))
+        imports.sort(reverse=True)
+
+    return seconds, out.decode("utf-8").split(), imports[:10]
+
+
+def bench_startup(args):
+    """how long it takes to get to main(), every watchlist command pays this, even
+    --help and --dry-run"""
+    runs = [get_startup() for _ in range(5)]
+    seconds = sorted(r[0] for r in runs)
+    deferred = runs[-1][1]
+    imports = runs[-1][2]
+    ret = {
+        "seconds": seconds[len(seconds) // 2],
+        "deferred": deferred,
+        "imports": [{"module": m, "us": us} for us, m in imports],
+    }
+
+    print("startup: {:.3f}s".format(ret["seconds"]))
+    for us, m in imports:
+        print("    {:>8.1f}ms {}".format(us / 1000.0, m))
+    if deferred:
+        print("startup regression, these shouldn't be imported: {}".format(", ".join(deferred)))
+
+    return ret
+
+
+BENCHMARKS = {
+    "sortedlist": bench_sortedlist,
+    "run": bench_run,
+    "sqlite": bench_sqlite,
+    "startup": bench_startup,
+}
+
+
+def get_commit():
+    """returns the current git commit so results can be compared between commits"""
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).decode("utf-8").strip()
+
+    except Exception:
+        return ""
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="watchlist benchmarks")
+    parser.add_argument(
+        "names",
+        nargs="*",
+        help="the benchmarks to run ({}), defaults to all of them".format(
+            ", ".join(sorted(BENCHMARKS.keys()))
+        ),
+    )
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[1000, 10000],
+        help="run: how many items each synthetic wishlist has",
+    )
+    parser.add_argument(
+        "--change-rate",
+        dest="change_rate",
+        type=float,
+        default=0.1,
+        help="run: the fraction of items whose price changes between runs",
+    )
+    parser.add_argument(
+        "--nostock-ratio",
+        dest="nostock_ratio",
+        type=float,
+        default=0.05,
+        help="run: the fraction of items that go out of stock between runs",
+    )
+    parser.add_argument(
+        "--prefetch",
+        type=int,
+        default=2,
+        help="run: how many pages can be fetched ahead",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="run: skip the items that haven't changed, like watchlist --incremental",
+    )
+    parser.add_argument(
+        "--spill-size",
+        dest="spill_size",
+        type=int,
+        default=0,
+        help="run: move the email's items to disk every N items, like watchlist --spill-size",
+    )
+    parser.add_argument(
+        "--sqlite-profile",
+        dest="sqlite_profile",
+        default="",
+        help="run: tuned to use watchlist.sqlite.SQLite, like WATCHLIST_SQLITE_PROFILE",
+    )
+    parser.add_argument(
+        "--output",
+        default="",
+        help="write the results as json to this path",
+    )
+    args = parser.parse_args(argv)
+    for name in args.names:
+        if name not in BENCHMARKS:
+            parser.error("unknown benchmark {}".format(name))
+
+    results = {
+        "commit": get_commit(),
+        "python": sys.version.split()[0],
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+    for name in args.names or sorted(BENCHMARKS.keys()):
+        results[name] = BENCHMARKS[name](args)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
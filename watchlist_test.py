@@ -1,13 +1,28 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals, division, print_function, absolute_import
 import os
+import sys
+import time
+import threading
+import subprocess
+import json
+import datetime
+import pickle
 
 import testdata
+import prom
 from testdata import TestCase
 from captain.client import Captain
 
-from watchlist.models import Item, Email, WatchlistItem, SortedList, Filepath
-from watchlist.email import Email as EmailApi
+from watchlist.models import Item, Email, DigestEmail, WatchlistItem, SortedList, Filepath, ItemBatch, \
+    WatchlistSummary, Summary, Fingerprints, ItemSnapshot, SpillList, WatchlistBody, migrate, \
+    send_emails, WatchlistOutbox, Checkpoint, WatchlistCheckpoint
+from watchlist.pages import Pages, resume
+from watchlist.rate import RateController
+from watchlist.stats import Stats
+from watchlist.email import Email as EmailApi, Delivery, SendError
+from watchlist.compat import is_py3
+from watchlist import sqlite, environ
 
 
 def setUpModule():
@@ -47,6 +62,113 @@ def get_item(item=None, **kwargs):
     return it
 
 
+class WishlistElement(object):
+    """stands in for wishlist.WishlistElement"""
+    def __init__(self, page, **kwargs):
+        self.page = page
+        self.body = get_item(**kwargs).newest.body
+        self.uuid = self.body["uuid"]
+        self.price = self.body["price"]
+        self.title = self.body["title"]
+
+    def jsonable(self):
+        return dict(self.body)
+
+
+def get_wishlist(count, page_size=10, error=None, **kwargs):
+    """returns a generator that stands in for wishlist.Wishlist
+
+    :param count: int, how many items the wishlist has
+    :param page_size: int, how many items are on each page
+    :param error: Exception, raised after the last item if passed in
+    """
+    for i in range(count):
+        yield WishlistElement((i // page_size) + 1, **kwargs)
+
+    if error:
+        raise error
+
+
+class UrlWishlist(object):
+    """stands in for wishlist.Wishlist, each page's url is found on the page
+    before it and the pages are counted from the page it starts on"""
+    def __init__(self, pages=3, robots=None):
+        """
+        :param pages: int, how many pages of 10 items it has
+        :param robots: list, each time one of these page urls is fetched it raises
+            a RobotError and is taken out of the list
+        """
+        self.name = testdata.get_ascii()
+        self.pages = pages
+        self.robots = list(robots or [])
+        self.elements = {} # url -> the page's elements, they are the same each time
+        self.fetched = [] # the urls in the order they were fetched
+
+    def get_wishlist_url(self, path=""):
+        return path or "p1"
+
+    def __iter__(self):
+        url = self.get_wishlist_url()
+        page = 1
+        while url:
+            self.fetched.append(url)
+            if url in self.robots:
+                from wishlist.exception import RobotError
+                self.robots.remove(url)
+                raise RobotError("Amazon robot check")
+
+            if url not in self.elements:
+                self.elements[url] = list(get_wishlist(10))
+
+            for we in self.elements[url]:
+                we.page = page
+                we.page_url = "{}#item".format(url)
+                we.body["page_url"] = we.page_url
+                yield we
+
+            number = int(url[1:]) + 1
+            url = self.get_wishlist_url("p{}".format(number)) if number <= self.pages else ""
+            page += 1
+
+
+def get_server_wishlist(server, name):
+    """returns a generator that stands in for wishlist.Wishlist by fetching each page
+    of wishlist name from server, see EngineTest"""
+    from urllib.request import urlopen
+    page = 1
+    while page:
+        res = urlopen(server.url(name, str(page)))
+        d = json.loads(res.read().decode("utf-8"))
+        for body in d["items"]:
+            yield WishlistElement(page, **body)
+        page = d["next"]
+
+
+def count_queries(callback):
+    """run callback and return all the queries it sent to the db"""
+    interface = WatchlistItem.interface
+    queries = []
+    _query = interface._query
+    def query(query_str, *args, **kwargs):
+        queries.append(query_str)
+        return _query(query_str, *args, **kwargs)
+
+    interface._query = query
+    try:
+        callback()
+    finally:
+        del interface._query
+    return queries
+
+
+def get_query_plan(query, **sql_options):
+    """return the detail lines of SQLite's EXPLAIN QUERY PLAN of query"""
+    interface = query.orm_class.interface
+    query_str, query_args = interface.get_SQL(query.orm_class.schema, query, **sql_options)
+    rows = interface.query("EXPLAIN QUERY PLAN " + query_str, *query_args, fetchall=True)
+    return [r["detail"] for r in rows]
+
+
 class FilepathTest(TestCase):
     def test_write(self):
         path = testdata.get_file("foo/fptw.html")
@@ -54,6 +176,135 @@ class FilepathTest(TestCase):
         fp.write("testing")
         self.assertEqual("testing", path.contents())
 
+    def test_writelines(self):
+        path = testdata.get_file("foo/fptwl.html")
+        fp = Filepath(path)
+        lines = ["one", "two", "\u2713"]
+        fp.writelines(iter(lines))
+        self.assertEqual("\n".join(lines), path.contents())
+
+
+class PagesTest(TestCase):
+    def test_pages(self):
+        for prefetch in [0, 2]:
+            pages = Pages(get_wishlist(25), prefetch=prefetch)
+            ps = list(pages)
+            self.assertEqual([10, 10, 5], [len(p) for p in ps])
+            self.assertEqual([1, 2, 3], [p.number for p in ps])
+            self.assertEqual(list(range(1, 26)), [ic for p in ps for ic, _, _ in p])
+
+    def test_error(self):
+        for prefetch in [0, 2]:
+            pages = Pages(get_wishlist(15, error=ValueError("robot")), prefetch=prefetch)
+            ps = []
+            with self.assertRaises(ValueError):
+                for p in pages:
+                    ps.append(p)
+            self.assertEqual([10, 5], [len(p) for p in ps])
+            self.assertEqual(15, ps[-1][-1][0])
+
+    def test_backpressure(self):
+        fetched = []
+        def wishlist():
+            for we in get_wishlist(100):
+                fetched.append(we)
+                yield we
+
+        pages = Pages(wishlist(), prefetch=2)
+        for p in pages:
+            time.sleep(0.2)
+            # the page we have, the 2 in the queue, and the one being built
+            self.assertLessEqual(len(fetched), 41)
+            break
+        pages.close()
+
+    def test_resume(self):
+        ps = list(Pages(UrlWishlist(), prefetch=0))
+        self.assertEqual(["p1", "p2", "p3"], [p.url for p in ps])
+
+        # the page at the url is fetched again but its checked items are skipped
+        wl = UrlWishlist()
+        ps = list(Pages(resume(wl, 2, "p2", 10), prefetch=0))
+        self.assertEqual([(3, "p3", 10)], [(p.number, p.url, len(p)) for p in ps])
+        self.assertEqual(["p2", "p3"], wl.fetched)
+
+        # without a url the wishlist starts over and skips the checked items
+        ps = list(Pages(resume(get_wishlist(25), 2, index=4), prefetch=0))
+        self.assertEqual([(2, 6), (3, 5)], [(p.number, len(p)) for p in ps])
+
+    def test_rate(self):
+        from wishlist.exception import RobotError
+
+        # the wishlist starts again at the last page it got to after a robot check
+        for prefetch in [0, 2]:
+            wl = UrlWishlist(robots=["p2"])
+            rate = RateController(concurrency=2)
+            rate.backoff = 0.1
+            ps = list(Pages(wl, prefetch=prefetch, rate=rate))
+            self.assertEqual([(1, 10), (2, 10), (3, 10)], [(p.number, len(p)) for p in ps])
+            self.assertEqual(list(range(1, 31)), [ic for p in ps for ic, _, _ in p])
+            self.assertEqual(["p1", "p2", "p1", "p2", "p3"], wl.fetched)
+            self.assertEqual(5, rate.fetches)
+            self.assertEqual(["robot check"], [b.reason for b in rate.backoffs])
+
+        # until it runs out of retries
+        wl = UrlWishlist(robots=["p2"] * 4)
+        rate = RateController(concurrency=2)
+        rate.backoff = 0.01
+        with self.assertRaises(RobotError):
+            list(Pages(wl, prefetch=0, rate=rate))
+        self.assertEqual(4, len(rate.backoffs))
+
+
+class RateTest(TestCase):
+    def test_aimd(self):
+        from wishlist.exception import RobotError
+
+        # the concurrency is its own setting, it doesn't follow --workers
+        self.assertEqual(environ.RATE_CONCURRENCY, RateController().max_concurrency)
+
+        rate = RateController(concurrency=4, delay=0.05)
+        rate.backoff = 0.1
+        rate.delay_step = 0.01
+        rate.release(rate.acquire())
+        self.assertEqual((4, 0.05), (rate.concurrency, rate.delay))
+
+        rate.release(rate.acquire(), RobotError("Amazon robot check"), "foo")
+        self.assertEqual((2, 0.1), (rate.concurrency, rate.delay))
+        rate.release(rate.acquire(), ValueError(), "foo")
+        self.assertEqual((1, 0.2), (rate.concurrency, rate.delay))
+
+        # it speeds back up one page at a time
+        rate.release(rate.acquire())
+        self.assertEqual((2, 0.19), (rate.concurrency, round(rate.delay, 2)))
+        rate.release(rate.acquire())
+        self.assertEqual((2.5, 0.18), (rate.concurrency, round(rate.delay, 2)))
+
+        # a slow page only cuts the concurrency
+        rate.latency = 0.5
+        rate.release(rate.acquire() - 3.0)
+        self.assertEqual((1.25, 0.18), (rate.concurrency, round(rate.delay, 2)))
+
+        self.assertEqual(
+            ["robot check", "error", "slow page"],
+            [b.reason for b in rate.backoffs]
+        )
+        lines = list(rate.lines())
+        self.assertEqual(4, len(lines))
+        self.assertTrue(lines[1].endswith("robot check on wishlist foo, 4 -> 2 at a time, 0.05s -> 0.10s apart"))
+
+    def test_acquire(self):
+        rate = RateController(concurrency=2, delay=0.1)
+        starts = [rate.acquire(), rate.acquire()]
+        self.assertLessEqual(0.1, starts[1] - starts[0])
+
+        # both fetches are still going so the next one waits for one of them
+        t = threading.Timer(0.2, rate.release, [starts[0]])
+        t.start()
+        start = rate.acquire()
+        self.assertLessEqual(0.2, start - starts[0])
+        t.join()
+
 
 class SortedListTest(TestCase):
     def test_append(self):
@@ -71,6 +322,85 @@ class SortedListTest(TestCase):
         self.assertEqual(("foo", 1), sl[0])
         self.assertEqual(("foo", 3), sl[2])
 
+    def test_many(self):
+        sl = SortedList()
+        sl.load = 4
+        vals = [testdata.get_int(0, 50) for _ in range(200)]
+        sl.extend(vals)
+        self.assertEqual(sorted(vals), list(sl))
+        self.assertEqual(200, len(sl))
+        self.assertEqual(sorted(vals)[10:20], sl[10:20])
+        self.assertEqual(sorted(vals)[-1], sl[-1])
+
+        sl = SortedList(reverse=True)
+        sl.load = 4
+        sl.extend(vals)
+        self.assertEqual(sorted(vals, reverse=True), list(sl))
+        self.assertEqual(max(vals), sl[0])
+
+    def test_key_once(self):
+        calls = []
+        def key(x):
+            calls.append(x)
+            return x[1]
+
+        sl = SortedList(key=key)
+        sl.extend([("foo", 2), ("bar", 1), ("che", 2)])
+        self.assertEqual(3, len(calls))
+        self.assertEqual(["bar", "foo", "che"], [x[0] for x in sl])
+        self.assertEqual(("bar", 1), sl[0])
+        self.assertEqual(3, len(calls))
+
+    def test_pop_remove_clear(self):
+        sl = SortedList()
+        sl.load = 2
+        sl.extend([5, 1, 4, 2, 3, 6])
+        self.assertEqual(6, sl.pop())
+        self.assertEqual(1, sl.pop(0))
+        self.assertEqual([2, 3, 4, 5], list(sl))
+
+        sl.remove(4)
+        self.assertEqual([2, 3, 5], list(sl))
+        with self.assertRaises(ValueError):
+            sl.remove(4)
+        with self.assertRaises(IndexError):
+            sl[3]
+
+        sl.clear()
+        self.assertEqual(0, len(sl))
+        self.assertFalse(sl)
+        sl.append(1)
+        self.assertEqual([1], list(sl))
+
+    def test_spill(self):
+        sl = SpillList(key=lambda x: x[1], size=10)
+        vals = [(i, testdata.get_int(0, 50)) for i in range(95)]
+        for i, v in enumerate(vals, 1):
+            sl.append(v)
+            if i % 7 == 0:
+                sl.spill()
+
+        self.assertEqual(6, len(sl._runs))
+        self.assertEqual(95, len(sl))
+        expected = sorted(vals, key=lambda x: x[1])
+        self.assertEqual(expected, list(sl))
+        self.assertEqual(expected[0], sl[0])
+        self.assertEqual(expected[-1], sl[-1])
+        self.assertEqual(expected[10:20], sl[10:20])
+
+        # the last value doesn't read the runs back
+        sl._run = None
+        self.assertEqual(expected[-1], sl[-1])
+        sl.append((95, -1))
+        sl.spill()
+        self.assertEqual(expected[-1], sl[-1])
+        sl.append((96, 51))
+        self.assertEqual((96, 51), sl[-1])
+
+        sl.clear()
+        self.assertFalse(sl)
+        self.assertEqual([], list(sl))
+
 
 class EmailTest(TestCase):
     def test_order(self):
@@ -190,6 +520,88 @@ class EmailTest(TestCase):
 
         #em.send()
 
+    def test_stream(self):
+        em = Email("wishlist-name")
+        em.kwargs["item_count"] = 10
+        for _ in range(3):
+            it = get_item(price=1.0, comment="the comment")
+            WatchlistItem.create(uuid=it.uuid, price=2.0, body={"price": 2.0})
+            em.cheaper_items.append(it)
+        em.richer_items.append(get_item(price=2.0))
+        em.nostock_items.append(get_item(price=0, digital=False))
+
+        html = em.html
+        self.assertEqual(html, "\n".join(em.iter_html()))
+        self.assertTrue(html.startswith("<!DOCTYPE html>"))
+        self.assertTrue("<div><p>\n" in html)
+        self.assertTrue("<hr></div>" not in html)
+        self.assertTrue("</p></div>\n</body>" in html)
+
+        path = testdata.get_file("foo/stream.html")
+        Filepath(path).writelines(em.iter_html())
+        self.assertEqual(html, path.contents())
+
+        text = em.body_text
+        self.assertFalse("<" in text)
+        self.assertTrue(text.startswith(em.summary))
+        for it in em.cheaper_items:
+            self.assertTrue(it.newest.body["title"] in text)
+            self.assertTrue("$1.00 was $2.00" in text)
+            self.assertTrue("the comment" in text)
+
+    def test_render_workers(self):
+        em = Email("wishlist-name")
+        em.kwargs["item_count"] = 10
+        for i in range(5):
+            it = get_item(price=1.0 + i, comment="the comment")
+            WatchlistItem.create(uuid=it.uuid, price=20.0, body={"price": 20.0})
+            WatchlistItem.create(uuid=it.uuid, price=0.5, body={"price": 0.5})
+            em.cheaper_items.append(it)
+            em.richer_items.append(get_item(price=2.0 + i))
+            em.nostock_items.append(get_item(price=0, digital=False))
+
+        html = em.html
+        text = em.body_text
+
+        em.render_workers = 2
+        em.render_min = 2
+        self.assertEqual(html, em.html)
+        pool = em.pool
+        self.assertIsNotNone(pool)
+
+        # every render of the email uses the same pool until it is closed
+        self.assertEqual(text, em.body_text)
+        self.assertIs(pool, em.pool)
+        em.close()
+        self.assertIsNone(em.pool)
+
+    def test_compact(self):
+        em = Email("wishlist-name")
+        em.kwargs["item_count"] = 10
+        for i in range(3):
+            it = get_item(price=1.0 + i, comment="the comment")
+            WatchlistItem.create(uuid=it.uuid, price=20.0, body={"price": 20.0})
+            em.cheaper_items.append(it)
+        em.richer_items.append(get_item(price=2.0))
+        em.nostock_items.append(get_item(price=0, digital=False))
+
+        html = em.html
+        text = em.body_text
+        subject = em.subject
+
+        em.compact()
+        for it in em.cheaper_items:
+            self.assertTrue(isinstance(it, ItemSnapshot))
+            self.assertFalse(hasattr(it, "__dict__"))
+            self.assertEqual(1, len(it.rows()))
+
+        self.assertEqual(html, em.html)
+        self.assertEqual(text, em.body_text)
+        self.assertEqual(subject, em.subject)
+
+        it = pickle.loads(pickle.dumps(em.cheaper_items[0], pickle.HIGHEST_PROTOCOL))
+        self.assertEqual(em.cheaper_items[0].html_detail(), it.html_detail())
+
     def test_nostock(self):
         nit = get_item(price=0, digital=False)
 
@@ -205,6 +617,30 @@ class EmailTest(TestCase):
         self.assertTrue("Lower Priced" in em.body_html)
 
 
+class DigestEmailTest(TestCase):
+    def test_sections(self):
+        ems = []
+        for name in ["foo", "bar", "che"]:
+            em = Email(name)
+            em.kwargs["item_count"] = 10
+            if name != "che":
+                it = get_item(price=1.0)
+                WatchlistItem.create(uuid=it.uuid, price=200, body={})
+                em.cheaper_items.append(it)
+            ems.append(em)
+
+        em = DigestEmail(ems)
+        self.assertEqual(2, len(em))
+        self.assertEqual("2/30 down [wishlists foo, bar, che]", em.subject)
+
+        html = em.html
+        self.assertTrue(html.index("<h1>foo</h1>") < html.index("<h1>bar</h1>"))
+        self.assertFalse("<h1>che</h1>" in html)
+
+        ems[2].errors.append((ValueError(), (None, None, None)))
+        self.assertEqual(1, len(em.errors))
+
+
 class ItemTest(TestCase):
     def test_digital(self):
         nit = Item(
@@ -294,6 +730,48 @@ class ItemTest(TestCase):
         it = Item(price=100, body={}, uuid=uuid)
         self.assertFalse(it.is_newest())
 
+    def test_verdict(self):
+        # make sure the table exists so only the lookups are counted
+        WatchlistItem.create(price=1000, body={}, uuid=testdata.get_hash())
+
+        uuid = testdata.get_hash()
+        it = Item(price=10.0, body={}, uuid=uuid)
+        queries = count_queries(lambda: it.verdict)
+        self.assertEqual(1, len(queries))
+        v = it.verdict
+        self.assertTrue(v.newest)
+        self.assertTrue(v.changed())
+        self.assertIsNone(v.category)
+        self.assertEqual("green", v.color)
+
+        WatchlistItem.create(price=1000, body={}, uuid=uuid)
+        WatchlistItem.create(price=500, body={}, uuid=uuid)
+        WatchlistItem.create(price=2000, body={}, uuid=uuid)
+
+        # an out of stock item only needs its last row
+        tests = [
+            (30.0, "richer_items", 1, "red", 3),
+            (5.0, "cheaper_items", -1, "green", 3),
+            (20.0, None, 0, "red", 3),
+            (0.0, "nostock_items", 0, "black", 1),
+        ]
+        for price, category, direction, color, count in tests:
+            it = Item(price=price, body={}, uuid=uuid)
+            queries = count_queries(lambda: it.verdict)
+            self.assertEqual(count, len(queries))
+            v = it.verdict
+            self.assertFalse(v.newest)
+            self.assertEqual(category, v.category)
+            self.assertEqual(direction, v.direction)
+            self.assertEqual(color, it.color)
+            self.assertEqual(2000, v.last_price)
+
+        WatchlistItem.create(price=500, body={}, uuid=uuid)
+        it = Item(price=5.0, body={}, uuid=uuid)
+        self.assertEqual("cheapest_items", it.verdict.category)
+        self.assertEqual((500, 2000), (it.verdict.cheapest_price, it.verdict.richest_price))
+        self.assertFalse(it.verdict.changed())
+
     def test_richest(self):
         uuid = testdata.get_hash()
         it = WatchlistItem.create(price=10, body={}, uuid=uuid)
@@ -305,6 +783,65 @@ class ItemTest(TestCase):
         richest = it.richest
         self.assertEqual(1000, richest.price)
 
+    def test_preload(self):
+        uuid = testdata.get_hash()
+        WatchlistItem.create(price=10, body={}, uuid=uuid)
+        WatchlistItem.create(price=1, body={}, uuid=uuid)
+        WatchlistItem.create(price=1000, body={}, uuid=uuid)
+        WatchlistItem.create(price=1, body={}, uuid=uuid)
+        WatchlistItem.create(price=100, body={}, uuid=uuid)
+
+        it = get_item(uuid=uuid, price=50)
+        pit = get_item(it)
+        nit = get_item()
+        Item.preload([pit, nit])
+
+        self.assertTrue(nit.is_newest())
+        self.assertIsNone(nit.last)
+        self.assertFalse(pit.is_newest())
+        for k in ["last", "cheapest", "richest"]:
+            self.assertEqual(getattr(it, k).pk, getattr(pit, k).pk)
+        self.assertEqual(2, pit.price_count(pit.cheapest))
+        self.assertEqual(5, pit.count())
+        self.assertEqual(it.html_detail(), pit.html_detail())
+        self.assertEqual(it.html_summary(), pit.html_summary())
+
+        pit.save()
+        self.assertEqual(100, pit.last.price)
+        self.assertEqual(6, pit.count())
+        self.assertEqual(pit.count(), WatchlistItem.query.is_uuid(uuid).count())
+
+    def test_cached_queries(self):
+        uuid = testdata.get_hash()
+        WatchlistItem.create(price=100, body={}, uuid=uuid)
+        WatchlistItem.create(price=10, body={}, uuid=uuid)
+        it = get_item(uuid=uuid, price=1)
+
+        # last, cheapest, richest, the summary, and since there isn't a summary when
+        # it was last at its cheapest and the 3 counts
+        queries = count_queries(lambda: it.html_detail())
+        self.assertEqual(8, len(queries))
+
+        queries = count_queries(lambda: [
+            it.html_detail(),
+            it.html_summary(),
+            it.color,
+            it.is_cheapest(),
+            it.is_richest(),
+            it.is_cheaper(),
+        ])
+        self.assertEqual(0, len(queries))
+
+        # saving adds a row so everything has to be looked up again
+        it.save()
+        self.assertEqual(1, it.cheapest.price)
+        self.assertTrue("3x total changes" in it.html_detail())
+
+        it = get_item(it)
+        self.assertEqual(2, len(count_queries(lambda: Item.preload([it]))))
+        queries = count_queries(lambda: [it.html_detail(), it.html_summary()])
+        self.assertEqual(0, len(queries))
+
     def test_equality(self):
         uuid = testdata.get_hash()
         price = 10
@@ -328,6 +865,41 @@ class ItemTest(TestCase):
         self.assertTrue(it.is_richest())
 
 
+class ItemBatchTest(TestCase):
+    def test_flush(self):
+        batch = ItemBatch(3)
+        its = [get_item() for _ in range(4)]
+        for it in its:
+            batch.append(it)
+        self.assertEqual(1, len(batch))
+        self.assertTrue(its[2].newest.pk)
+        self.assertFalse(its[3].newest.pk)
+
+        self.assertEqual(1, batch.flush())
+        self.assertEqual(0, len(batch))
+        self.assertTrue(its[3].newest.pk)
+
+    def test_rollback(self):
+        batch = ItemBatch()
+        its = [get_item() for _ in range(2)]
+        its.append(get_item(unsaveable=object()))
+        Item.preload(its)
+        for it in its:
+            batch.append(it)
+
+        # the transaction fails so each item is saved on its own
+        self.assertEqual(2, batch.flush())
+        for it in its[:2]:
+            self.assertEqual(1, WatchlistItem.query.is_uuid(it.uuid).count())
+            self.assertEqual(1, len(it.history))
+            self.assertEqual(it.newest.pk, it.history.summary.last_pk)
+
+        self.assertEqual(1, len(batch.failed))
+        self.assertEqual(its[2], batch.failed[0][0])
+        self.assertFalse(its[2].newest.pk)
+        self.assertEqual(0, WatchlistItem.query.is_uuid(its[2].uuid).count())
+
+
 class WatchlistItemTest(TestCase):
     def test_fset(self):
         uuid = testdata.get_ascii(16)
@@ -404,8 +976,505 @@ class WatchlistItemTest(TestCase):
         it.price = 1256
         self.assertEqual(1256, it.price)
 
+    def test_compact(self):
+        uuid = testdata.get_hash()
+        now = datetime.datetime.utcnow()
+        points = [
+            (10, [5.0, 3.0, 7.0, 4.0]),
+            (9, [4.5, 3.5, 6.0]),
+            (0, [1.0]),
+        ]
+        it = get_item(uuid=uuid, price=1.0)
+        for days, prices in points:
+            for price in prices:
+                it = get_item(it, price=price)
+                it.save()
+                created = now - datetime.timedelta(days=days)
+                WatchlistItem.query.is_pk(it.newest.pk).set_fields(_created=created).update()
+
+        it = get_item(it, price=2.0)
+        Item.preload([it])
+        html = it.html_detail()
+        self.assertTrue("8x total changes" in html)
+        self.assertEqual(html, get_item(it, price=2.0).html_detail())
+
+        items, rows = WatchlistItem.compact(7)
+        self.assertEqual(1, items)
+        self.assertEqual(3, rows)
+
+        prices = [wi.price for wi in WatchlistItem.query.is_uuid(uuid).asc_pk().get()]
+        self.assertEqual([300, 700, 350, 600, 100], prices)
+
+        it = get_item(it, price=2.0)
+        Item.preload([it])
+        self.assertEqual(html, it.html_detail())
+
+        # the counts don't shrink without the preloaded history either
+        it = get_item(it, price=2.0)
+        self.assertEqual(8, it.count())
+        self.assertEqual(html, it.html_detail())
+
+        it = get_item(it, price=2.0)
+        self.assertEqual(100, it.last.price)
+        self.assertEqual(100, it.cheapest.price)
+        self.assertEqual(700, it.richest.price)
+
+        self.assertEqual((0, 0), WatchlistItem.compact(7))
+
+    @TestCase.skipUnless("sqlite" in os.environ.get("PROM_DSN_1", "").lower())
+    def test_query_plans(self):
+        it = get_item(price=10.0)
+        it.save()
+        it.save()
+        uuid = it.uuid
+        pk = it.newest.pk
+
+        queries = [
+            # last
+            WatchlistItem.query.is_uuid(uuid).lt_pk(pk).desc_pk().limit(1),
+            WatchlistItem.query.is_uuid(uuid).desc_pk().limit(1),
+            # cheapest and richest
+            WatchlistItem.query.is_uuid(uuid).gt_price(0).asc_price().limit(1),
+            WatchlistItem.query.is_uuid(uuid).gt_price(0).desc_price().limit(1),
+            # is_newest, count and price_count
+            WatchlistItem.query.select_fields("_id").is_uuid(uuid).limit(1),
+            WatchlistItem.query.select_fields("_id").is_uuid(uuid),
+            WatchlistItem.query.select_fields("_id").is_uuid(uuid).is_price(1000),
+            # History.load
+            WatchlistItem.query.select_fields("_id", "uuid", "price", "_created").in_uuid([uuid]).asc_pk(),
+            WatchlistItem.query.in_pk([pk]),
+            WatchlistSummary.query.in_uuid([uuid]),
+            WatchlistBody.query.select_fields("hash", "body").in_hash([it.newest.body_hash]),
+        ]
+        for query in queries:
+            plan = get_query_plan(query)
+            for detail in plan:
+                # a SCAN without an index reads the whole table
+                self.assertFalse(detail.startswith("SCAN") and "INDEX" not in detail, plan)
+            self.assertFalse([d for d in plan if "TEMP B-TREE" in d], plan)
+
+        plan = get_query_plan(queries[7])
+        self.assertTrue([d for d in plan if "COVERING INDEX" in d], plan)
+
+        WatchlistCheckpoint.interface.set_table(WatchlistCheckpoint.schema)
+        indexes = migrate()
+        self.assertTrue(("watchlist_item", "history_index") in indexes)
+        self.assertTrue(("watchlist_checkpoint", "name_index") in indexes)
+
+
+class WatchlistBodyTest(TestCase):
+    def test_dedupe(self):
+        it = get_item(price=10.0)
+        it.save()
+        body = dict(it.newest.body)
+
+        it = get_item(it, price=5.0)
+        it.save()
+        self.assertEqual(1, WatchlistBody.query.is_hash(it.newest.body_hash).count())
+
+        WatchlistBody.cache.clear()
+        rows = list(WatchlistItem.query.is_uuid(it.uuid).asc_pk().get())
+        self.assertEqual(rows[0].body_hash, rows[1].body_hash)
+        self.assertEqual(body, rows[0].body)
+        self.assertEqual(5.0, rows[1].body["price"])
+        self.assertEqual("$5.00", rows[1].pricetag)
+
+        # rows saved with the whole body still read the same
+        interface = WatchlistItem.interface
+        fields = {
+            "uuid": it.uuid,
+            "price": 100,
+            "body": WatchlistItem.schema.fields["body"].encode(dict(body, price=1.0)),
+            "_created": datetime.datetime.utcnow(),
+            "_updated": datetime.datetime.utcnow(),
+        }
+        pk = WatchlistItem.query.set_fields(fields).insert()
+        wi = WatchlistItem.query.get_pk(pk)
+        self.assertIsNone(wi.body_hash)
+        self.assertEqual(dict(body, price=1.0), wi.body)
+
+
+class WatchlistSummaryTest(TestCase):
+    def test_save(self):
+        uuid = testdata.get_hash()
+        # these are from before the item had a summary
+        WatchlistItem.create(price=10, body={}, uuid=uuid)
+        WatchlistItem.create(price=0, body={}, uuid=uuid)
+
+        for price in [5.0, 20.0, 0.1]:
+            it = get_item(uuid=uuid, price=price)
+            it.save()
+
+        s = Summary.load([uuid])[uuid]
+        self.assertEqual(5, s.change_count)
+        self.assertEqual(it.newest.pk, s.last_pk)
+        self.assertEqual(10, s.last_price)
+        self.assertEqual(10, s.cheapest_price)
+        self.assertNotEqual(it.newest.pk, s.cheapest_pk)
+        self.assertEqual(it.newest._created, s.cheapest_seen)
+        self.assertEqual(2000, s.richest_price)
+        self.assertEqual(2, s.price_count(10))
+        self.assertEqual(1, s.price_count(0))
+
+        # the email's "last on" is the last time it was at its cheapest, with and
+        # without the history
+        it = get_item(uuid=uuid, price=0.1)
+        self.assertEqual(s.cheapest_seen, it.cheapest_seen)
+        Item.preload([it])
+        self.assertEqual(s.cheapest_seen, it.snapshot().cheapest_seen)
+
+        it = get_item(uuid=uuid, price=1.0)
+        self.assertEqual(it.cheapest.pk, s.cheapest_pk)
+        self.assertEqual(it.richest.pk, s.richest_pk)
+
+    def test_rebuild(self):
+        uuid = testdata.get_hash()
+        for price in [10, 1000, 10, 0]:
+            WatchlistItem.create(price=price, body={}, uuid=uuid)
+        self.assertEqual({}, Summary.load([uuid]))
+
+        self.assertLess(0, WatchlistSummary.rebuild())
+        s = Summary.load([uuid])[uuid]
+        self.assertEqual(4, s.change_count)
+        self.assertEqual(0, s.last_price)
+        self.assertEqual(10, s.cheapest_price)
+        self.assertEqual(2, s.price_count(10))
+
+        it = get_item(uuid=uuid, price=0.05)
+        Item.preload([it])
+        self.assertEqual(4, it.count())
+        self.assertEqual(0, it.last.price)
+        self.assertEqual(s.cheapest_pk, it.cheapest.pk)
+
+
+class SQLiteTest(TestCase):
+    def get_interface(self, options=""):
+        path = testdata.get_file("{}.db".format(testdata.get_ascii(8)))
+        dsn = "watchlist.sqlite.SQLite://{}{}#{}".format(path, options, testdata.get_ascii(8))
+        return prom.configure(dsn)
+
+    def test_pragmas(self):
+        inter = self.get_interface()
+        pragmas = inter.get_pragmas()
+        self.assertEqual("wal", pragmas["journal_mode"])
+        self.assertEqual(1, pragmas["synchronous"])
+        self.assertEqual(-64000, pragmas["cache_size"])
+
+        inter = self.get_interface("?synchronous=FULL&cached_statements=10")
+        self.assertEqual(2, inter.get_pragmas()["synchronous"])
+
+    def test_configure(self):
+        interfaces = dict(prom.get_interfaces())
+        try:
+            self.assertEqual([], sqlite.configure(""))
+            names = sqlite.configure("tuned")
+            self.assertTrue(WatchlistItem.connection_name in names)
+            self.assertTrue(isinstance(WatchlistItem.interface, sqlite.SQLite))
+            self.assertEqual([], sqlite.configure("tuned"))
+
+            it = get_item(price=10.0)
+            it.save()
+            self.assertEqual(1, WatchlistItem.query.is_uuid(it.uuid).count())
+
+        finally:
+            for inter in prom.get_interfaces().values():
+                inter.close()
+            prom.interface.interfaces.clear()
+            prom.interface.interfaces.update(interfaces)
+
+
+class StatsTest(TestCase):
+    def test_off(self):
+        s = Stats()
+        with s.timer("phase", "foo"):
+            pass
+        s.observe("phase", "bar", 1.0)
+        self.assertEqual({}, s.histograms)
+
+    def test_timed(self):
+        s = Stats()
+        s.enable()
+
+        @s.timed("query")
+        def foo():
+            return 1
+
+        self.assertEqual(1, foo())
+        self.assertEqual(1, foo())
+        s.observe("phase", "bar", 0.002)
+
+        self.assertEqual(2, s.jsonable()["query"]["foo"]["count"])
+        h = s.jsonable()["phase"]["bar"]
+        self.assertEqual(0, h["buckets"]["0.001"])
+        self.assertEqual(1, h["buckets"]["0.005"])
+
+        text = s.prometheus()
+        self.assertTrue('watchlist_seconds_count{kind="query",name="foo"} 2' in text)
+        self.assertTrue('watchlist_seconds_bucket{kind="phase",name="bar",le="+Inf"} 1' in text)
+
+    def test_sql(self):
+        interface = WatchlistItem.interface
+        s = Stats()
+        s.enable(interface)
+        try:
+            it = get_item()
+            it.save()
+            it.is_newest()
+
+        finally:
+            s.disable(interface)
+
+        # the row, its body and its summary
+        self.assertEqual(3, s.histograms[("sql", "insert")].count)
+        self.assertLess(0, s.histograms[("sql", "select")].count)
+        self.assertFalse("_query" in vars(interface))
+
+        path = testdata.create_file("stats.json", "")
+        s.write(path)
+        with open(path) as f:
+            self.assertTrue("insert" in f.read())
+
 
 class MainTest(TestCase):
+    def test_startup_imports(self):
+        # these are only imported when they're needed, see watchlist_bench.py startup
+        modules = ["wishlist", "brow", "selenium", "bs4", "sendgrid"]
+        script = "import sys, watchlist.__main__; print(' '.join(m for m in {!r} if m in sys.modules))"
+        out = subprocess.check_output(
+            [sys.executable, "-c", script.format([str(m) for m in modules])],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        )
+        self.assertEqual([], out.decode("utf-8").split())
+
+    def test_check_wishlist_seen(self):
+        from watchlist.__main__ import check_wishlist
+
+        uuid = testdata.get_hash()
+        WatchlistItem.create(uuid=uuid, price=1000, body={})
+
+        seen = {}
+        ems = []
+        for name in ["foo", "bar"]:
+            wl = list(get_wishlist(3))
+            wl.append(WishlistElement(1, uuid=uuid, price=5.0))
+            em = check_wishlist(name, Pages(wl, prefetch=0), False, seen)
+            self.assertEqual(1, len(em.cheaper_items))
+            self.assertEqual(4, em.kwargs["item_count"])
+            ems.append(em)
+
+        self.assertIs(ems[0].cheaper_items[0], ems[1].cheaper_items[0])
+        self.assertEqual(2, WatchlistItem.query.is_uuid(uuid).count())
+
+    def test_check_wishlist_incremental(self):
+        from watchlist.__main__ import check_wishlist
+
+        name = testdata.get_ascii()
+        wl = list(get_wishlist(15))
+
+        fps = Fingerprints.load(name, sweep_days=7)
+        self.assertTrue(fps.full)
+        check_wishlist(name, Pages(wl, prefetch=0, fingerprints=fps), False)
+
+        # nothing has changed so nothing is looked up
+        fps = Fingerprints.load(name, sweep_days=7)
+        self.assertFalse(fps.full)
+        pages = Pages(wl, prefetch=0, fingerprints=fps)
+        self.assertEqual([None] * 15, [item for p in pages for _, item, _ in p])
+
+        # only the changed item on the changed page is checked
+        wl[12] = WishlistElement(2, uuid=wl[12].uuid, price=wl[12].price / 2.0)
+        fps = Fingerprints.load(name)
+        pages = Pages(wl, prefetch=0, fingerprints=fps)
+        em = []
+        queries = count_queries(lambda: em.append(check_wishlist(name, pages, False)))
+        self.assertEqual(1, len(em[0].cheaper_items))
+        self.assertEqual(wl[12].uuid, em[0].cheaper_items[0].uuid)
+        self.assertEqual(15, em[0].kwargs["item_count"])
+        self.assertGreater(10, len(queries))
+
+        fps = Fingerprints.load(name)
+        pages = Pages(wl, prefetch=0, fingerprints=fps)
+        self.assertEqual([None] * 15, [item for p in pages for _, item, _ in p])
+
+        # a full sweep checks everything
+        fps = Fingerprints.load(name)
+        fps.full = True
+        pages = Pages(wl, prefetch=0, fingerprints=fps)
+        em = check_wishlist(name, pages, False)
+        self.assertEqual(15, len(em.cheapest_items))
+
+    def test_check_wishlist_incremental_save_error(self):
+        """an item that couldn't be saved shouldn't be skipped on the next run"""
+        from watchlist.__main__ import check_wishlist
+
+        name = testdata.get_ascii()
+        wl = list(get_wishlist(15))
+        check_wishlist(name, Pages(wl, prefetch=0, fingerprints=Fingerprints(name, True)), False)
+
+        wl[2] = WishlistElement(1, uuid=wl[2].uuid, price=wl[2].price / 2.0)
+        wl[3] = WishlistElement(1, uuid=wl[3].uuid, price=wl[3].price / 2.0, unsaveable=object())
+        em = check_wishlist(name, Pages(wl, prefetch=0, fingerprints=Fingerprints.load(name)), False)
+        self.assertEqual(1, len(em.errors))
+        self.assertEqual(2, len(em.cheaper_items))
+
+        # the item that was saved is skipped, the one that wasn't is checked again
+        body = dict(wl[3].body)
+        body.pop("unsaveable")
+        wl[3] = WishlistElement(1, **body)
+        pages = Pages(wl, prefetch=0, fingerprints=Fingerprints.load(name))
+        items = [item for p in pages for _, item, _ in p]
+        self.assertEqual([wl[3].uuid], [item.uuid for item in items if item])
+
+        em = check_wishlist(name, Pages(wl, prefetch=0, fingerprints=Fingerprints.load(name)), False)
+        self.assertEqual(0, len(em.errors))
+        self.assertEqual([wl[3].uuid], [it.uuid for it in em.cheaper_items])
+
+    def test_check_wishlist_resume(self):
+        from watchlist.__main__ import check_wishlist
+
+        name = testdata.get_ascii()
+        wl = list(get_wishlist(25))
+        check_wishlist(name, Pages(iter(wl), prefetch=0), False)
+        # the first item's price doesn't change so it isn't saved
+        wl = wl[:1] + [WishlistElement(we.page, uuid=we.uuid, price=we.price / 2.0) for we in wl[1:]]
+
+        def wishlist():
+            # the run dies in the middle of the 2nd page
+            for we in wl[:15]:
+                yield we
+            raise ValueError("robot")
+
+        pages = Pages(wishlist(), prefetch=0, checkpoint=Checkpoint(name))
+        em = check_wishlist(name, pages, False)
+        self.assertEqual(1, len(em.errors))
+        self.assertEqual(14, len(em.cheaper_items))
+        self.assertEqual(1, len(em.cheapest_items))
+        rendered = dict((it.uuid, it.text_detail()) for it in em.cheaper_items)
+        rendered[wl[0].uuid] = em.cheapest_items[0].html_summary()
+
+        # only the uuids of the items are saved
+        row = WatchlistCheckpoint.query.is_name(name).asc_pk().get_one()
+        self.assertEqual(("cheapest_items", wl[0].uuid, 1), tuple(row.items[0]))
+
+        cp = Checkpoint.load(name)
+        self.assertEqual((2, 5, 15), (cp.page, cp.item_index, cp.item_count))
+
+        # only the unchecked items are checked but the email still has every item
+        pages = Pages(iter(wl), prefetch=0, checkpoint=cp)
+        em = check_wishlist(name, pages, False)
+        self.assertEqual(0, len(em.errors))
+        self.assertEqual(25, em.kwargs["item_count"])
+        self.assertEqual(
+            [we.uuid for we in sorted(wl[1:], key=lambda we: we.price)],
+            [it.uuid for it in em.cheaper_items],
+        )
+        self.assertEqual(49, WatchlistItem.query.in_uuid([we.uuid for we in wl]).count())
+
+        # the items loaded back from the db render the same as they did
+        for it in em.cheaper_items:
+            if it.uuid in rendered:
+                self.assertEqual(rendered[it.uuid], it.text_detail())
+        self.assertEqual(rendered[wl[0].uuid], em.cheapest_items[0].html_summary())
+
+        # the whole wishlist was checked so there is nothing to resume
+        self.assertEqual(0, Checkpoint.load(name).page)
+
+    def test_check_wishlist_save_error(self):
+        """one item that can't be saved shouldn't stop the rest of the wishlist"""
+        from watchlist.__main__ import check_wishlist
+
+        name = testdata.get_ascii()
+        wl = list(get_wishlist(25))
+        wl[3] = WishlistElement(1, unsaveable=object())
+
+        em = check_wishlist(name, Pages(iter(wl), prefetch=0), False)
+        self.assertEqual(1, len(em.errors))
+        self.assertEqual(25, em.kwargs["item_count"])
+        self.assertEqual(24, WatchlistItem.query.in_uuid([we.uuid for we in wl]).count())
+
+    def test_check_wishlist_resume_save_error(self):
+        """an item that couldn't be saved is checked again when the run is resumed"""
+        from watchlist.__main__ import check_wishlist
+
+        name = testdata.get_ascii()
+        wl = list(get_wishlist(30))
+        check_wishlist(name, Pages(iter(wl), prefetch=0), False)
+        wl = [WishlistElement(we.page, uuid=we.uuid, price=we.price / 2.0) for we in wl]
+        body = wl[13].body
+        wl[13] = WishlistElement(2, unsaveable=object(), **body)
+
+        def wishlist():
+            # the run dies in the middle of the 3rd page
+            for we in wl[:25]:
+                yield we
+            raise ValueError("robot")
+
+        pages = Pages(wishlist(), prefetch=0, checkpoint=Checkpoint(name))
+        em = check_wishlist(name, pages, False)
+        self.assertEqual(2, len(em.errors))
+
+        # the checkpoint doesn't go past the item that wasn't saved
+        cp = Checkpoint.load(name)
+        self.assertEqual((1, 10, 10), (cp.page, cp.item_index, cp.item_count))
+
+        wl[13] = WishlistElement(2, **body)
+        pages = Pages(iter(wl), prefetch=0, checkpoint=cp)
+        em = check_wishlist(name, pages, False)
+        self.assertEqual(0, len(em.errors))
+        self.assertEqual(30, em.kwargs["item_count"])
+        self.assertEqual(
+            [we.uuid for we in sorted(wl, key=lambda we: we.price)],
+            [it.uuid for it in em.cheaper_items],
+        )
+        self.assertEqual(60, WatchlistItem.query.in_uuid([we.uuid for we in wl]).count())
+
+    def test_check_wishlist_resume_bail(self):
+        """the items checked before bailing in the middle of a page are in the
+        email of the resumed run"""
+        from watchlist.__main__ import check_wishlist
+
+        class ErrorElement(WishlistElement):
+            def jsonable(self):
+                raise ValueError("bad element")
+
+        name = testdata.get_ascii()
+        wl = list(get_wishlist(40, page_size=40))
+        check_wishlist(name, Pages(iter(wl), prefetch=0), False)
+        wl = [WishlistElement(we.page, uuid=we.uuid, price=we.price / 2.0) for we in wl]
+        errors = [ErrorElement(we.page, **we.body) for we in wl[3:31]]
+
+        pages = Pages(iter(wl[:3] + errors + wl[31:]), prefetch=0, checkpoint=Checkpoint(name))
+        em = check_wishlist(name, pages, False)
+        self.assertEqual(26, len(em.errors))
+
+        cp = Checkpoint.load(name)
+        self.assertEqual((1, 28, 28), (cp.page, cp.item_index, cp.item_count))
+
+        em = check_wishlist(name, Pages(iter(wl), prefetch=0, checkpoint=cp), False)
+        self.assertEqual(0, len(em.errors))
+        self.assertEqual(
+            set(we.uuid for we in wl[:3] + wl[28:]),
+            set(it.uuid for it in em.cheaper_items),
+        )
+
+        # a resumed run bails once the items it checked have all failed, even
+        # though the checkpoint's items came before them
+        wl = [WishlistElement(we.page, uuid=we.uuid, price=we.price / 2.0) for we in wl]
+
+        def wishlist():
+            for we in wl[:28]:
+                yield we
+            raise ValueError("robot")
+
+        pages = Pages(wishlist(), prefetch=0, checkpoint=Checkpoint(name))
+        em = check_wishlist(name, pages, False)
+        self.assertEqual(1, len(em.errors))
+
+        errors = [ErrorElement(we.page, **we.body) for we in wl[28:]]
+        cp = Checkpoint.load(name)
+        em = check_wishlist(name, Pages(iter(wl[:28] + errors), prefetch=0, checkpoint=cp), False)
+        self.assertEqual(11, len(em.errors))
+
     def test_connect_failure(self):
         """I recently had an issue where the environment variables got screwed up
         so Watchlist failed to connect to the db and I got a huge email with the
@@ -421,7 +1490,226 @@ class MainTest(TestCase):
         self.assertTrue("unable to open database file" in r)
 
 
+class EngineTest(TestCase):
+    @TestCase.skipUnless(is_py3)
+    def test_run(self):
+        from watchlist.aio import Engine
+        from watchlist.__main__ import check_wishlist
+
+        names = [testdata.get_ascii(), testdata.get_ascii()]
+        shared = get_item(price=10.0, digital=False).newest.body
+        wishlists = {}
+        for name in names:
+            wishlists[name] = [get_item(price=10.0, digital=False).newest.body for _ in range(12)]
+            wishlists[name].append(shared)
+
+        page_size = 5
+        def callback(handler):
+            _, name, page = handler.path.split("/")
+            page = int(page)
+            items = wishlists[name]
+            return {
+                "items": items[(page - 1) * page_size:page * page_size],
+                "next": page + 1 if page * page_size < len(items) else 0,
+            }
+
+        def check(engine, dry_run):
+            pages = [Pages(get_server_wishlist(server, name)) for name in names]
+            seen = {}
+            if engine:
+                return Engine(check_wishlist, requests=2).run(names, pages, dry_run, seen)
+
+            else:
+                return [check_wishlist(name, p, dry_run, seen) for name, p in zip(names, pages)]
+
+        def categories(emails):
+            ret = []
+            for em in emails:
+                for k in ["cheaper_items", "richer_items", "cheapest_items", "nostock_items"]:
+                    ret.append([it.uuid for it in getattr(em, k)])
+                ret.append(em.kwargs["item_count"])
+            return ret
+
+        server = testdata.CallbackServer(callback)
+        with server:
+            check(False, False)
+            for items in wishlists.values():
+                for i, price in enumerate([5.0, 20.0, 0.0, 10.0] * 3):
+                    items[i]["price"] = price
+
+            emails = check(True, True)
+            self.assertEqual(categories(check(False, True)), categories(emails))
+            self.assertEqual(3, len(emails[0].cheaper_items))
+            self.assertEqual(13, emails[1].kwargs["item_count"])
+
+            # the engine can save too
+            emails = check(True, False)
+            self.assertEqual(3, len(emails[1].richer_items))
+            # the cheaper and richer items were saved
+            self.assertEqual(6, WatchlistItem.query.in_uuid([b["uuid"] for b in wishlists[names[0]][:4]]).count())
+
+    @TestCase.skipUnless(is_py3)
+    def test_send(self):
+        from watchlist.aio import Engine
+
+        sent = []
+        class SendEmail(Email):
+            def send(self):
+                sent.append(self.name)
+
+        Engine(None, requests=2).send([SendEmail("foo"), SendEmail("bar")])
+        self.assertEqual(["bar", "foo"], sorted(sent))
+
+
 class EmailApiTest(TestCase):
+    def get_server(self, statuses):
+        """returns a server that stands in for SendGrid, it responds to each
+        email with the next status in its statuses list, keyed by the subject"""
+        for k in ["SENDGRID_KEY", "SENDGRID_EMAIL_TO", "SENDGRID_EMAIL_FROM"]:
+            os.environ.setdefault(k, "foo@example.com")
+
+        posts = []
+        def callback(handler):
+            body = json.loads(handler.rfile.read(int(handler.headers["content-length"])).decode("utf-8"))
+            subject = body["subject"]
+            posts.append(subject)
+            status = statuses[subject].pop(0) if len(statuses[subject]) > 1 else statuses[subject][0]
+            handler.send_response(status)
+            handler.end_headers()
+            if status >= 400:
+                return {"errors": [{"message": "{} {}".format(status, subject)}]}
+
+        server = testdata.CallbackServer(callback)
+        server.posts = posts
+        return server
+
+    def get_delivery(self, server):
+        d = Delivery()
+        d.url = server.url("v3/mail/send")
+        d.backoff = 0
+        return d
+
+    def get_email(self, subject):
+        em = EmailApi()
+        em.subject = subject
+        em.body_text = "This is the body"
+        return em
+
+    def test_delivery(self):
+        server = self.get_server({
+            "retried": [503, 429, 202],
+            "bad": [400],
+            "down": [500],
+            "ok": [202],
+        })
+        with server:
+            d = self.get_delivery(server)
+            d.retries = 3
+            ems = [self.get_email(s) for s in ["retried", "bad", "down", "ok"]]
+            rets = d.send(ems, workers=4)
+
+            self.assertEqual(202, rets[0].status_code)
+            self.assertTrue(isinstance(rets[1], SendError))
+            self.assertEqual("400 bad", str(rets[1]))
+            self.assertEqual(500, rets[2].errno)
+            self.assertEqual(202, rets[3].status_code)
+
+            self.assertEqual(3, server.posts.count("retried"))
+            self.assertEqual(1, server.posts.count("bad"))
+            self.assertEqual(4, server.posts.count("down"))
+
+    def test_delivery_connection_error(self):
+        import requests
+
+        class Session(object):
+            posts = 0
+            def post(self, *args, **kwargs):
+                self.posts += 1
+                raise requests.ConnectionError("refused")
+
+        d = Delivery()
+        d.backoff = 0
+        d.retries = 2
+        d.local.session = Session()
+        with self.assertRaises(SendError) as cm:
+            d.post({})
+
+        self.assertEqual(3, d.local.session.posts)
+        self.assertIsNone(cm.exception.errno)
+        self.assertTrue(isinstance(cm.exception.error, requests.ConnectionError))
+        self.assertEqual("refused", str(cm.exception))
+
+    def test_send_emails(self):
+        ems = []
+        for name in ["foo", "bar"]:
+            em = Email(name)
+            em.kwargs["item_count"] = 1
+            em.cheaper_items.append(get_item(price=10.0))
+            ems.append(em)
+        ems[0].errors.append((ValueError("foo"), (None, None, None)))
+
+        server = self.get_server({
+            "1 errors raised": [500],
+            ems[0].subject: [202],
+            ems[1].subject: [400],
+        })
+        with server:
+            interface = EmailApi._interface
+            EmailApi._interface = self.get_delivery(server)
+            EmailApi._interface.retries = 1
+            try:
+                # failing to send the error email is only logged
+                rets = send_emails(ems[:1])
+                self.assertEqual(1, len(rets))
+                self.assertEqual(2, server.posts.count("1 errors raised"))
+
+                # the other emails are still sent when one of them fails
+                with self.assertRaises(SendError):
+                    send_emails([ems[1], ems[0]])
+                self.assertEqual(2, server.posts.count(ems[0].subject))
+
+            finally:
+                EmailApi._interface = interface
+
+    def test_outbox(self):
+        ems = []
+        for name in ["foo", "bar"]:
+            em = Email(name)
+            em.kwargs["item_count"] = 1
+            em.cheaper_items.append(get_item(price=10.0))
+            ems.append(em)
+
+        statuses = {
+            ems[0].subject: [202],
+            ems[1].subject: [503],
+        }
+        server = self.get_server(statuses)
+        with server:
+            interface = EmailApi._interface
+            EmailApi._interface = self.get_delivery(server)
+            EmailApi._interface.retries = 0
+            try:
+                WatchlistOutbox.query.gt_pk(0).delete()
+                self.assertEqual(2, WatchlistOutbox.queue(ems))
+                # they are already waiting to be sent
+                self.assertEqual(0, WatchlistOutbox.queue(ems))
+                self.assertEqual([], server.posts)
+
+                self.assertEqual((1, 1), WatchlistOutbox.flush(batch_size=1))
+                row = WatchlistOutbox.query.one()
+                self.assertEqual(ems[1].subject, row.subject)
+                self.assertEqual(1, row.attempts)
+                self.assertTrue("503" in row.error)
+
+                # the failed one is retried without checking the wishlist again
+                statuses[ems[1].subject] = [202]
+                self.assertEqual((1, 0), WatchlistOutbox.flush())
+                self.assertEqual(0, WatchlistOutbox.query.count())
+                self.assertEqual(3, len(server.posts))
+
+            finally:
+                EmailApi._interface = interface
+
     @TestCase.skipUnless(bool(int(os.environ.get("SEND_EMAIL", 0))))
     def test_sending(self):
         em = EmailApi()